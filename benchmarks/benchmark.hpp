@@ -0,0 +1,76 @@
+// A minimal microbenchmark harness for build.py. Each benchmark prints one JSON
+// line with the fastest of several timed runs, in nanoseconds per operation.
+
+#ifndef FIFTYTHREE_BENCHMARK_HPP
+#define FIFTYTHREE_BENCHMARK_HPP
+
+#include <algorithm>
+#include <chrono>
+#include <cstddef>
+#include <cstdio>
+#include <string>
+
+#ifndef BENCHMARK_REPETITIONS
+#define BENCHMARK_REPETITIONS 5
+#endif
+
+#ifndef BENCHMARK_MIN_TIME_MS
+#define BENCHMARK_MIN_TIME_MS 50
+#endif
+
+namespace benchmark {
+
+// Keeps the optimizer from discarding a result
+template <typename T>
+inline void do_not_optimize(T const& value)
+{
+    asm volatile("" : : "r,m"(value) : "memory");
+}
+
+// body(iterations) runs the benchmark and returns the number of operations it
+// did. The iteration count doubles until a run takes BENCHMARK_MIN_TIME_MS.
+template <typename Body>
+void run(std::string const& name, Body body)
+{
+    typedef std::chrono::steady_clock clock;
+    std::size_t iterations = 1;
+    double best = 0;
+    std::size_t operations = 0;
+    for (int repetition = 0; repetition < BENCHMARK_REPETITIONS; ) {
+        clock::time_point start = clock::now();
+        operations = body(iterations);
+        double elapsed = std::chrono::duration<double, std::nano>(clock::now() - start).count();
+        if (elapsed < BENCHMARK_MIN_TIME_MS * 1e6 && repetition == 0) {
+            iterations *= 2;
+            continue;
+        }
+        double per_op = elapsed / operations;
+        best = repetition == 0 ? per_op : std::min(best, per_op);
+        ++repetition;
+    }
+    std::printf("{\"name\": \"%s\", \"ns_per_op\": %.4f, \"operations\": %lu}\n",
+                name.c_str(), best, static_cast<unsigned long>(operations));
+    std::fflush(stdout);
+}
+
+// Deterministic pseudo-random numbers, so every run measures the same work
+class Random
+{
+public:
+    explicit Random(unsigned seed = 1) : state_(seed) {}
+
+    unsigned next()
+    {
+        state_ ^= state_ << 13;
+        state_ ^= state_ >> 17;
+        state_ ^= state_ << 5;
+        return state_;
+    }
+
+private:
+    unsigned state_;
+};
+
+} // namespace benchmark
+
+#endif
@@ -0,0 +1,27 @@
+#include "benchmark.hpp"
+
+#include <boost/circular_buffer.hpp>
+
+int main()
+{
+    const std::size_t capacities[] = {64, 1024};
+    for (std::size_t capacity : capacities) {
+        benchmark::run("circular_buffer/push_pop/" + std::to_string(capacity), [&](std::size_t iterations) {
+            boost::circular_buffer<int> buffer(capacity);
+            int sum = 0;
+            for (std::size_t i = 0; i < iterations; ++i) {
+                // Fill it, then keep it full: every push_back overwrites the front
+                for (std::size_t j = 0; j < capacity * 2; ++j) {
+                    buffer.push_back(static_cast<int>(j));
+                }
+                while (!buffer.empty()) {
+                    sum += buffer.front();
+                    buffer.pop_front();
+                }
+            }
+            benchmark::do_not_optimize(sum);
+            return iterations * capacity * 3;
+        });
+    }
+    return 0;
+}
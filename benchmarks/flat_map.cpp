@@ -0,0 +1,44 @@
+#include "benchmark.hpp"
+
+#include <boost/container/flat_map.hpp>
+
+#include <vector>
+
+int main()
+{
+    const std::size_t sizes[] = {16, 256, 4096, 65536};
+    for (std::size_t size : sizes) {
+        std::vector<int> keys(size);
+        benchmark::Random random;
+        for (std::size_t i = 0; i < size; ++i) {
+            keys[i] = static_cast<int>(random.next());
+        }
+
+        benchmark::run("flat_map/insert/" + std::to_string(size), [&](std::size_t iterations) {
+            for (std::size_t i = 0; i < iterations; ++i) {
+                boost::container::flat_map<int, int> map;
+                for (int key : keys) {
+                    map.insert(std::make_pair(key, key));
+                }
+                benchmark::do_not_optimize(map.size());
+            }
+            return iterations * size;
+        });
+
+        boost::container::flat_map<int, int> map;
+        for (int key : keys) {
+            map.insert(std::make_pair(key, key));
+        }
+        benchmark::run("flat_map/find/" + std::to_string(size), [&](std::size_t iterations) {
+            int sum = 0;
+            for (std::size_t i = 0; i < iterations; ++i) {
+                for (int key : keys) {
+                    sum += map.find(key)->second;
+                }
+            }
+            benchmark::do_not_optimize(sum);
+            return iterations * size;
+        });
+    }
+    return 0;
+}
@@ -0,0 +1,29 @@
+#include "benchmark.hpp"
+
+#include <boost/uuid/sha1.hpp>
+
+#include <vector>
+
+int main()
+{
+    // Nanoseconds per byte hashed
+    const std::size_t sizes[] = {64, 65536};
+    for (std::size_t size : sizes) {
+        std::vector<unsigned char> data(size);
+        benchmark::Random random;
+        for (std::size_t i = 0; i < size; ++i) {
+            data[i] = static_cast<unsigned char>(random.next());
+        }
+        benchmark::run("sha1/bytes/" + std::to_string(size), [&](std::size_t iterations) {
+            unsigned int digest[5];
+            for (std::size_t i = 0; i < iterations; ++i) {
+                boost::uuids::detail::sha1 sha1;
+                sha1.process_bytes(data.data(), data.size());
+                sha1.get_digest(digest);
+                benchmark::do_not_optimize(digest[0]);
+            }
+            return iterations * size;
+        });
+    }
+    return 0;
+}
@@ -0,0 +1,41 @@
+#include "benchmark.hpp"
+
+#include <boost/variant.hpp>
+
+#include <string>
+#include <vector>
+
+typedef boost::variant<int, double, std::string> Value;
+
+struct Weight : boost::static_visitor<std::size_t>
+{
+    std::size_t operator()(int value) const { return static_cast<std::size_t>(value); }
+    std::size_t operator()(double value) const { return static_cast<std::size_t>(value * 2); }
+    std::size_t operator()(std::string const& value) const { return value.size(); }
+};
+
+int main()
+{
+    const std::size_t count = 1024;
+    std::vector<Value> values;
+    benchmark::Random random;
+    for (std::size_t i = 0; i < count; ++i) {
+        switch (random.next() % 3) {
+        case 0: values.push_back(static_cast<int>(i)); break;
+        case 1: values.push_back(i * 0.5); break;
+        default: values.push_back(std::string(i % 32, 'x')); break;
+        }
+    }
+
+    benchmark::run("variant/visit", [&](std::size_t iterations) {
+        std::size_t sum = 0;
+        for (std::size_t i = 0; i < iterations; ++i) {
+            for (Value const& value : values) {
+                sum += boost::apply_visitor(Weight(), value);
+            }
+        }
+        benchmark::do_not_optimize(sum);
+        return iterations * count;
+    });
+    return 0;
+}
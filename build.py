@@ -1,12 +1,30 @@
 #!/usr/bin/env python
 
+import argparse
+import collections
+import errno
+import fcntl
+import hashlib
+import httplib
+import json
+import mmap
+import multiprocessing
 import os
 import re
+import resource
+import select
 import shlex
 import shutil
+import signal
+import socket
+import struct
 import subprocess
 import sys
+import tarfile
+import threading
+import time
 import traceback
+import urllib2
 
 VERBOSE = False
 
@@ -15,6 +33,24 @@ COMPILER   = 'clang++'
 CPP_STD    = 'c++14'
 STD_LIB    = 'libc++'
 
+# Flags of every platform, for the libraries and the precompiled headers alike
+COMMON_CPP_FLAGS = [
+    '-std={}'.format(CPP_STD),
+    '-fvisibility=default',
+    '-fvisibility-inlines-hidden',
+    '-fPIC',
+    '-DBOOST_SP_USE_SPINLOCK',
+    ]
+
+# Build profiles, each cached and installed on its own: 'lto' builds ThinLTO
+# bitcode, 'size' optimizes for size and puts each function in its own section
+# so the app's linker can dead-strip it, and 'pgo' optimizes with the profile of
+# a training run against instrumented ('pgo-generate') libs.
+BUILD_PROFILES = ['default', 'lto', 'size', 'pgo']
+DEFAULT_BUILD_PROFILE = 'default'
+PGO_TRAINING_SOURCE = 'pgo/train.cpp'
+PGO_PROFILE_PATH = 'pgo/boost.profdata'
+
 # Operating Systems
 IOS_MIN_VERSION = '8.0'
 OSX_MIN_VERSION = '10.9'
@@ -46,7 +82,67 @@ BOOST_HEADERS  = [
     'boost/uuid/sha1.hpp'
     ]
 
+# Benchmarks
+# Every benchmarks/*.cpp is built against the installed headers and host lib,
+# and its results are compared with the baseline saved for the build profile.
+# A benchmark slower than its baseline by more than the threshold fails the build.
+BENCHMARK_THRESHOLD = 0.10
+
+# Precompiled headers
+# An umbrella header of the modules above, precompiled for every platform and
+# arch into pch/, with a clang module map and a report of each header's parse cost
+PCH_DIR = 'pch'
+PCH_UMBRELLA_NAME = 'boost.hpp'
+PCH_MODULE_NAME = 'FiftyThreeBoost'
+PCH_REPORT_HEADERS = 10
+# The headers of modules without a boost/<module>.hpp, where not every header at
+# the top of the module's directory parses on its own
+PCH_MODULE_HEADERS = {
+    'typeof': ['boost/typeof/typeof.hpp'],
+}
+
+# Parallelism
+# The job-slot budget is shared by every b2 process running at the same time.
+# By default it's derived from the core count, capped by physical memory.
+MEMORY_PER_JOB_MB = 512
+
+# Artifact cache
+# Stage dirs of finished BuildTasks are kept here, keyed by everything that goes
+# into the b2 invocation, so an unchanged configuration is restored instead of
+# rebuilt. The least recently used entries are evicted beyond CACHE_SIZE_MB.
+CACHE_DIR = os.path.expanduser('~/Library/Caches/FiftyThree+boost' if sys.platform == 'darwin' else '~/.cache/fiftythree-boost')
+CACHE_SIZE_MB = 2048
+
+# Source cache
+# Tarballs and pristine unpacked trees are shared by every checkout on the
+# machine, keyed by Boost version and tarball checksum. Builds work in a clone
+# (or hard-link farm) of the cached tree, which is evicted LRU beyond
+# SOURCE_CACHE_SIZE_MB.
+SOURCE_CACHE_SIZE_MB = 1024
+
+# Logging
+# Command output is streamed to one log file per stage in LOG_DIR, rotated
+# beyond LOG_FILE_SIZE_MB. Only the last LOG_TAIL_LINES lines of each command are
+# kept in memory, for failure reports.
+LOG_DIR = None
+LOG_FILE_SIZE_MB = 16
+LOG_FILE_BACKUPS = 3
+LOG_TAIL_LINES = 50
+
 BOOST_TARBALL_URL_TEMPLATE = 'http://sourceforge.net/projects/boost/files/boost/{}/boost_{}.tar.bz2/download'
+BOOST_TARBALL_SHA256 = {
+    '1.60.0': '686affff989ac2488f79a97b9479efb9f2abae035b5ed4d8226de6857933fd3b',
+}
+
+# Minimal source
+# With --minimal-source only these parts of the tarball are extracted: the
+# headers, the build system, bcp, libs/<module> of the modules above and the
+# sources, build files and config checks of every library, which is all the
+# native header resolver reads. Docs and the tests of every other library are
+# skipped. bcp copies parts of libs/ too, so this needs the native header
+# resolver to keep the installed headers the same.
+MINIMAL_SOURCE_DIRS = ['boost', 'tools/build', 'tools/bcp', 'libs/config']
+MINIMAL_SOURCE_LIBS = ['filesystem', 'regex', 'system']
 
 #-------------------------------------------------------------------------------
 #
@@ -58,75 +154,2282 @@ BOOST_TARBALL_URL_TEMPLATE = 'http://sourceforge.net/projects/boost/files/boost/
 #
 # Description of each command:
 #
-#  Command       Arguments      Output
-#  -------       -------------  ------------------------------------------------
-#  shell         cmd            To stdout/stderr, returns status code
-#  shell_pipe    callback, cmd  Each line invokes `callback(line)`, returns status
+#  Command        Arguments       Output
+#  -------        --------------  -----------------------------------------------
+#  shell          cmd             To stdout/stderr when verbose, returns status
+#  shell_output   cmd             Returns the command's output
+#  shell_outputs  cmds            Runs the commands concurrently, returns outputs
 #
-# shell will by default halt the build if the command returns
+# shell and shell_output by default raise a CommandError if the command returns
 # a non-zero exit code. Use the ignore_failure parameter to prevent this.
+#
+# All of them go through a CommandRunner, which drives any number of children
+# from one thread with select(), reading their output in large chunks. When a
+# command fails or times out, its still running siblings are cancelled before the
+# error propagates.
+#
+# Output is streamed to the current task's log file. shell keeps only the last
+# LOG_TAIL_LINES lines of each command in memory, for the failure report, so a
+# chatty b2 run doesn't grow the orchestrator. shell_output keeps everything,
+# since it returns it, and is meant for short outputs.
 
-def message_cmd(cmd_long, msg):
-    cmd = os.path.split(shlex.split(cmd_long)[0])[-1]
-    if cmd in ('sh', 'bash'):
-        cmd = os.path.split(shlex.split(cmd_long)[1])[-1]
-        if cmd == '-x':
-            cmd = os.path.split(shlex.split(cmd_long)[2])[-1]
-    print '{}| {}'.format(cmd, msg)
-
-class EchoAccumFilter:
-    def __init__(self, cmd):
-        self.command = cmd
-        self.data = []
-
-    def handle_line_silent(self, line):
-        self.data.append(line)
-
-    def get_data(self):
-        return ''.join(self.data)
-
-def shell_output(cmd, ignore_failure = False):
-    filt = EchoAccumFilter(cmd)
-    status = shell_pipe(filt.handle_line_silent, cmd)
-    if status != 0 and not ignore_failure:
-        print '{} failed with status {}'.format(cmd, status)
-        sys.exit(1)
-    return filt.get_data().rstrip()
-
-def shell(cmd, ignore_failure = False):
-    # Print out every line of the command's output, with a prefix of the command executable's name.
-    callback = lambda x: [message_cmd(cmd, y.rstrip()) for y in re.split('\n|\r', x) if y.strip() != ''] if VERBOSE else None
-    status = shell_pipe(callback, cmd)
-    if status != 0 and not ignore_failure:
-        print '{} failed with status {}'.format(cmd, status)
-        sys.exit(1)
+READ_CHUNK_SIZE = 64 * 1024
 
-def shell_pipe(callback, cmd, redirect_stderr_to_stdout = True):
-    stdout = subprocess.PIPE
-    if redirect_stderr_to_stdout:
-        stderr = subprocess.STDOUT
-    else:
-        stderr = None
+# Seconds a cancelled command gets to exit after SIGTERM before it's killed
+CANCEL_GRACE_PERIOD = 5
 
-    process = subprocess.Popen(shlex.split(cmd), shell = False, stdout = stdout, stderr = stderr)
+class BuildError(Exception):
+    pass
 
-    while process.poll() == None:
-        line = process.stdout.readline()
-        if not line:
-            break
-        if callback:
-            callback(line)
+class CommandError(BuildError):
+
+    def __init__(self, cmd, status, timed_out=False, tail=None):
+        if timed_out:
+            message = '{} timed out'.format(cmd)
+        else:
+            message = '{} failed with status {}'.format(cmd, status)
+        if tail:
+            message += ', last lines of output:\n' + '\n'.join(['    ' + line for line in tail])
+        BuildError.__init__(self, message)
+        self.cmd = cmd
+        self.status = status
+        self.timed_out = timed_out
+        self.tail = tail
+
+class Cancelled(BuildError):
+    pass
+
+def raise_cancelled(signum, frame):
+    raise Cancelled('Cancelled')
+
+def command_label(cmd):
+    # The executable's name, or the script's for commands run through a shell
+    args = shlex.split(cmd)
+    label = os.path.basename(args[0])
+    if label in ('sh', 'bash'):
+        scripts = [arg for arg in args[1:] if not arg.startswith('-')]
+        if scripts:
+            label = os.path.basename(scripts[0].split()[0]) if '-c' in args else os.path.basename(scripts[0])
+    return label
+
+class RotatingLog:
+
+    def __init__(self, path, max_size_mb=LOG_FILE_SIZE_MB, backups=LOG_FILE_BACKUPS):
+        self.path = path
+        self.max_size = max_size_mb * 1024 * 1024
+        self.backups = backups
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.file = open(path, 'a')
+        self.size = os.path.getsize(path)
+
+    def rotate(self):
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.isfile('{}.{}'.format(self.path, i)):
+                os.rename('{}.{}'.format(self.path, i), '{}.{}'.format(self.path, i + 1))
+        if self.backups > 0:
+            os.rename(self.path, '{}.1'.format(self.path))
+        self.file = open(self.path, 'w')
+        self.size = 0
+
+    def write(self, data):
+        if self.size > 0 and self.size + len(data) > self.max_size:
+            self.rotate()
+        self.file.write(data)
+        self.size += len(data)
+
+    def close(self):
+        self.file.close()
+
+# The log of the task (stage) running in this process
+TASK_LOG = None
+
+def open_task_log(name):
+    global TASK_LOG
+    if TASK_LOG:
+        TASK_LOG.close()
+    TASK_LOG = RotatingLog(os.path.join(LOG_DIR, '{}.log'.format(name))) if LOG_DIR else None
+
+class CommandLog:
+
+    def __init__(self, cmd, echo=False, keep_output=False):
+        self.label = command_label(cmd)
+        self.prefix = '{}| '.format(self.label)
+        self.echo = echo
+        self.output = [] if keep_output else None
+        self.tail = collections.deque(maxlen=LOG_TAIL_LINES)
+        self.partial_line = ''
+        if TASK_LOG:
+            TASK_LOG.write('$ {}\n'.format(cmd))
+
+    def handle_data(self, data):
+        if TASK_LOG:
+            TASK_LOG.write(data)
+        if self.output is not None:
+            self.output.append(data)
+        lines = (self.partial_line + data).split('\n')
+        self.partial_line = lines.pop()
+        # A line without an end doesn't get to grow without bound either
+        if len(self.partial_line) > READ_CHUNK_SIZE:
+            lines.append(self.partial_line)
+            self.partial_line = ''
+        self.tail.extend(lines)
+        if self.echo:
+            # Print out every line of the command's output, with a prefix of the command executable's name.
+            for line in lines:
+                if line.strip() != '':
+                    sys.stdout.write(self.prefix + line.rstrip() + '\n')
+
+    def finish(self):
+        if self.partial_line:
+            self.handle_data('\n')
+        if TASK_LOG:
+            TASK_LOG.file.flush()
+
+    def tail_lines(self):
+        return [line.rstrip() for line in self.tail if line.strip() != '']
+
+    def get_output(self):
+        return ''.join(self.output)
+
+class Command:
+
+    def __init__(self, cmd, log=None, timeout=None, redirect_stderr_to_stdout=True):
+        self.cmd = cmd
+        self.log = log or CommandLog(cmd)
+        self.timeout = timeout
+        self.redirect_stderr_to_stdout = redirect_stderr_to_stdout
+        self.process = None
+        self.deadline = None
+        self.status = None
+        self.timed_out = False
+        # Resource usage of the finished process
+        self.usage = {}
+
+    def start(self):
+        stderr = subprocess.STDOUT if self.redirect_stderr_to_stdout else None
+        try:
+            # Each command leads its own process group, so stopping it also stops
+            # whatever it spawned (b2's compilers, a shell's children).
+            self.process = subprocess.Popen(shlex.split(self.cmd), shell = False, stdout = subprocess.PIPE, stderr = stderr,
+                                            close_fds = True, preexec_fn = os.setpgrp)
+        except OSError:
+            raise CommandError(self.cmd, 127)
+        self.started = time.time()
+        if self.timeout:
+            self.deadline = self.started + self.timeout
+
+    def fileno(self):
+        return self.process.stdout.fileno()
+
+    def read(self):
+        # Returns False at the end of the output
+        data = os.read(self.fileno(), READ_CHUNK_SIZE)
+        if data:
+            self.log.handle_data(data)
+        return len(data) > 0
+
+    def finish(self):
+        self.process.stdout.close()
+        usage = {}
+        if self.process.returncode is None:
+            # wait4 also reports the child's resource usage
+            pid, status, rusage = os.wait4(self.process.pid, 0)
+            self.process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+            usage = rusage_fields(rusage)
+        self.usage = usage
+        self.status = self.process.returncode
+        self.log.finish()
+        args = {'cmd': self.cmd, 'status': self.status, 'cpu_user': 0, 'cpu_system': 0, 'max_rss': 0, 'bytes_written': 0}
+        args.update(usage)
+        TRACER.add(self.log.label, 'command', self.started, time.time(), tid=self.process.pid, args=args)
+
+    def error(self):
+        return CommandError(self.cmd, self.status, self.timed_out, self.log.tail_lines())
+
+    def signal_group(self, signum):
+        try:
+            os.killpg(self.process.pid, signum)
+        except OSError:
+            pass
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.signal_group(signal.SIGTERM)
+            deadline = time.time() + CANCEL_GRACE_PERIOD
+            while self.process.poll() is None and time.time() < deadline:
+                time.sleep(0.05)
+            if self.process.poll() is None:
+                self.signal_group(signal.SIGKILL)
+        self.finish()
+
+class CommandRunner:
+
+    def __init__(self, max_concurrency=1):
+        self.max_concurrency = max_concurrency
+        self.running = []
+
+    def run(self, commands, fail_fast=True):
+        # Returns the status of every command. With fail_fast, the first failure
+        # cancels the others and raises a CommandError.
+        pending = list(commands)
+        try:
+            while pending or self.running:
+                while pending and len(self.running) < self.max_concurrency:
+                    command = pending.pop(0)
+                    command.start()
+                    self.running.append(command)
+                deadlines = [command.deadline for command in self.running if command.deadline]
+                wait = max(0, min(deadlines) - time.time()) if deadlines else None
+                readable = select.select(self.running, [], [], wait)[0]
+                for command in readable:
+                    if not command.read():
+                        command.finish()
+                        self.running.remove(command)
+                        if command.status != 0 and fail_fast:
+                            raise command.error()
+                now = time.time()
+                for command in [command for command in self.running if command.deadline and command.deadline <= now]:
+                    command.timed_out = True
+                    command.stop()
+                    self.running.remove(command)
+                    if fail_fast:
+                        raise command.error()
+        except BaseException:
+            self.cancel()
+            raise
+        return [command.status for command in commands]
+
+    def cancel(self):
+        running = self.running
+        self.running = []
+        for command in running:
+            command.stop()
+
+def shell_outputs(cmds, ignore_failure = False, timeout = None, max_concurrency = None):
+    commands = [Command(cmd, CommandLog(cmd, keep_output = True), timeout) for cmd in cmds]
+    CommandRunner(max_concurrency or len(commands)).run(commands, fail_fast = not ignore_failure)
+    return [command.log.get_output().rstrip() for command in commands]
+
+def shell_output(cmd, ignore_failure = False, timeout = None):
+    return shell_outputs([cmd], ignore_failure, timeout)[0]
+
+def shell(cmd, ignore_failure = False, timeout = None):
+    command = Command(cmd, CommandLog(cmd, echo = VERBOSE), timeout)
+    return CommandRunner().run([command], fail_fast = not ignore_failure)[0]
+
+#-------------------------------------------------------------------------------
+#
+# Tracing
+#
+#-------------------------------------------------------------------------------
+
+# Every command and every stage is recorded with its wall time, CPU time, peak RSS
+# and bytes written, taken from the rusage of the command (or of the stage's
+# process and its children). Each stage process saves its events to the trace
+# dir; the pipeline merges them into a JSON summary and a Chrome trace_event file
+# (open it in chrome://tracing or Perfetto).
+
+# Number of commands listed by --profile
+PROFILE_SLOWEST_COMMANDS = 10
+
+def rusage_fields(usage):
+    # ru_maxrss is in bytes on OS X but kilobytes on Linux. Block counts are in
+    # 512 byte units, which makes bytes_written an estimate.
+    return {
+        'cpu_user': usage.ru_utime,
+        'cpu_system': usage.ru_stime,
+        'max_rss': usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024),
+        'bytes_written': usage.ru_oublock * 512,
+    }
+
+class Tracer:
+
+    def __init__(self, process_name):
+        self.process_name = process_name
+        self.pid = os.getpid()
+        self.events = []
+
+    def add(self, name, category, started, finished, tid=None, args=None):
+        self.events.append({
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': int(started * 1000000),
+            'dur': int((finished - started) * 1000000),
+            'pid': self.pid,
+            'tid': tid or self.pid,
+            'args': args or {},
+            })
+
+    def save(self, path):
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'w') as f:
+            json.dump({'process': self.process_name, 'pid': self.pid, 'events': self.events}, f)
+        os.rename(temp_path, path)
+
+# The tracer of this process; each stage process starts its own
+TRACER = Tracer('build')
+
+def start_tracer(name):
+    global TRACER
+    TRACER = Tracer(name)
+
+def process_rusage():
+    # This process and its reaped children together
+    own = rusage_fields(resource.getrusage(resource.RUSAGE_SELF))
+    children = rusage_fields(resource.getrusage(resource.RUSAGE_CHILDREN))
+    return {
+        'cpu_user': own['cpu_user'] + children['cpu_user'],
+        'cpu_system': own['cpu_system'] + children['cpu_system'],
+        'max_rss': max(own['max_rss'], children['max_rss']),
+        'bytes_written': own['bytes_written'] + children['bytes_written'],
+    }
+
+class BuildProfile:
+
+    def __init__(self, trace_dir):
+        self.trace_dir = trace_dir
+        self.summary_path = os.path.join(os.path.dirname(trace_dir), 'build-profile.json')
+        self.trace_path = os.path.join(os.path.dirname(trace_dir), 'build-trace.json')
+
+    def reset(self):
+        if os.path.isdir(self.trace_dir):
+            shutil.rmtree(self.trace_dir)
+        os.makedirs(self.trace_dir)
+
+    def stage_trace_path(self, name):
+        return os.path.join(self.trace_dir, '{}.json'.format(name))
+
+    def previous_durations(self):
+        # Stage durations of the last run, if there was one
+        if not os.path.isfile(self.summary_path):
+            return {}
+        with open(self.summary_path) as f:
+            return dict([(stage['name'], stage['duration']) for stage in json.load(f)['stages']])
+
+    def write(self, pipeline, durations, started, finished):
+        processes = [{'process': TRACER.process_name, 'pid': TRACER.pid, 'events': TRACER.events}]
+        for filename in sorted(os.listdir(self.trace_dir)):
+            if filename.endswith('.json'):
+                with open(os.path.join(self.trace_dir, filename)) as f:
+                    processes.append(json.load(f))
+        trace_events = []
+        stages = []
+        commands = []
+        for process in processes:
+            trace_events.append({'name': 'process_name', 'ph': 'M', 'pid': process['pid'], 'args': {'name': process['process']}})
+            for event in process['events']:
+                trace_events.append(event)
+                record = dict(event['args'])
+                record.update({'name': event['name'], 'start': event['ts'] / 1000000.0 - started, 'duration': event['dur'] / 1000000.0})
+                if event['cat'] == 'stage':
+                    stages.append(record)
+                else:
+                    record['stage'] = process['process']
+                    commands.append(record)
+        path, total = pipeline.critical_path(durations)
+        summary = {
+            'wall_time': finished - started,
+            'job_slots': pipeline.job_slots,
+            'stages': sorted(stages, key=lambda stage: stage['start']),
+            'commands': sorted(commands, key=lambda command: command['start']),
+            'critical_path': [stage.name for stage in path],
+            'critical_path_time': total,
+            }
+        with open(self.summary_path, 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+        with open(self.trace_path, 'w') as f:
+            json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, f)
+        return summary
+
+    def print_report(self, summary):
+        print 'Build took {:.1f}s; profile in {}, trace in {}'.format(summary['wall_time'], self.summary_path, self.trace_path)
+        print 'Slowest commands:'
+        slowest = sorted(summary['commands'], key=lambda command: command['duration'], reverse=True)[:PROFILE_SLOWEST_COMMANDS]
+        for command in slowest:
+            cmd = command['cmd'] if len(command['cmd']) <= 60 else command['cmd'][:57] + '...'
+            print '  {:>8.1f}s  {:>8.1f}s cpu  {:<24} {}'.format(command['duration'], command['cpu_user'] + command['cpu_system'], command['stage'], cmd)
+        print 'Critical path ({:.1f}s): {}'.format(summary['critical_path_time'], ' -> '.join(summary['critical_path']))
+
+#-------------------------------------------------------------------------------
+#
+# Job slots
+#
+#-------------------------------------------------------------------------------
 
-    process.wait()
+def physical_memory():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        pass
+    # OS X doesn't expose SC_PHYS_PAGES on every release
+    memsize = shell_output('sysctl -n hw.memsize', ignore_failure = True)
+    if memsize.isdigit():
+        return int(memsize)
+    return None
+
+def detect_job_slots():
+    slots = multiprocessing.cpu_count()
+    memory = physical_memory()
+    if memory:
+        slots = min(slots, memory // (MEMORY_PER_JOB_MB * 1024 * 1024))
+    return max(1, slots)
+
+def split_job_slots(job_slots, count):
+    # Hand out the budget as evenly as possible, giving the remainder to the first
+    # consumers. Every consumer gets at least one slot.
+    share, remainder = divmod(job_slots, count)
+    return [max(1, share + (1 if i < remainder else 0)) for i in range(count)]
+
+#-------------------------------------------------------------------------------
+#
+# Caching
+#
+#-------------------------------------------------------------------------------
 
-    while True:
-        line = process.stdout.readline()
-        if not line:
+def hash_key(parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True)).hexdigest()
+
+def directory_size(path):
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            filepath = os.path.join(dirpath, filename)
+            if not os.path.islink(filepath):
+                size += os.path.getsize(filepath)
+    return size
+
+# Entries being written are never evicted
+TRANSIENT_SUFFIXES = ('.tmp', '.partial', '.part', '.lock')
+
+class FileLock:
+
+    # An exclusive flock on path. The kernel releases it if the holder dies.
+    def __init__(self, path, blocking=True):
+        self.path = path
+        self.blocking = blocking
+        self.file = None
+
+    def acquire(self):
+        self.file = open(self.path, 'a')
+        try:
+            fcntl.flock(self.file, fcntl.LOCK_EX if self.blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            self.file.close()
+            self.file = None
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return False
+        return True
+
+    def release(self):
+        if self.file:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        # A lock acquired beforehand (see SourceCache.lock) is held as it is;
+        # acquiring it again would drop the first flock before taking the second
+        if self.file is None:
+            self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+def evict_entries(root, max_size, description):
+    # Evicts the least recently used entries of root until it fits in max_size.
+    # An entry's mtime records when it was last used, and entries that a build
+    # holds the lock of are skipped.
+    entries = []
+    for name in os.listdir(root):
+        entry = os.path.join(root, name)
+        if name.endswith(TRANSIENT_SUFFIXES):
+            continue
+        try:
+            size = directory_size(entry) if os.path.isdir(entry) else os.path.getsize(entry)
+            entries.append((os.path.getmtime(entry), size, entry))
+        except OSError as e:
+            # Evicted or replaced by another build meanwhile
+            if e.errno != errno.ENOENT:
+                raise
+    total = sum([size for mtime, size, entry in entries])
+    for mtime, size, entry in sorted(entries):
+        if total <= max_size:
             break
-        if callback:
-            callback(line)
+        # Taking the lock even when nobody has yet closes the gap in which a build
+        # would lock the entry after it was found unlocked
+        lock = FileLock('{}.lock'.format(entry), blocking=False)
+        if not lock.acquire():
+            continue
+        if not os.path.exists(entry):
+            lock.release()
+            continue
+        print 'Evicting {} from the {}'.format(os.path.basename(entry), description)
+        if os.path.isdir(entry):
+            shutil.rmtree(entry, ignore_errors=True)
+        else:
+            os.remove(entry)
+        total -= size
+        lock.release()
+
+class ArtifactCache:
+
+    def __init__(self, root, max_size_mb=CACHE_SIZE_MB, enabled=True, rebuild=False):
+        self.root = os.path.join(root, 'artifacts')
+        self.max_size = max_size_mb * 1024 * 1024
+        # Disabled caches neither restore nor store; rebuilding skips restores
+        # but still refreshes the stored entries.
+        self.enabled = enabled
+        self.rebuild = rebuild
+
+    def entry_path(self, key):
+        return os.path.join(self.root, key)
+
+    def lock(self, key):
+        # Held while an entry is read or replaced, so evict_entries skips it
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        return FileLock('{}.lock'.format(self.entry_path(key)))
+
+    def restore(self, key, path):
+        if not self.enabled or self.rebuild:
+            return False
+        entry = self.entry_path(key)
+        with self.lock(key):
+            if not os.path.isdir(entry):
+                return False
+            # The entry's mtime records when it was last used
+            os.utime(entry, None)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            shutil.copytree(os.path.join(entry, 'data'), path, symlinks=True)
+        return True
+
+    def store(self, key, path):
+        if not self.enabled or not os.path.isdir(path):
+            return
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        entry = self.entry_path(key)
+        # Copy next to the final location and rename, so concurrent builds never
+        # see a partial entry.
+        staging = '{}.{}.tmp'.format(entry, os.getpid())
+        shutil.copytree(path, os.path.join(staging, 'data'), symlinks=True)
+        # An existing entry is moved aside rather than removed first, so the new
+        # one replaces it with a single rename
+        replaced = '{}.{}.old.tmp'.format(entry, os.getpid())
+        with self.lock(key):
+            if os.path.isdir(entry):
+                os.rename(entry, replaced)
+            os.rename(staging, entry)
+        if os.path.isdir(replaced):
+            shutil.rmtree(replaced)
+        self.evict()
+
+    def evict(self):
+        evict_entries(self.root, self.max_size, 'artifact cache')
+
+class SourceCache:
+
+    def __init__(self, root, max_size_mb=SOURCE_CACHE_SIZE_MB):
+        self.root = os.path.join(root, 'sources')
+        self.max_size = max_size_mb * 1024 * 1024
+
+    def entry_path(self, key):
+        return os.path.join(self.root, key)
+
+    def lock(self, key):
+        # Concurrent builds wait for the one filling the entry
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        lock = FileLock('{}.lock'.format(self.entry_path(key)), blocking=False)
+        if not lock.acquire():
+            print 'Waiting for another build to release {}'.format(key)
+            lock.blocking = True
+            lock.acquire()
+        return lock
+
+    def touch(self, key):
+        os.utime(self.entry_path(key), None)
+
+    def evict(self):
+        evict_entries(self.root, self.max_size, 'source cache')
+
+#-------------------------------------------------------------------------------
+#
+# Static archives
+#
+#-------------------------------------------------------------------------------
+
+# A small reader and writer for BSD (Darwin) and GNU `ar` archives, so libraries
+# can be merged member by member without spilling every object to disk.
+#
+# Archives are memory-mapped and members are handed out as read-only buffers
+# into the map. A universal (fat) file is read one architecture slice at a time,
+# which makes `lipo -thin` unnecessary. The writer computes the archive's symbol
+# table itself from the Mach-O or ELF symbol tables of its members.
+
+AR_MAGIC = '!<arch>\n'
+AR_HEADER_SIZE = 60
+
+FAT_MAGIC = 0xcafebabe
+FAT_MAGIC_64 = 0xcafebabf
+
+# (cputype, cpusubtype) of each architecture we build
+MACHO_ARCHITECTURES = {
+    'armv7': (12, 9),
+    'armv7s': (12, 11),
+    'arm64': (0x0100000c, 0),
+    'i386': (7, 3),
+    'x86_64': (0x01000007, 3),
+}
+
+# Symbol table members, which are regenerated rather than copied
+AR_SYMBOL_TABLES = ('/', '/SYM64/', '__.SYMDEF', '__.SYMDEF SORTED', '__.SYMDEF_64', '__.SYMDEF_64 SORTED')
+
+class ArchiveError(BuildError):
+    pass
+
+class ArchiveMember:
+
+    def __init__(self, name, data, mtime=0, uid=0, gid=0, mode=0100644):
+        self.name = name
+        self.data = data
+        self.mtime = mtime
+        self.uid = uid
+        self.gid = gid
+        self.mode = mode
+
+def fat_slices(data):
+    # Returns {(cputype, cpusubtype): (offset, size)}, or None for a thin file
+    if len(data) < 8:
+        return None
+    magic, count = struct.unpack_from('>II', data, 0)
+    if magic == FAT_MAGIC:
+        entry_format = '>iiIII'
+    elif magic == FAT_MAGIC_64:
+        entry_format = '>iiQQII'
+    else:
+        return None
+    slices = {}
+    entry_size = struct.calcsize(entry_format)
+    for i in range(count):
+        fields = struct.unpack_from(entry_format, data, 8 + i * entry_size)
+        # The top byte of the subtype holds capability bits
+        slices[(fields[0], fields[1] & 0x00ffffff)] = (fields[2], fields[3])
+    return slices
+
+class Archive:
+
+    def __init__(self, path, arch=None):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.start = 0
+        self.end = len(self.map)
+        slices = fat_slices(self.map)
+        if slices is not None:
+            if arch not in MACHO_ARCHITECTURES or MACHO_ARCHITECTURES[arch] not in slices:
+                raise ArchiveError('{} has no {} slice'.format(path, arch))
+            offset, size = slices[MACHO_ARCHITECTURES[arch]]
+            self.start = offset
+            self.end = offset + size
+        if self.map[self.start:self.start + len(AR_MAGIC)] != AR_MAGIC:
+            raise ArchiveError('{} is not an archive'.format(path))
+        self.members = self.read_members()
+
+    def read_members(self):
+        members = []
+        gnu_names = None
+        position = self.start + len(AR_MAGIC)
+        while position + AR_HEADER_SIZE <= self.end:
+            header = self.map[position:position + AR_HEADER_SIZE]
+            if header[58:60] != '`\n':
+                raise ArchiveError('{}: bad member header at offset {}'.format(self.path, position - self.start))
+            name = header[0:16].rstrip(' ')
+            size = int(header[48:58])
+            data_start = position + AR_HEADER_SIZE
+            data_size = size
+            position = data_start + size + (size % 2)
+            if name.startswith('#1/'):
+                # BSD: the name precedes the data
+                name_size = int(name[3:])
+                name = self.map[data_start:data_start + name_size].rstrip('\0')
+                data_start += name_size
+                data_size -= name_size
+            elif name == '//':
+                gnu_names = self.map[data_start:data_start + data_size]
+                continue
+            elif name.startswith('/') and name[1:].isdigit():
+                # GNU: an offset into the long name table
+                if gnu_names is None:
+                    raise ArchiveError('{}: long member name without a name table'.format(self.path))
+                offset = int(name[1:])
+                name = gnu_names[offset:gnu_names.index('/\n', offset)]
+            elif name not in AR_SYMBOL_TABLES and name.endswith('/'):
+                name = name[:-1]
+            if name in AR_SYMBOL_TABLES:
+                continue
+            members.append(ArchiveMember(name,
+                                         buffer(self.map, data_start, data_size),
+                                         mtime=int(header[16:28] or 0),
+                                         uid=int(header[28:34] or 0),
+                                         gid=int(header[34:40] or 0),
+                                         mode=int(header[40:48] or '100644', 8)))
+        return members
+
+    def close(self):
+        self.members = []
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def macho_symbol_table(data):
+    # The (name, n_type, n_sect, n_value) of every symbol, and the (addr, size)
+    # of every section, or None if data isn't a Mach-O object
+    magic = struct.unpack_from('<I', data, 0)[0]
+    if magic in (0xfeedface, 0xfeedfacf):
+        endian = '<'
+    elif magic in (0xcefaedfe, 0xcffaedfe):
+        endian = '>'
+    else:
+        return None
+    is_64 = magic in (0xfeedfacf, 0xcffaedfe)
+    ncmds = struct.unpack_from(endian + 'I', data, 16)[0]
+    position = 32 if is_64 else 28
+    symbols = []
+    sections = []
+    for i in range(ncmds):
+        cmd, cmdsize = struct.unpack_from(endian + 'II', data, position)
+        if cmd in (0x1, 0x19): # LC_SEGMENT, LC_SEGMENT_64
+            if cmd == 0x19:
+                nsects = struct.unpack_from(endian + 'I', data, position + 64)[0]
+                section_format, section_offset = 'QQ', position + 72
+            else:
+                nsects = struct.unpack_from(endian + 'I', data, position + 48)[0]
+                section_format, section_offset = 'II', position + 56
+            section_size = 80 if cmd == 0x19 else 68
+            for j in range(nsects):
+                sections.append(struct.unpack_from(endian + section_format, data, section_offset + j * section_size + 32))
+        elif cmd == 0x2: # LC_SYMTAB
+            symoff, nsyms, stroff, strsize = struct.unpack_from(endian + 'IIII', data, position + 8)
+            nlist_format = endian + ('IBBHQ' if is_64 else 'IBBhI')
+            nlist_size = struct.calcsize(nlist_format)
+            strtab = str(data[stroff:stroff + strsize])
+            for j in range(nsyms):
+                strx, n_type, n_sect, n_desc, n_value = struct.unpack_from(nlist_format, data, symoff + j * nlist_size)
+                symbols.append((strtab[strx:strtab.index('\0', strx)], n_type, n_sect, n_value))
+        position += cmdsize
+    return symbols, sections
+
+def macho_symbols(data, undefined=False):
+    table = macho_symbol_table(data)
+    if table is None:
+        return None
+    symbols = []
+    for name, n_type, n_sect, n_value in table[0]:
+        # Skip debugging entries and non-external symbols. Undefined ones
+        # with a value are common symbols, which count as definitions.
+        if n_type & 0xe0 or not n_type & 0x01:
+            continue
+        if (n_type & 0x0e == 0 and n_value == 0) != undefined:
+            continue
+        symbols.append(name)
+    return symbols
+
+def macho_symbol_sizes(data):
+    # Mach-O symbols have no size: each one runs up to the next symbol of its
+    # section, or the section's end
+    table = macho_symbol_table(data)
+    if table is None:
+        return None
+    symbols, sections = table
+    defined = sorted([(n_sect, n_value, name) for name, n_type, n_sect, n_value in symbols
+                      if not n_type & 0xe0 and n_type & 0x0e == 0x0e and 0 < n_sect <= len(sections)])
+    sizes = {}
+    for i, (n_sect, n_value, name) in enumerate(defined):
+        addr, size = sections[n_sect - 1]
+        end = addr + size
+        if i + 1 < len(defined) and defined[i + 1][0] == n_sect:
+            end = defined[i + 1][1]
+        sizes[name] = sizes.get(name, 0) + end - n_value
+    # The value of a common symbol is its size
+    for name, n_type, n_sect, n_value in symbols:
+        if not n_type & 0xe0 and n_type & 0x01 and n_type & 0x0e == 0 and n_value:
+            sizes[name] = sizes.get(name, 0) + n_value
+    return sizes
+
+def elf_symbol_table(data):
+    # The (name, info, shndx, value, size) of every symbol, or None if data
+    # isn't an ELF object
+    if str(data[0:4]) != '\x7fELF':
+        return None
+    is_64 = data[4] == '\x02'
+    endian = '<' if data[5] == '\x01' else '>'
+    if is_64:
+        shoff = struct.unpack_from(endian + 'Q', data, 40)[0]
+        shentsize, shnum = struct.unpack_from(endian + 'HH', data, 58)
+        section_format, symbol_format = 'IIQQQQIIQQ', 'IBBHQQ'
+    else:
+        shoff = struct.unpack_from(endian + 'I', data, 32)[0]
+        shentsize, shnum = struct.unpack_from(endian + 'HH', data, 46)
+        section_format, symbol_format = 'IIIIIIIIII', 'IIIBBH'
+    sections = [struct.unpack_from(endian + section_format, data, shoff + i * shentsize) for i in range(shnum)]
+    symbols = []
+    for section in sections:
+        if section[1] != 2: # SHT_SYMTAB
+            continue
+        offset, size, link, entsize = section[4], section[5], section[6], section[9]
+        strtab = str(data[sections[link][4]:sections[link][4] + sections[link][5]])
+        for i in range(1, size // entsize):
+            fields = struct.unpack_from(endian + symbol_format, data, offset + i * entsize)
+            if is_64:
+                name, info, shndx, value, symbol_size = fields[0], fields[1], fields[3], fields[4], fields[5]
+            else:
+                name, value, symbol_size, info, shndx = fields[0], fields[1], fields[2], fields[3], fields[5]
+            symbols.append((strtab[name:strtab.index('\0', name)], info, shndx, value, symbol_size))
+    return symbols
+
+def elf_symbols(data, undefined=False):
+    table = elf_symbol_table(data)
+    if table is None:
+        return None
+    symbols = []
+    for name, info, shndx, value, size in table:
+        # Global, weak and unique symbols
+        if info >> 4 not in (1, 2, 10) or not name or (shndx == 0) != undefined:
+            continue
+        symbols.append(name)
+    return symbols
+
+def elf_symbol_sizes(data):
+    table = elf_symbol_table(data)
+    if table is None:
+        return None
+    sizes = {}
+    for name, info, shndx, value, size in table:
+        # Defined functions and data objects
+        if info & 0xf not in (1, 2) or shndx == 0 or not name:
+            continue
+        sizes[name] = sizes.get(name, 0) + size
+    return sizes
+
+def object_symbols(data, undefined=False):
+    # Defined (or undefined) external symbols of an object file, or None if it
+    # can't be read
+    if len(data) < 64:
+        return None
+    symbols = macho_symbols(data, undefined)
+    if symbols is None:
+        symbols = elf_symbols(data, undefined)
+    return symbols
+
+def object_symbol_sizes(data):
+    # {name: size} of the symbols defined in an object file, or None if it can't
+    # be read
+    if len(data) < 64:
+        return None
+    sizes = macho_symbol_sizes(data)
+    if sizes is None:
+        sizes = elf_symbol_sizes(data)
+    return sizes
+
+class ArchiveWriter:
+
+    def __init__(self, path, format='bsd'):
+        self.path = path
+        self.format = format
+        self.members = []
+        self.names = set()
+        # Names of the members that came from each library
+        self.labels = {}
+        # False once a member's symbols couldn't be read (LLVM bitcode, for one);
+        # the archive then needs an external ranlib.
+        self.indexed = True
+
+    def add(self, member, label=None):
+        # ar identifies members by name alone. Identical duplicates are dropped, and
+        # different objects with the same name get the label of their library as
+        # a prefix instead of shadowing each other.
+        name = member.name
+        if name in self.names:
+            existing = [m for m in self.members if m.name == name][0]
+            if existing.data == member.data:
+                return False
+            name = '{}_{}'.format(label, member.name) if label else member.name
+            suffix = 1
+            while name in self.names:
+                name = '{}_{}_{}'.format(label, suffix, member.name) if label else '{}_{}'.format(suffix, member.name)
+                suffix += 1
+            print 'Renaming {} to {} in {}: it collides with another member'.format(member.name, name, os.path.basename(self.path))
+        self.names.add(name)
+        self.members.append(ArchiveMember(name, member.data, member.mtime, member.uid, member.gid, member.mode))
+        self.labels.setdefault(label, []).append(name)
+        return True
+
+    def header(self, name, size, member=None):
+        if member is None:
+            member = ArchiveMember(name, '')
+        return '{:<16}{:<12}{:<6}{:<6}{:<8o}{:<10}`\n'.format(name, member.mtime, member.uid, member.gid, member.mode, size)
+
+    def symbols(self):
+        symbols = []
+        for index, member in enumerate(self.members):
+            member_symbols = object_symbols(member.data)
+            if member_symbols is None:
+                self.indexed = False
+                continue
+            symbols.extend([(symbol, index) for symbol in member_symbols])
+        return symbols
+
+    def bsd_layout(self, symbols):
+        # Darwin: every name is stored in front of the data (#1/<length>), padded so
+        # that the data starts on an 8 byte boundary.
+        def name_field(name, offset):
+            padding = -(offset + AR_HEADER_SIZE + len(name)) % 8
+            return name + '\0' * padding
+
+        # Like ranlib, sort the table of contents unless a symbol is defined by more
+        # than one member (weak definitions); then keep every entry in member order.
+        if len(set([symbol for symbol, index in symbols])) == len(symbols):
+            symbols = sorted(symbols)
+            toc_name = name_field('__.SYMDEF SORTED', len(AR_MAGIC))
+        else:
+            toc_name = name_field('__.SYMDEF', len(AR_MAGIC))
+        strtab = ''.join([symbol + '\0' for symbol, index in symbols])
+        strtab += '\0' * (-len(strtab) % 8)
+        toc_size = len(toc_name) + 4 + 8 * len(symbols) + 4 + len(strtab)
+        offset = len(AR_MAGIC) + AR_HEADER_SIZE + toc_size + (toc_size % 2)
+        layout = []
+        for member in self.members:
+            padded_name = name_field(member.name, offset)
+            size = len(padded_name) + len(member.data)
+            layout.append((offset, padded_name, size))
+            offset += AR_HEADER_SIZE + size + (size % 2)
+
+        chunks = [AR_MAGIC, self.header('#1/{}'.format(len(toc_name)), toc_size), toc_name]
+        chunks.append(struct.pack('<I', 8 * len(symbols)))
+        string_offset = 0
+        for symbol, index in symbols:
+            chunks.append(struct.pack('<II', string_offset, layout[index][0]))
+            string_offset += len(symbol) + 1
+        chunks.append(struct.pack('<I', len(strtab)))
+        chunks.append(strtab)
+        if toc_size % 2:
+            chunks.append('\n')
+        for member, (offset, padded_name, size) in zip(self.members, layout):
+            chunks.extend([self.header('#1/{}'.format(len(padded_name)), size, member), padded_name, member.data])
+            if size % 2:
+                chunks.append('\n')
+        return chunks
+
+    def gnu_layout(self, symbols):
+        # GNU: short names end in '/', longer ones live in the '//' name table
+        long_names = ''
+        name_fields = []
+        for member in self.members:
+            if len(member.name) < 16:
+                name_fields.append(member.name + '/')
+            else:
+                name_fields.append('/{}'.format(len(long_names)))
+                long_names += member.name + '/\n'
+        symtab_size = 4 + 4 * len(symbols) + sum([len(symbol) + 1 for symbol, index in symbols])
+        offset = len(AR_MAGIC) + AR_HEADER_SIZE + symtab_size + (symtab_size % 2)
+        if long_names:
+            offset += AR_HEADER_SIZE + len(long_names) + (len(long_names) % 2)
+        offsets = []
+        for member in self.members:
+            offsets.append(offset)
+            offset += AR_HEADER_SIZE + len(member.data) + (len(member.data) % 2)
+
+        chunks = [AR_MAGIC, self.header('/', symtab_size), struct.pack('>I', len(symbols))]
+        chunks.extend([struct.pack('>I', offsets[index]) for symbol, index in symbols])
+        chunks.extend([symbol + '\0' for symbol, index in symbols])
+        if symtab_size % 2:
+            chunks.append('\n')
+        if long_names:
+            chunks.extend([self.header('//', len(long_names)), long_names])
+            if len(long_names) % 2:
+                chunks.append('\n')
+        for member, name_field in zip(self.members, name_fields):
+            chunks.extend([self.header(name_field, len(member.data), member), member.data])
+            if len(member.data) % 2:
+                chunks.append('\n')
+        return chunks
+
+    def write(self):
+        symbols = self.symbols()
+        chunks = self.bsd_layout(symbols) if self.format == 'bsd' else self.gnu_layout(symbols)
+        # Write next to the destination and rename, so readers never see half an archive
+        temp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.rename(temp_path, self.path)
+        return self.indexed
+
+def archive_label(path):
+    label = os.path.splitext(os.path.basename(path))[0]
+    return label[len('libboost_'):] if label.startswith('libboost_') else label
+
+def merge_archives(output_path, input_paths, arch=None, format='bsd', base_path=None, base_labels=None):
+    # Merges the members of several archives (or one slice of each fat archive)
+    # into one archive, after the members of base_path listed in base_labels
+    # ({label: [names]}). Returns whether its symbol table is complete, and the
+    # names of the members of each library.
+    writer = ArchiveWriter(output_path, format)
+    archives = []
+    try:
+        if base_path:
+            archive = Archive(base_path, arch)
+            archives.append(archive)
+            labels = dict([(name, label) for label, names in base_labels.items() for name in names])
+            for member in archive.members:
+                if member.name in labels:
+                    writer.add(member, labels[member.name])
+        for path in input_paths:
+            archive = Archive(path, arch)
+            archives.append(archive)
+            for member in archive.members:
+                writer.add(member, archive_label(path))
+        return writer.write(), writer.labels
+    finally:
+        for archive in archives:
+            archive.close()
+
+def split_archive(path, labels, output_paths, format='bsd'):
+    # Writes the members of each library ({label: [names]}) of a thin archive
+    # into an archive of its own. Returns the archives whose symbol table is
+    # incomplete.
+    unindexed = []
+    with Archive(path) as archive:
+        members = dict([(member.name, member) for member in archive.members])
+        for label, names in sorted(labels.items()):
+            writer = ArchiveWriter(output_paths[label], format)
+            for name in names:
+                writer.add(members[name], label)
+            if not writer.write():
+                unindexed.append(output_paths[label])
+    return unindexed
+
+def archive_dependencies(paths, arch=None):
+    # The libraries ({label: path} of thin archives, or of fat ones read for
+    # arch) each library needs symbols from. Members whose symbols can't be read
+    # are left out.
+    defined = {}
+    undefined = {}
+    for label, path in paths.items():
+        defined[label] = set()
+        undefined[label] = set()
+        with Archive(path, arch) as archive:
+            for member in archive.members:
+                defined[label].update(object_symbols(member.data) or [])
+                undefined[label].update(object_symbols(member.data, undefined=True) or [])
+    dependencies = {}
+    for label in paths:
+        needed = undefined[label] - defined[label]
+        dependencies[label] = sorted([other for other in paths if other != label and needed & defined[other]])
+    return dependencies
+
+def fat_architectures(path):
+    # The architectures of a fat file, or None for a thin one
+    with open(path, 'rb') as f:
+        header = f.read(4096)
+    slices = fat_slices(header)
+    if slices is None:
+        return None
+    return sorted([arch for arch, key in MACHO_ARCHITECTURES.items() if key in slices])
+
+def extract_slice(path, arch, output_path):
+    with Archive(path, arch) as archive:
+        with open(output_path, 'wb') as f:
+            f.write(archive.map[archive.start:archive.end])
+
+#-------------------------------------------------------------------------------
+#
+# Size reports
+#
+#-------------------------------------------------------------------------------
+
+# The size of every object and symbol of the packaged archives, saved per build
+# profile so each build can be compared with the previous build of its profile
+# and with the last build of the others.
+
+SIZE_REPORT_CHANGES = 10
+
+def archive_sizes(path):
+    objects = {}
+    symbols = {}
+    with Archive(path) as archive:
+        for member in archive.members:
+            objects[member.name] = objects.get(member.name, 0) + len(member.data)
+            # LLVM bitcode members have no symbol sizes
+            for name, size in (object_symbol_sizes(member.data) or {}).items():
+                symbols[name] = symbols.get(name, 0) + size
+    return {
+        'size': os.path.getsize(path),
+        'objects': objects,
+        'symbols': symbols,
+    }
+
+def size_changes(previous, current):
+    # The largest changes of a {name: size} map, largest first
+    changes = []
+    for name in set(previous) | set(current):
+        change = current.get(name, 0) - previous.get(name, 0)
+        if change:
+            changes.append((-abs(change), name, change))
+    return [(name, change) for key, name, change in sorted(changes)[:SIZE_REPORT_CHANGES]]
+
+class SizeReport:
+
+    def __init__(self, report_dir, profile):
+        self.report_dir = report_dir
+        self.profile = profile
+
+    def report_path(self, profile):
+        return os.path.join(self.report_dir, 'size-{}.json'.format(profile))
+
+    def read(self, profile):
+        path = self.report_path(profile)
+        if not os.path.isfile(path):
+            return {}
+        with open(path) as f:
+            return json.load(f)
+
+    def run(self, libs):
+        # libs is {name: path} of the thin archive of each platform and arch
+        previous = self.read(self.profile)
+        report = dict(previous)
+        for name, path in sorted(libs.items()):
+            report[name] = archive_sizes(path)
+        if not os.path.isdir(self.report_dir):
+            os.makedirs(self.report_dir)
+        with open(self.report_path(self.profile), 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        others = dict([(profile, self.read(profile)) for profile in BUILD_PROFILES if profile != self.profile])
+        for name in sorted(libs):
+            self.print_lib(name, previous.get(name), report[name], others)
+
+    def print_lib(self, name, previous, current, others):
+        line = '{} ({} profile): {} bytes'.format(name, self.profile, current['size'])
+        if previous:
+            line += ', {:+} since the previous build'.format(current['size'] - previous['size'])
+        for profile, report in sorted(others.items()):
+            if name in report:
+                line += ', {:+} from {}'.format(current['size'] - report[name]['size'], profile)
+        print line
+        if not previous:
+            return
+        for kind in ['objects', 'symbols']:
+            for changed, change in size_changes(previous[kind], current[kind]):
+                print '  {:+10} {} {}'.format(change, kind[:-1], changed)
+
+#-------------------------------------------------------------------------------
+#
+# Tree sync
+#
+#-------------------------------------------------------------------------------
+
+# Brings a destination tree in line with a source tree while touching as little as
+# possible: files whose content is unchanged keep their inode and mtime, so
+# projects that include them don't rebuild. Changed files are written with a fresh
+# mtime, and files missing from the source are deleted.
+#
+# Files are placed by copying, or by hard-linking or cloning (reflink) them from a
+# content-addressed store that can be shared between Boost versions. Store objects
+# are read-only, since every tree linked to them shares their inode.
+
+SYNC_MODES = ('copy', 'hardlink', 'reflink')
+
+def file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def same_contents(src_path, dst_path):
+    src_stat = os.stat(src_path)
+    dst_stat = os.stat(dst_path)
+    if src_stat.st_size != dst_stat.st_size:
+        return False
+    if (src_stat.st_dev, src_stat.st_ino) == (dst_stat.st_dev, dst_stat.st_ino):
+        return True
+    # Copies get mtimes of their own, so equal mtimes don't mean equal contents
+    return file_digest(src_path) == file_digest(dst_path)
+
+def list_files(root):
+    files = set()
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            files.add(os.path.relpath(os.path.join(dirpath, filename), root))
+    return files
+
+def reflink(src_path, dst_path, recursive=False):
+    # APFS clones with `cp -c`, btrfs/XFS with `cp --reflink`
+    flag = '-c' if sys.platform == 'darwin' else '--reflink=always'
+    options = ['-R', flag] if recursive else [flag]
+    with open(os.devnull, 'w') as devnull:
+        return subprocess.call(['cp'] + options + [src_path, dst_path], stderr=devnull) == 0
+
+class ContentStore:
+
+    def __init__(self, root):
+        self.root = root
+
+    def add(self, path):
+        digest = file_digest(path)
+        object_path = os.path.join(self.root, digest[:2], digest)
+        if not os.path.isfile(object_path):
+            if not os.path.isdir(os.path.dirname(object_path)):
+                os.makedirs(os.path.dirname(object_path))
+            temp_path = '{}.{}.tmp'.format(object_path, os.getpid())
+            shutil.copyfile(path, temp_path)
+            os.chmod(temp_path, 0444)
+            os.rename(temp_path, object_path)
+        return object_path
+
+def place_file(src_path, dst_path, mode, store):
+    # Write next to the destination and rename over it
+    temp_path = '{}.{}.tmp'.format(dst_path, os.getpid())
+    source = store.add(src_path) if store else src_path
+    placed = False
+    if mode == 'hardlink':
+        # A store object's inode is shared by every tree linked to it, so its mtime
+        # is never touched. One older than the file it replaces would look
+        # unchanged to consumers; that file gets a reflink or a copy instead.
+        if not os.path.isfile(dst_path) or os.path.getmtime(source) >= os.path.getmtime(dst_path):
+            try:
+                os.link(source, temp_path)
+                placed = True
+            except OSError:
+                pass
+        if not placed and reflink(source, temp_path):
+            # A clone is an inode of its own
+            os.utime(temp_path, None)
+            placed = True
+    elif mode == 'reflink':
+        placed = reflink(source, temp_path)
+    if not placed:
+        shutil.copyfile(src_path, temp_path)
+    os.rename(temp_path, dst_path)
+
+def sync_tree(src_root, dst_root, mode='copy', store_root=None, prune=True):
+    # Returns the number of updated, removed and unchanged files. Files missing
+    # from src_root are removed from dst_root unless prune is off.
+    store = ContentStore(store_root) if store_root and mode != 'copy' else None
+    src_files = list_files(src_root)
+    dst_files = list_files(dst_root) if os.path.isdir(dst_root) else set()
+    updated = 0
+    unchanged = 0
+    for relative_path in sorted(src_files):
+        src_path = os.path.join(src_root, relative_path)
+        dst_path = os.path.join(dst_root, relative_path)
+        if relative_path in dst_files and same_contents(src_path, dst_path):
+            unchanged += 1
+            continue
+        if not os.path.isdir(os.path.dirname(dst_path)):
+            os.makedirs(os.path.dirname(dst_path))
+        place_file(src_path, dst_path, mode, store)
+        updated += 1
+    removed = dst_files - src_files if prune else set()
+    for relative_path in removed:
+        os.remove(os.path.join(dst_root, relative_path))
+    # Prune directories left empty, deepest first
+    for dirpath, dirnames, filenames in os.walk(dst_root, topdown=False):
+        if dirpath != dst_root and not os.listdir(dirpath):
+            os.rmdir(dirpath)
+    return updated, len(removed), unchanged
+
+def freeze_tree(root):
+    # Makes every file read-only, so a tree hard-linked to it can't write through
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if not os.path.islink(path):
+                os.chmod(path, os.stat(path).st_mode & 0555)
+
+def link_tree(src_root, dst_root):
+    for dirpath, dirnames, filenames in os.walk(src_root):
+        dst_dir = os.path.join(dst_root, os.path.relpath(dirpath, src_root))
+        if not os.path.isdir(dst_dir):
+            os.makedirs(dst_dir)
+        # os.walk lists symlinks to directories without descending into them
+        for name in dirnames + filenames:
+            src_path = os.path.join(dirpath, name)
+            dst_path = os.path.join(dst_dir, name)
+            if os.path.islink(src_path):
+                os.symlink(os.readlink(src_path), dst_path)
+            elif name in filenames:
+                try:
+                    os.link(src_path, dst_path)
+                except OSError:
+                    shutil.copy2(src_path, dst_path)
+
+def clone_tree(src_root, dst_root):
+    # Clones the tree where the file system supports it and falls back to a
+    # hard-link farm. Returns the mode used.
+    temp_root = '{}.{}.tmp'.format(dst_root, os.getpid())
+    if reflink(src_root, temp_root, recursive=True):
+        mode = 'reflink'
+    else:
+        shutil.rmtree(temp_root, ignore_errors=True)
+        link_tree(src_root, temp_root)
+        mode = 'hardlink'
+    os.rename(temp_root, dst_root)
+    return mode
+
+#-------------------------------------------------------------------------------
+#
+# Fetching
+#
+#-------------------------------------------------------------------------------
+
+# Tarballs are downloaded, verified and extracted in a single pass. Bytes are
+# written to a .part file and hashed as they arrive, and tarfile reads the
+# decompressed stream, so extraction is done when the download is. An interrupted
+# download resumes with a Range request once the .part file has been replayed
+# through the decompressor. bz2 is decompressed on every core by lbzip2 (or
+# pbzip2) when one is installed, and in-process otherwise.
+
+FETCH_CHUNK_SIZE = 256*1024
+FETCH_TIMEOUT = 60
+FETCH_RETRIES = 3
+PARALLEL_BZIP2 = ['lbzip2', 'pbzip2']
+
+class FetchError(BuildError):
+    pass
+
+def find_executable(name):
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+class TarballStream:
+
+    def __init__(self, url, path):
+        self.url = url
+        self.path = path
+        self.part_path = '{}.part'.format(path)
+        self.digest = hashlib.sha256()
+        self.offset = 0
+        self.size = None
+        self.replay = None
+        self.replay_left = 0
+        self.response = None
+        self.part = None
+        self.retries = FETCH_RETRIES
+
+    def open(self):
+        if os.path.isfile(self.path):
+            print 'Found tarball: {}'.format(self.path)
+            self.start_replay(self.path)
+            return
+        resume_from = os.path.getsize(self.part_path) if os.path.isfile(self.part_path) else 0
+        self.response = self.connect(resume_from)
+        if self.response.getcode() == 206:
+            print 'Resuming download of {} at {} bytes'.format(self.url, resume_from)
+            self.start_replay(self.part_path)
+            self.part = open(self.part_path, 'ab')
+        else:
+            print 'Downloading {}'.format(self.url)
+            self.size = self.content_length(self.response)
+            self.part = open(self.part_path, 'wb')
+
+    def start_replay(self, path):
+        self.replay = open(path, 'rb')
+        self.replay_left = os.path.getsize(path)
+
+    def connect(self, offset):
+        request = urllib2.Request(self.url)
+        if offset:
+            request.add_header('Range', 'bytes={}-'.format(offset))
+        try:
+            response = urllib2.urlopen(request, timeout=FETCH_TIMEOUT)
+        except urllib2.HTTPError as e:
+            if offset and e.code == 416:
+                # The .part file is no prefix of what's served, start over
+                return self.connect(0)
+            raise FetchError('Unable to download {}: {}'.format(self.url, e))
+        except (urllib2.URLError, httplib.HTTPException, socket.error) as e:
+            raise FetchError('Unable to download {}: {}'.format(self.url, e))
+        if offset and response.getcode() == 206:
+            content_range = response.info().getheader('Content-Range', '')
+            match = re.match(r'bytes (\d+)-\d+/(\d+|\*)', content_range)
+            if not match or int(match.group(1)) != offset:
+                raise FetchError('Unexpected Content-Range from {}: {}'.format(self.url, content_range))
+            if match.group(2) != '*':
+                self.size = int(match.group(2))
+        return response
+
+    def content_length(self, response):
+        length = response.info().getheader('Content-Length')
+        return int(length) if length else None
+
+    def read(self, size=FETCH_CHUNK_SIZE):
+        if self.replay_left:
+            data = self.replay.read(min(size, self.replay_left))
+            if not data:
+                raise FetchError('{} was truncated while reading it'.format(self.replay.name))
+            self.replay_left -= len(data)
+        elif self.response:
+            data = self.receive(size)
+            self.part.write(data)
+        else:
+            data = ''
+        self.digest.update(data)
+        self.offset += len(data)
+        return data
+
+    def receive(self, size):
+        while True:
+            try:
+                data = self.response.read(size)
+                if data or self.size is None or self.offset >= self.size:
+                    return data
+                error = 'connection closed'
+            except (httplib.HTTPException, socket.error) as e:
+                error = e
+            if not self.retries:
+                raise FetchError('Download of {} failed at {} bytes: {}'.format(self.url, self.offset, error))
+            self.retries -= 1
+            print 'Download interrupted at {} bytes ({}), resuming'.format(self.offset, error)
+            self.part.flush()
+            self.response = self.connect(self.offset)
+            if self.response.getcode() != 206:
+                raise FetchError('Unable to resume download of {}: the server ignores Range requests'.format(self.url))
+
+    def finish(self, sha256=None):
+        # The tar stream ends before the compressed file does, read the rest too
+        while self.read():
+            pass
+        self.close()
+        digest = self.digest.hexdigest()
+        if sha256 and digest != sha256:
+            self.discard()
+            raise FetchError('Checksum mismatch for {}: expected {}, got {}'.format(self.url, sha256, digest))
+        if os.path.isfile(self.part_path):
+            os.rename(self.part_path, self.path)
+        return digest
+
+    def close(self):
+        for f in [self.replay, self.part, self.response]:
+            if f:
+                f.close()
+        self.replay = self.part = self.response = None
+        self.replay_left = 0
+
+    def discard(self):
+        # Corrupt data, so a resumed download would fail the same way
+        self.close()
+        for path in [self.part_path, self.path]:
+            if os.path.isfile(path):
+                os.remove(path)
+
+class ParallelDecompressor:
+
+    def __init__(self, stream, tool):
+        self.stream = stream
+        self.tool = os.path.basename(tool)
+        self.process = subprocess.Popen([tool, '-dc'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.error = None
+        self.feeder = threading.Thread(target=self.feed, name='feed-{}'.format(self.tool))
+        self.feeder.daemon = True
+        self.feeder.start()
+
+    def feed(self):
+        try:
+            while True:
+                data = self.stream.read()
+                if not data:
+                    break
+                self.process.stdin.write(data)
+        except IOError as e:
+            # The decompressor exited early, its status tells why
+            if e.errno != errno.EPIPE:
+                self.error = e
+        except BaseException as e:
+            self.error = e
+        finally:
+            try:
+                self.process.stdin.close()
+            except IOError:
+                pass
+
+    def finish(self):
+        while self.process.stdout.read(FETCH_CHUNK_SIZE):
+            pass
+        self.feeder.join()
+        status = self.process.wait()
+        if self.error:
+            raise self.error
+        if status != 0:
+            raise tarfile.ReadError('{} failed with status {}'.format(self.tool, status))
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        # The feeder may be blocked on the network, it's a daemon thread
+        self.feeder.join(1)
+
+def strip_member_path(member, components):
+    # Drops the leading components of the member's path (and of its link target,
+    # for hard links), leaving None for members above them. Refuses paths that
+    # would land outside the extraction dir.
+    parts = member.name.split('/')[components:]
+    if not parts or parts == ['']:
+        return None
+    name = '/'.join(parts)
+    if os.path.isabs(name) or '..' in parts:
+        raise FetchError('Refusing to extract {}'.format(member.name))
+    member.name = name
+    if member.islnk():
+        member.linkname = '/'.join(member.linkname.split('/')[components:])
+    return member
+
+# Downloads url to tarball_path, or uses the tarball already there, and extracts
+# it into dst_dir. The first path component of the members is stripped, and
+# members for which wanted(member) is false are skipped.
+def fetch_tarball(url, tarball_path, dst_dir, sha256=None, wanted=None):
+    temp_dir = '{}.partial'.format(dst_dir)
+    if os.path.isdir(temp_dir):
+        shutil.rmtree(temp_dir)
+    os.makedirs(temp_dir)
+    stream = TarballStream(url, tarball_path)
+    decompressor = None
+    try:
+        stream.open()
+        bzip2 = next((path for path in map(find_executable, PARALLEL_BZIP2) if path), None)
+        if bzip2:
+            decompressor = ParallelDecompressor(stream, bzip2)
+            tar = tarfile.open(fileobj=decompressor.process.stdout, mode='r|')
+        else:
+            tar = tarfile.open(fileobj=stream, mode='r|bz2')
+        extracted = skipped = 0
+        for member in tar:
+            member = strip_member_path(member, 1)
+            if member and (not wanted or wanted(member)):
+                tar.extract(member, temp_dir)
+                extracted += 1
+            else:
+                skipped += 1
+        tar.close()
+        if decompressor:
+            decompressor.finish()
+        digest = stream.finish(sha256)
+    except BaseException as e:
+        if decompressor:
+            decompressor.stop()
+            # A failed download also truncates what the decompressor sees
+            e = decompressor.error or e
+        # Data that doesn't decompress would fail the same way when resumed
+        corrupt = isinstance(e, (tarfile.TarError, EOFError, IOError)) and not getattr(e, 'errno', None)
+        if corrupt:
+            stream.discard()
+        else:
+            stream.close()
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        if corrupt:
+            raise FetchError('Unable to extract {}: {}'.format(url, e))
+        raise e
+    if os.path.isdir(dst_dir):
+        shutil.rmtree(dst_dir)
+    os.rename(temp_dir, dst_dir)
+    print 'Extracted {} of {} members (sha256 {})'.format(extracted, extracted + skipped, digest)
+
+#-------------------------------------------------------------------------------
+#
+# Include graph
+#
+#-------------------------------------------------------------------------------
+
+# A native stand-in for bcp. Every file under boost/ and every source file under
+# libs/ is scanned once, in parallel, for the headers its preprocessor directives
+# name; the resulting graph is cached per Boost version and set of files. The
+# headers needed by a set of modules are then the transitive closure of the graph
+# from those modules, following bcp's rules: a module stands for its header, its
+# header directory and everything under libs/<module>, tests and examples
+# included, and the headers of a library bring in its sources, build files and
+# config checks.
+#
+# Besides #include directives this picks up header paths named in #define lines
+# (BOOST_USER_CONFIG, BOOST_PP_FILENAME_1, ...), the headers behind the few
+# macros Boost includes by name, and every header matching a path prefix passed
+# to an include macro (BOOST_ATOMIC_DETAIL_HEADER(boost/atomic/detail/ops_)).
+
+INCLUDE_INDEX_FORMAT = 2
+
+# The files under libs/ that bcp scans, and the dirs of a library it copies
+# along with any of the library's headers
+LIB_SOURCE_FILE = re.compile(r'.*\.(?:c|cxx|h|hxx|inc|inl|.?pp|yy?)$', re.IGNORECASE)
+LIB_SOURCE_DIRS = ['src', 'build', 'config']
+LIBRARY_HEADER = re.compile(r'boost/(\w+)(?:/|\.hpp$)')
+
+INCLUDE_DIRECTIVE = re.compile(r'#\s*include\s*(?:[<"]([^>"]+)[>"]|([A-Z_][A-Z0-9_]*)(?:\s*\(\s*(boost/[\w/.]+))?)')
+BOOST_PATH = re.compile(r'[<"](boost/[^>"\s]+)[>"]')
+
+# Headers included through a macro; a trailing slash includes a whole directory
+MACRO_INCLUDES = {
+    'BOOST_ABI_PREFIX': ['boost/config/abi_prefix.hpp'],
+    'BOOST_ABI_SUFFIX': ['boost/config/abi_suffix.hpp'],
+    'BOOST_PP_ITERATE': ['boost/preprocessor/iteration/detail/'],
+    'BOOST_PP_LOCAL_ITERATE': ['boost/preprocessor/iteration/detail/local.hpp'],
+    'BOOST_PP_INCLUDE_SELF': ['boost/preprocessor/iteration/detail/self.hpp'],
+    'BOOST_PP_INDIRECT_SELF': ['boost/preprocessor/iteration/detail/self.hpp'],
+    'BOOST_PP_UPDATE_COUNTER': ['boost/preprocessor/slot/detail/counter.hpp'],
+    'BOOST_PP_ASSIGN_SLOT': ['boost/preprocessor/slot/detail/'],
+    'BOOST_TYPEOF_INCREMENT_REGISTRATION_GROUP': ['boost/typeof/incr_registration_group.hpp'],
+}
+
+# Headers that other headers pick with computed names, as bcp special-cases them
+COMPANION_FILES = {
+    'boost/config.hpp': ['boost/config/'],
+    'boost/function.hpp': ['boost/function/detail/'],
+    'boost/regex/config.hpp': ['boost/regex/user.hpp'],
+    'boost/mpl/list.hpp': ['boost/mpl/list/'],
+    'boost/mpl/list_c.hpp': ['boost/mpl/list/'],
+    'boost/mpl/vector.hpp': ['boost/mpl/vector/'],
+    'boost/mpl/deque.hpp': ['boost/mpl/vector/'],
+    'boost/mpl/vector_c.hpp': ['boost/mpl/vector/'],
+    'boost/mpl/map.hpp': ['boost/mpl/map/'],
+    'boost/mpl/set.hpp': ['boost/mpl/set/'],
+    'boost/mpl/set_c.hpp': ['boost/mpl/set/'],
+    'boost/mpl/aux_/include_preprocessed.hpp': ['boost/mpl/aux_/preprocessed/'],
+    'boost/mpl/vector/aux_/include_preprocessed.hpp': ['boost/mpl/vector/aux_/preprocessed/'],
+    'boost/mpl/set/aux_/include_preprocessed.hpp': ['boost/mpl/set/aux_/preprocessed/'],
+    'boost/mpl/map/aux_/include_preprocessed.hpp': ['boost/mpl/map/aux_/preprocessed/'],
+    'boost/mpl/list/aux_/include_preprocessed.hpp': ['boost/mpl/list/aux_/preprocessed/'],
+    'boost/typeof/typeof.hpp': ['boost/typeof/incr_registration_group.hpp'],
+    'boost/function_types/detail/pp_loop.hpp': ['boost/function_types/detail/pp_cc_loop/', 'boost/function_types/detail/pp_loop/'],
+    'boost/function_types/components.hpp': ['boost/function_types/detail/components_impl/'],
+    'boost/function_types/detail/pp_tags/preprocessed.hpp': ['boost/function_types/detail/pp_tags/'],
+    'boost/function_types/detail/pp_variate_loop/preprocessed.hpp': ['boost/function_types/detail/pp_variate_loop/'],
+    'boost/function_types/detail/pp_retag_default_cc/preprocessed.hpp': ['boost/function_types/detail/pp_retag_default_cc/'],
+    'boost/function_types/detail/synthesize_impl/master.hpp': ['boost/function_types/detail/synthesize_impl/'],
+    'boost/function_types/detail/classifier_impl/master.hpp': ['boost/function_types/detail/classifier_impl/'],
+    'boost/fusion/container/vector/vector10.hpp': ['boost/fusion/container/vector/detail/'],
+    'boost/fusion/container/list/list.hpp': ['boost/fusion/container/list/detail/'],
+    'boost/fusion/container/map/map.hpp': ['boost/fusion/container/map/detail/'],
+    'boost/fusion/container/set/set.hpp': ['boost/fusion/container/set/detail/'],
+    'boost/fusion/container/deque/deque.hpp': ['boost/fusion/container/deque/detail/'],
+}
+
+def scan_includes(path):
+    # Returns the header names and include macros of one file's directives
+    names = set()
+    with open(path, 'rb') as f:
+        lines = iter(f.read().splitlines())
+    for line in lines:
+        if not line.lstrip().startswith('#'):
+            continue
+        # Join continuation lines, which multi-line macro definitions use
+        while line.endswith('\\'):
+            line = line[:-1] + next(lines, '')
+        match = INCLUDE_DIRECTIVE.match(line.lstrip())
+        if match:
+            names.add(match.group(1) or match.group(2))
+            if match.group(3):
+                names.add(match.group(3) + '*')
+        names.update(BOOST_PATH.findall(line))
+    return sorted(names)
+
+def scan_includes_chunk(args):
+    root, relative_paths = args
+    return [(relative_path, scan_includes(os.path.join(root, relative_path))) for relative_path in relative_paths]
+
+class IncludeIndex:
+
+    def __init__(self, root, version, cache_dir):
+        self.root = root
+        self.version = version
+        self.cache_dir = cache_dir
+        self.edges = None
+        self.library_files = None
+
+    def index_path(self, files):
+        # A minimal source tree has fewer files to index than a full one
+        digest = hashlib.sha1('\n'.join(files)).hexdigest()[:12]
+        return os.path.join(self.cache_dir, 'include-index', 'boost-{}-{}-{}.json'.format(self.version, INCLUDE_INDEX_FORMAT, digest))
+
+    def source_files(self):
+        files = ['boost/' + path for path in list_files(os.path.join(self.root, 'boost'))]
+        libs_dir = os.path.join(self.root, 'libs')
+        if os.path.isdir(libs_dir):
+            files.extend(['libs/' + path for path in list_files(libs_dir) if LIB_SOURCE_FILE.match(path)])
+        return sorted(files)
+
+    def expand(self, targets, files):
+        expanded = []
+        for target in targets:
+            if target.endswith('/'):
+                expanded.extend([path for path in files if path.startswith(target)])
+            elif target in files:
+                expanded.append(target)
+        return expanded
+
+    def resolve(self, including_path, name, files):
+        # Quoted includes are looked up next to the including file first
+        relative = os.path.normpath(os.path.join(os.path.dirname(including_path), name))
+        if relative in files:
+            return [relative]
+        if name in files:
+            return [name]
+        if name.endswith('*'):
+            return [path for path in files if path.startswith(name[:-1])]
+        return self.expand(MACRO_INCLUDES.get(name, []), files)
+
+    def scan(self, files, jobs):
+        file_set = set(files)
+        print 'Scanning {} files for includes with {} jobs'.format(len(files), jobs)
+        chunks = [(self.root, files[i:i + 256]) for i in range(0, len(files), 256)]
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results = pool.map(scan_includes_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+        edges = {}
+        for chunk in results:
+            for path, names in chunk:
+                targets = set()
+                for name in names:
+                    targets.update(self.resolve(path, name, file_set))
+                targets.update(self.expand(COMPANION_FILES.get(path, []), file_set))
+                targets.discard(path)
+                edges[path] = sorted(targets)
+        return edges
+
+    def load(self, jobs=1):
+        if self.edges is not None:
+            return
+        files = self.source_files()
+        path = self.index_path(files)
+        if os.path.isfile(path):
+            with open(path) as f:
+                self.edges = json.load(f)['edges']
+            return
+        self.edges = self.scan(files, jobs)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'w') as f:
+            json.dump({'version': self.version, 'edges': self.edges}, f)
+        os.rename(temp_path, path)
+
+    def module_files(self, module):
+        # A header path stands for itself. A module name stands for its header,
+        # its header directory and everything under libs/<module>.
+        if module in self.edges:
+            return [module]
+        prefixes = ('boost/{}/'.format(module), 'libs/{}/'.format(module))
+        files = [path for path in self.edges if path.startswith(prefixes)]
+        header = 'boost/{}.hpp'.format(module)
+        if header in self.edges:
+            files.append(header)
+        return files
+
+    def library_dependencies(self, path):
+        # The sources, build files and config checks of the library a header
+        # belongs to
+        if self.library_files is None:
+            self.library_files = {}
+            for other in self.edges:
+                parts = other.split('/')
+                if parts[0] == 'libs' and len(parts) > 3 and parts[2] in LIB_SOURCE_DIRS:
+                    self.library_files.setdefault(parts[1], []).append(other)
+        match = LIBRARY_HEADER.match(path)
+        return self.library_files.get(match.group(1), []) if match else []
+
+    def closure(self, modules):
+        pending = []
+        for module in modules:
+            files = self.module_files(module)
+            if not files:
+                raise BuildError('Unknown Boost module or header: {}'.format(module))
+            pending.extend(files)
+        seen = set()
+        while pending:
+            path = pending.pop()
+            if path in seen:
+                continue
+            seen.add(path)
+            pending.extend(self.edges.get(path, []))
+            pending.extend(self.library_dependencies(path))
+        return sorted(seen)
+
+#-------------------------------------------------------------------------------
+#
+# Toolchain
+#
+#-------------------------------------------------------------------------------
+
+# A toolchain backend knows the platforms it builds and their architectures, and
+# gives b2 its user-config.jam, toolset args and compiler flags. The Xcode backend
+# builds for iOS, the simulator and OS X; the Linux backend builds for the host
+# with clang or gcc, and for cross targets through a sysroot.
+#
+# Each backend is probed once, with all of its queries running at the same time.
+# The results (compiler identity, tool paths and, for Xcode, SDK versions) are
+# kept in the cache dir, keyed by the toolchain's install path and its mtime, so
+# later runs read them back without starting a process. Commands run the tools
+# by absolute path, not through xcrun.
+
+TOOLCHAIN_CACHE_FORMAT = 3
+TOOLCHAINS = ['xcode', 'linux']
+DEFAULT_TOOLCHAIN = 'xcode' if sys.platform == 'darwin' else 'linux'
+
+# SDK of each Xcode platform
+XCODE_SDKS = {
+    'ios': 'iphoneos',
+    'simulator': 'iphonesimulator',
+    'osx': 'macosx',
+}
+XCODE_SDK_DIRS = {
+    'ios': 'iPhoneOS',
+    'simulator': 'iPhoneSimulator',
+    'osx': 'MacOSX',
+}
+XCODE_TOOLS = [COMPILER, 'ar', 'lipo', 'ranlib']
+# Only some builds need these, and they fail only when they're missing
+XCODE_OPTIONAL_TOOLS = ['llvm-profdata']
+
+# Compiler driver of each Linux compiler, and the b2 architecture and address
+# model of each Linux architecture
+LINUX_COMPILERS = {
+    'clang': 'clang++',
+    'gcc': 'g++',
+}
+LINUX_ARCHITECTURES = {
+    'x86_64': ('x86', '64'),
+    'i386': ('x86', '32'),
+    'i686': ('x86', '32'),
+    'aarch64': ('arm', '64'),
+    'arm': ('arm', '32'),
+    'armv7l': ('arm', '32'),
+    'ppc64le': ('power', '64'),
+}
+
+class Toolchain:
+
+    name = None
+    # Format of the archives the platform's linker reads
+    archive_format = 'bsd'
+
+    def __init__(self, cache_dir):
+        self.cache_path = os.path.join(cache_dir, 'toolchain-{}.json'.format(self.name))
+        self._info = None
+        self.selected_platforms = None
+        self.selected_archs = None
+
+    # Probed (or read from the cache) once a stage needs it, so the dry run and
+    # no-op builds don't wait for it.
+    def info(self):
+        if self._info is None:
+            self._info = self.load()
+        return self._info
+
+    def load(self):
+        key = self.cache_key()
+        if key and os.path.isfile(self.cache_path):
+            with open(self.cache_path) as f:
+                cached = json.load(f)
+            tool_paths = [path for tools in cached['info']['tools'].values() for path in tools.values()]
+            if cached['key'] == key and all([os.path.isfile(path) for path in tool_paths]):
+                return cached['info']
+        info = self.probe()
+        if key:
+            if not os.path.isdir(os.path.dirname(self.cache_path)):
+                os.makedirs(os.path.dirname(self.cache_path))
+            temp_path = '{}.{}.tmp'.format(self.cache_path, os.getpid())
+            with open(temp_path, 'w') as f:
+                json.dump({'key': key, 'info': info}, f, indent=2, sort_keys=True)
+            os.rename(temp_path, self.cache_path)
+        return info
+
+    def tool_path(self, tool, platform):
+        return self.info()['tools'][platform].get(tool)
+
+    def select(self, platforms=None, archs=None):
+        # Restricts the build to some platforms and architectures
+        for platform in platforms or []:
+            if platform not in self.all_platforms():
+                raise BuildError('The {} toolchain has no platform {}'.format(self.name, platform))
+        all_archs = set([arch for platform in self.all_platforms() for arch in self.all_architectures(platform)])
+        for arch in archs or []:
+            if arch not in all_archs:
+                raise BuildError('The {} toolchain has no architecture {}'.format(self.name, arch))
+        self.selected_platforms = platforms
+        self.selected_archs = archs
+
+    def partial(self):
+        return bool(self.selected_platforms or self.selected_archs)
+
+    def platforms(self):
+        return [platform for platform in self.all_platforms()
+                if (not self.selected_platforms or platform in self.selected_platforms) and self.architectures(platform)]
+
+    def architectures(self, platform):
+        return [arch for arch in self.all_architectures(platform) if not self.selected_archs or arch in self.selected_archs]
+
+    def lib_dir_name(self, platform):
+        return platform
+
+    def tasks(self):
+        return dict([(platform, ['stage']) for platform in self.platforms()])
+
+    def host_platform(self):
+        # The platform whose programs run on this machine
+        return None
+
+    def pch_extension(self):
+        return 'pch'
+
+    def missing_headers(self):
+        return []
+
+    def profile_flags(self, platform, profile):
+        if profile == 'lto':
+            return ['-flto=thin']
+        if profile == 'size':
+            return ['-ffunction-sections', '-fdata-sections']
+        if profile == 'pgo-generate':
+            return ['-fprofile-instr-generate']
+        if profile == 'pgo':
+            # Other platforms use the host's profile, whose counters don't cover
+            # their platform-specific code
+            return ['-Wno-profile-instr-unprofiled', '-Wno-profile-instr-out-of-date']
+        return []
+
+    def check_platform(self, platform):
+        if platform not in self.platforms():
+            raise BuildError('Unexpected platform: {}'.format(platform))
+
+class XcodeToolchain(Toolchain):
+
+    name = 'xcode'
+    archive_format = 'bsd'
+
+    def developer_dir(self):
+        # What `xcode-select -print-path` reports, without running it when the
+        # environment or the selection symlink tells
+        if os.environ.get('DEVELOPER_DIR'):
+            return os.path.realpath(os.environ['DEVELOPER_DIR'])
+        if os.path.islink('/var/db/xcode_select_link'):
+            return os.path.realpath('/var/db/xcode_select_link')
+        try:
+            path = shell_output('xcode-select -print-path')
+        except BuildError:
+            return None
+        return os.path.realpath(path) if path else None
+
+    def cache_key(self):
+        path = self.developer_dir()
+        if not path or not os.path.isdir(path):
+            return None
+        return [TOOLCHAIN_CACHE_FORMAT, path, os.path.getmtime(path)]
+
+    def probe(self):
+        print 'Probing the Xcode toolchain'
+        sdks = sorted(set(XCODE_SDKS.values()))
+        commands = ['xcode-select -print-path', 'xcrun --sdk macosx {} --version'.format(COMPILER)]
+        commands.extend(['xcrun --sdk {} --show-sdk-version'.format(sdk) for sdk in sdks])
+        finds = [(sdk, tool) for sdk in sdks for tool in XCODE_TOOLS + XCODE_OPTIONAL_TOOLS]
+        commands.extend(['xcrun --sdk {} --find {}'.format(sdk, tool) for sdk, tool in finds])
+        optional = [False] * (len(commands) - len(finds)) + [tool in XCODE_OPTIONAL_TOOLS for sdk, tool in finds]
+        commands = [Command(cmd, CommandLog(cmd, keep_output=True)) for cmd in commands]
+        CommandRunner(len(commands)).run(commands, fail_fast=False)
+        outputs = []
+        for command, is_optional in zip(commands, optional):
+            if command.status != 0 and not is_optional:
+                raise command.error()
+            outputs.append(command.log.get_output().rstrip() if command.status == 0 else None)
+        developer_dir, compiler_identity = outputs[:2]
+        sdk_versions = dict(zip(sdks, outputs[2:2 + len(sdks)]))
+        # Missing optional tools are left out
+        sdk_tools = dict([(sdk, {}) for sdk in sdks])
+        for (sdk, tool), path in zip(finds, outputs[2 + len(sdks):]):
+            if path:
+                sdk_tools[sdk][tool] = path
+        return {
+            'developer_dir': developer_dir,
+            'compiler_identity': compiler_identity,
+            'sdk_versions': sdk_versions,
+            'tools': dict([(platform, sdk_tools[sdk]) for platform, sdk in XCODE_SDKS.items()]),
+        }
+
+    def sdk_version(self, platform):
+        return self.info()['sdk_versions'][XCODE_SDKS[platform]]
+
+    def all_platforms(self):
+        return PLATFORMS
+
+    def all_architectures(self, platform):
+        return ARCHITECTURES[platform]
+
+    def lib_dir_name(self, platform):
+        return 'ios' if platform in ['ios', 'simulator'] else 'osx'
+
+    def host_platform(self):
+        return 'osx'
+
+    def sdk_path(self, platform):
+        name = XCODE_SDK_DIRS[platform]
+        return '{}/Platforms/{}.platform/Developer/SDKs/{}{}.sdk'.format(self.info()['developer_dir'], name, name, self.sdk_version(platform))
+
+    def program_command(self, platform, profile=DEFAULT_BUILD_PROFILE, arch=None):
+        # Compiles (and links a program against the platform's lib) for one arch
+        flags = ['-isysroot', self.sdk_path(platform), '-arch', arch or self.all_architectures(platform)[-1]] + self.cpp_flags(platform, profile)
+        return '"{}" {}'.format(self.tool_path(COMPILER, platform), ' '.join(flags))
+
+    def tasks(self):
+        return {
+            "ios": ['stage', 'install'],
+            "simulator": ['stage'],
+            "osx": ['stage'],
+        }
+
+    # These files are missing in the ARM iPhoneOS SDK, but they are in the simulator.
+    # They are supported on the device, so we copy them from x86 SDK to a staging area
+    # to use them on ARM, too.
+    def missing_headers(self):
+        simulator_include = os.path.join(self.info()['developer_dir'], 'Platforms/iPhoneSimulator.platform/Developer/SDKs/iPhoneSimulator{}.sdk/usr/include'.format(self.sdk_version('simulator')))
+        return [os.path.join(simulator_include, filename) for filename in ['crt_externs.h', 'bzlib.h']]
+
+    def arch_flags(self, platform):
+        # b2 builds every selected architecture of a platform in one pass
+        return ' '.join(['-arch {}'.format(arch) for arch in self.architectures(platform) or self.all_architectures(platform)])
+
+    def config_contents(self):
+        return """
+using darwin : {ios_sdk_version}~iphone
+: {compiler_path} {ios_arch_flags} "-isysroot {xcode_root}/Platforms/iPhoneOS.platform/Developer/SDKs/iPhoneOS{ios_sdk_version}.sdk" -I{xcode_root}/Platforms/iPhoneOS.platform/Developer/SDKs/iPhoneOS{ios_sdk_version}.sdk/usr/include
+: <striper> <root>{xcode_root}/Platforms/iPhoneOS.platform/Developer
+: <architecture>arm <target-os>iphone
+;
+using darwin : {ios_sdk_version}~iphonesim
+: {compiler_path} {simulator_arch_flags} "-isysroot {xcode_root}/Platforms/iPhoneSimulator.platform/Developer/SDKs/iPhoneSimulator{ios_sdk_version}.sdk" -I{xcode_root}/Platforms/iPhoneSimulator.platform/Developer/SDKs/iPhoneSimulator{ios_sdk_version}.sdk/usr/include
+: <striper> <root>{xcode_root}/Platforms/iPhoneSimulator.platform/Developer
+: <architecture>x86 <target-os>iphone
+;
+using darwin : {osx_sdk_version}~osx
+: {compiler_path} {osx_arch_flags} "-isysroot {xcode_root}/Platforms/MacOSX.platform/Developer/SDKs/MacOSX{osx_sdk_version}.sdk" -I{xcode_root}/Platforms/MacOSX.platform/Developer/SDKs/MacOSX{osx_sdk_version}.sdk/usr/include
+: <striper> <root>{xcode_root}/Platforms/MacOSX.platform/Developer
+: <architecture>x86 <target-os>darwin
+;
+        """.format(xcode_root=self.info()['developer_dir'],
+                   compiler_path=self.tool_path(COMPILER, 'osx'),
+                   ios_arch_flags=self.arch_flags('ios'),
+                   simulator_arch_flags=self.arch_flags('simulator'),
+                   osx_arch_flags=self.arch_flags('osx'),
+                   ios_sdk_version=self.sdk_version('ios'),
+                   osx_sdk_version=self.sdk_version('osx'))
+
+    def build_args(self, platform):
+        self.check_platform(platform)
+        args = ['linkflags="-stdlib={}"'.format(STD_LIB)]
+        if platform == 'ios':
+            args.extend([
+                'target-os=iphone',
+                'macosx-version=iphone-{}'.format(self.sdk_version('ios')),
+                'toolset=darwin-{}~iphone'.format(self.sdk_version('ios')),
+                'define=_LITTLE_ENDIAN',
+                'architecture=arm',
+                ])
+        elif platform == 'simulator':
+            args.extend([
+                'target-os=iphone',
+                'macosx-version=iphonesim-{}'.format(self.sdk_version('ios')),
+                'toolset=darwin-{}~iphonesim'.format(self.sdk_version('ios')),
+                'architecture=x86',
+                ])
+        else:
+            args.extend([
+                'target-os=darwin',
+                'macosx-version={}'.format(self.sdk_version('osx')),
+                'toolset=darwin-{}~osx'.format(self.sdk_version('osx')),
+                'architecture=x86',
+                ])
+        return args
 
-    return process.returncode
+    def cpp_flags(self, platform, profile=DEFAULT_BUILD_PROFILE):
+        self.check_platform(platform)
+        flags = ['-stdlib={}'.format(STD_LIB)]
+        if platform in ['ios', 'simulator']:
+            flags.append('-miphoneos-version-min={}'.format(IOS_MIN_VERSION))
+            # LTO objects are bitcode already, and clang rejects both flags together
+            if profile != 'lto':
+                flags.append('-fembed-bitcode')
+        else:
+            flags.extend([
+                '-mmacosx-version-min={}'.format(OSX_MIN_VERSION),
+                ])
+        return flags + self.profile_flags(platform, profile)
+
+    def identity(self):
+        return {
+            'ios_sdk_version': self.sdk_version('ios'),
+            'osx_sdk_version': self.sdk_version('osx'),
+            'compiler': self.info()['compiler_identity'],
+        }
+
+class LinuxToolchain(Toolchain):
+
+    name = 'linux'
+    archive_format = 'gnu'
+
+    def __init__(self, cache_dir, compiler=None, sysroot=None, cross_targets=()):
+        Toolchain.__init__(self, cache_dir)
+        self.compiler = compiler or ('clang' if find_executable('clang++') else 'gcc')
+        self.sysroot = sysroot
+        # Target triple of each platform, None for the host
+        self.targets = {'linux': None}
+        for triple in cross_targets:
+            self.targets['linux-{}'.format(triple.split('-')[0])] = triple
+
+    def all_platforms(self):
+        return sorted(self.targets)
+
+    def all_architectures(self, platform):
+        triple = self.targets[platform]
+        return [triple.split('-')[0] if triple else os.uname()[4]]
+
+    def compiler_command(self, platform):
+        # Cross gcc is a separate driver, clang takes --target
+        triple = self.targets[platform]
+        command = LINUX_COMPILERS[self.compiler]
+        return '{}-{}'.format(triple, command) if triple and self.compiler == 'gcc' else command
+
+    def cache_key(self):
+        path = find_executable(LINUX_COMPILERS[self.compiler])
+        if not path:
+            return None
+        path = os.path.realpath(path)
+        return [TOOLCHAIN_CACHE_FORMAT, self.compiler, path, os.path.getmtime(path), self.sysroot, sorted([triple for triple in self.targets.values() if triple])]
+
+    def find_tool(self, names, search_dirs):
+        for name in names:
+            path = find_executable(name)
+            if path:
+                return path
+            for directory in search_dirs:
+                path = os.path.join(directory, name)
+                if os.path.isfile(path) and os.access(path, os.X_OK):
+                    return path
+        return None
+
+    def probe(self):
+        print 'Probing the {} toolchain'.format(self.compiler)
+        tools = {}
+        for platform in self.all_platforms():
+            triple = self.targets[platform]
+            compiler = find_executable(self.compiler_command(platform))
+            if not compiler:
+                raise BuildError('Unable to find {}'.format(self.compiler_command(platform)))
+            # LLVM tools often live next to clang or llvm-ar rather than on the PATH
+            search_dirs = [os.path.dirname(os.path.realpath(path)) for path in [compiler, find_executable('llvm-ar')] if path]
+            tools[platform] = {'compiler': compiler}
+            for tool in ['ar', 'ranlib', 'lipo', 'llvm-profdata']:
+                names = [tool if tool.startswith('llvm-') else 'llvm-{}'.format(tool)]
+                if tool in ['ar', 'ranlib']:
+                    names.append('{}-{}'.format(triple, tool) if triple else tool)
+                path = self.find_tool(names, search_dirs)
+                if path:
+                    tools[platform][tool] = path
+        platforms = self.all_platforms()
+        identities = shell_outputs(['"{}" --version'.format(tools[platform]['compiler']) for platform in platforms], max_concurrency=len(platforms))
+        return {
+            'compiler_identity': dict(zip(platforms, identities)),
+            'tools': tools,
+        }
+
+    def target_flags(self, platform):
+        triple = self.targets[platform]
+        flags = []
+        if triple and self.compiler == 'clang':
+            flags.append('--target={}'.format(triple))
+        if triple and self.sysroot:
+            flags.append('--sysroot={}'.format(self.sysroot))
+        return flags
+
+    def host_platform(self):
+        return 'linux'
+
+    def pch_extension(self):
+        return 'gch' if self.compiler == 'gcc' else 'pch'
+
+    def program_command(self, platform, profile=DEFAULT_BUILD_PROFILE, arch=None):
+        flags = self.target_flags(platform) + self.cpp_flags(platform, profile) + ['-pthread']
+        return '"{}" {}'.format(self.tool_path('compiler', platform), ' '.join(flags))
+
+    def toolset_version(self, platform):
+        return self.all_architectures(platform)[0] if self.targets[platform] else 'host'
+
+    def config_contents(self):
+        lines = []
+        for platform in self.platforms():
+            options = []
+            for flag in self.target_flags(platform):
+                options.extend(['<compileflags>{}'.format(flag), '<linkflags>{}'.format(flag)])
+            for tool, feature in [('ar', 'archiver'), ('ranlib', 'ranlib')]:
+                if self.tool_path(tool, platform):
+                    options.append('<{}>{}'.format(feature, self.tool_path(tool, platform)))
+            lines.append('using {} : {} : {} : {} ;'.format(self.compiler, self.toolset_version(platform),
+                                                          self.tool_path('compiler', platform), ' '.join(options)))
+        return '\n{}\n'.format('\n'.join(lines))
+
+    def build_args(self, platform):
+        self.check_platform(platform)
+        args = [
+            'target-os=linux',
+            'toolset={}-{}'.format(self.compiler, self.toolset_version(platform)),
+            ]
+        arch = self.all_architectures(platform)[0]
+        if self.targets[platform] and arch in LINUX_ARCHITECTURES:
+            architecture, address_model = LINUX_ARCHITECTURES[arch]
+            args.extend([
+                'architecture={}'.format(architecture),
+                'address-model={}'.format(address_model),
+                ])
+        return args
+
+    def profile_flags(self, platform, profile):
+        # gcc has no ThinLTO; fat LTO objects keep the machine code next to the
+        # GIMPLE, so the archives stay readable without the LTO plugin
+        if profile == 'lto' and self.compiler == 'gcc':
+            return ['-flto', '-ffat-lto-objects']
+        if profile in ['pgo', 'pgo-generate'] and self.compiler != 'clang':
+            raise BuildError('The {} profile needs clang'.format(profile))
+        return Toolchain.profile_flags(self, platform, profile)
+
+    def cpp_flags(self, platform, profile=DEFAULT_BUILD_PROFILE):
+        self.check_platform(platform)
+        return self.profile_flags(platform, profile)
+
+    def identity(self):
+        return {
+            'sysroot': self.sysroot,
+            'compiler': self.info()['compiler_identity'],
+        }
+
+def create_toolchain(name, cache_dir, compiler=None, sysroot=None, cross_targets=()):
+    if name == 'xcode':
+        return XcodeToolchain(cache_dir)
+    if name == 'linux':
+        return LinuxToolchain(cache_dir, compiler, sysroot, cross_targets)
+    raise BuildError('Unknown toolchain: {}'.format(name))
 
 #-------------------------------------------------------------------------------
 #
@@ -134,17 +2437,71 @@ def shell_pipe(callback, cmd, redirect_stderr_to_stdout = True):
 #
 #-------------------------------------------------------------------------------
 
+# Keys of the --config file
+SELECTION_KEYS = ['platforms', 'archs', 'libs', 'targets']
+TARGETS = ['stage', 'install']
+
+class BuildSelection:
+
+    # The platforms, architectures, libraries and targets to build; None selects
+    # all of them.
+    def __init__(self, platforms=None, archs=None, libs=None, targets=None):
+        self.platforms = platforms
+        self.archs = archs
+        self.libs = libs
+        self.targets = targets
+
+    def selected_libs(self):
+        return self.libs or BOOST_LIBS
+
+    def select_tasks(self, tasks, platforms):
+        selected = {}
+        for platform in platforms:
+            targets = [target for target in tasks.get(platform, []) if not self.targets or target in self.targets]
+            if targets:
+                selected[platform] = targets
+        return selected
+
+def load_selection(config_path=None, platforms=None, archs=None, libs=None, targets=None):
+    # Selections on the command line override the config file's
+    config = {}
+    if config_path:
+        try:
+            with open(config_path) as f:
+                config = json.load(f)
+        except (IOError, ValueError) as e:
+            raise BuildError('Unable to read {}: {}'.format(config_path, e))
+        unknown = sorted(set(config) - set(SELECTION_KEYS))
+        if unknown:
+            raise BuildError('Unknown keys in {}: {}'.format(config_path, ', '.join(unknown)))
+    selection = BuildSelection(platforms or config.get('platforms'),
+                               archs or config.get('archs'),
+                               libs or config.get('libs'),
+                               targets or config.get('targets'))
+    for lib in selection.libs or []:
+        if lib not in BOOST_LIBS:
+            raise BuildError('Unknown library {}, expected one of {}'.format(lib, ', '.join(BOOST_LIBS)))
+    for target in selection.targets or []:
+        if target not in TARGETS:
+            raise BuildError('Unknown target {}, expected one of {}'.format(target, ', '.join(TARGETS)))
+    return selection
+
 class BuildEnv:
 
     def __init__(self, root):
         self.root = os.path.join(root, 'build')
         self.dir_stack = []
-        self.xcode_root = shell_output('xcode-select -print-path')
-        self.ios_sdk_version = shell_output('xcrun -sdk iphoneos --show-sdk-version')
-        self.osx_sdk_version = shell_output('xcrun -sdk macosx --show-sdk-version')
-        self.ios_simulator_root = os.path.join(self.xcode_root, 'Platforms/iPhoneSimulator.platform/Developer/SDKs/iPhoneSimulator{}.sdk'.format(self.ios_sdk_version))
         self.output_lib_dir = os.path.join(root, 'lib')
         self.output_src_dir = os.path.join(root, 'include/boost')
+        self.artifact_cache = None
+        self.cache_dir = CACHE_DIR
+        self.header_resolver = 'bcp'
+        self.header_sync_mode = 'copy'
+        self.header_store = None
+        self.pch = False
+        self.toolchain = create_toolchain(DEFAULT_TOOLCHAIN, CACHE_DIR)
+        self.selection = BuildSelection()
+        self.build_profile = DEFAULT_BUILD_PROFILE
 
     def resolve_path(self, relative_path):
         return os.path.join(self.root, relative_path)
@@ -188,40 +2545,94 @@ class BoostSource:
         self.root = self.build_env.resolve_path('boost_{}'.format(self.version_underscore))
         self.tarball_url = BOOST_TARBALL_URL_TEMPLATE.format(self.version, self.version_underscore)
         self.tarball_path = os.path.join(self.build_env.root, 'boost_{}.tar.bz2'.format(self.version_underscore))
+        self.tarball_sha256 = BOOST_TARBALL_SHA256.get(version)
+        self.marker_path = self.resolve_path('.fetched.json')
+        self.minimal = False
+        self.source_cache = None
         self.config_path = os.path.join(self.root, 'user-config.jam')
 
     def resolve_path(self, relative_path):
         return os.path.join(self.root, relative_path)
 
-    def download(self):
-        if os.path.isfile(self.tarball_path):
-            print 'Found Boost {} tarball: {}'.format(self.version, self.tarball_path)
-        else:
-            print 'Downloading Boost {} tarball: {}'.format(self.version, self.tarball_path)
-            shell('curl -L -o {} {}'.format(self.tarball_path, self.tarball_url))
-
-    def unpack(self):
-        if not os.path.isfile(self.tarball_path):
-            print 'Boost {} tarball not found: {}'.format(self.version, self.tarball_path)
+    def source_filter_dirs(self):
+        dirs = MINIMAL_SOURCE_DIRS[:]
+        for module in sorted(set(BOOST_LIBS + BOOST_HEADERS + MINIMAL_SOURCE_LIBS)):
+            if '/' not in module:
+                dirs.append('libs/{}'.format(module))
+        return dirs
+
+    def minimal_key(self):
+        # Changes with what a minimal tree holds, so that one extracted for other
+        # modules is replaced
+        return hash_key(self.source_filter_dirs())[:16]
+
+    def source_filter(self):
+        dirs = self.source_filter_dirs()
+        prefixes = tuple(['{}/'.format(d) for d in dirs])
+        parents = set()
+        for d in dirs:
+            parts = d.split('/')
+            parents.update(['/'.join(parts[:i]) for i in range(1, len(parts))])
+        def wanted(member):
+            path = member.name.rstrip('/')
+            if '/' not in path and not member.isdir():
+                return True
+            parts = path.split('/')
+            if parts[0] == 'libs' and (len(parts) > 2 and parts[2] in LIB_SOURCE_DIRS or len(parts) == 2 and member.isdir()):
+                return True
+            return path in dirs or path in parents or path.startswith(prefixes)
+        return wanted
+
+    def fetch(self):
+        # A full tree serves a minimal build, but not the other way round
         if os.path.isdir(self.root):
-            print 'Found Boost {} source: {}'.format(self.version, self.root)
+            fetched = {}
+            if os.path.isfile(self.marker_path):
+                with open(self.marker_path) as f:
+                    fetched = json.load(f)
+            minimal = fetched.get('minimal')
+            if not minimal or (self.minimal and minimal == self.minimal_key()):
+                print 'Found Boost {} source: {}'.format(self.version, self.root)
+                return
+            shutil.rmtree(self.root)
+        if self.source_cache:
+            self.fetch_cached()
         else:
-            self.build_env.make_dir(self.root)
-            self.build_env.push_dir(self.build_env.root)
-            print 'Unpacking Boost {} tarball in {}'.format(self.version, self.build_env.root)
-            shell('tar xfj {}'.format(self.tarball_path))
-            self.build_env.pop_dir()
-
-    # These files are missing in the ARM iPhoneOS SDK, but they are in the simulator.
-    # They are supported on the device, so we copy them from x86 SDK to a staging area
-    # to use them on ARM, too.
+            print 'Fetching Boost {} into {}'.format(self.version, self.root)
+            self.extract(self.tarball_path, self.root)
+
+    def fetch_cached(self):
+        cache = self.source_cache
+        name = 'boost_{}-{}'.format(self.version_underscore, (self.tarball_sha256 or 'unverified')[:16])
+        tarball_key = '{}.tar.bz2'.format(name)
+        tree_key = '{}-minimal-{}'.format(name, self.minimal_key()) if self.minimal else name
+        with cache.lock(tarball_key), cache.lock(tree_key):
+            tree = cache.entry_path(tree_key)
+            if os.path.isdir(tree):
+                print 'Found Boost {} source in the source cache: {}'.format(self.version, tree)
+            else:
+                print 'Fetching Boost {} into the source cache: {}'.format(self.version, tree)
+                self.extract(cache.entry_path(tarball_key), tree)
+                freeze_tree(tree)
+            if os.path.isfile(cache.entry_path(tarball_key)):
+                cache.touch(tarball_key)
+            cache.touch(tree_key)
+            mode = clone_tree(tree, self.root)
+            print 'Created the Boost {} working tree ({}): {}'.format(self.version, mode, self.root)
+        cache.evict()
+
+    def extract(self, tarball_path, dst_dir):
+        fetch_tarball(self.tarball_url, tarball_path, dst_dir, sha256=self.tarball_sha256,
+                      wanted=self.source_filter() if self.minimal else None)
+        with open(os.path.join(dst_dir, os.path.basename(self.marker_path)), 'w') as f:
+            json.dump({'url': self.tarball_url, 'minimal': self.minimal_key() if self.minimal else False}, f)
+
+    # Headers the toolchain's SDKs lack, copied into the source root
     def invent_missing_headers(self):
-        simulator_include = os.path.join(self.build_env.ios_simulator_root, 'usr/include')
-        for filename in ['crt_externs.h', 'bzlib.h']:
-            filepath = os.path.join(simulator_include, filename)
+        for filepath in self.build_env.toolchain.missing_headers():
             if not os.path.isfile(filepath):
-                print 'File doesn\'t exist: {}'.format(filepath)
-                sys.exit(1)
+                raise BuildError('File doesn\'t exist: {}'.format(filepath))
+            filename = os.path.basename(filepath)
             dst_path = self.resolve_path(filename)
             if not os.path.isfile(dst_path):
                 print 'Copying {}'.format(filename)
@@ -234,52 +2645,42 @@ class BoostSource:
         self.build_env.pop_dir()
 
     def config_contents(self):
-        return """
-using darwin : {ios_sdk_version}~iphone
-: {xcode_root}/Toolchains/XcodeDefault.xctoolchain/usr/bin/{compiler} -arch armv7 -arch arm64 "-isysroot {xcode_root}/Platforms/iPhoneOS.platform/Developer/SDKs/iPhoneOS{ios_sdk_version}.sdk" -I{xcode_root}/Platforms/iPhoneOS.platform/Developer/SDKs/iPhoneOS{ios_sdk_version}.sdk/usr/include
-: <striper> <root>{xcode_root}/Platforms/iPhoneOS.platform/Developer
-: <architecture>arm <target-os>iphone
-;
-using darwin : {ios_sdk_version}~iphonesim
-: {xcode_root}/Toolchains/XcodeDefault.xctoolchain/usr/bin/{compiler} -arch i386 -arch x86_64 "-isysroot {xcode_root}/Platforms/iPhoneSimulator.platform/Developer/SDKs/iPhoneSimulator{ios_sdk_version}.sdk" -I{xcode_root}/Platforms/iPhoneSimulator.platform/Developer/SDKs/iPhoneSimulator{ios_sdk_version}.sdk/usr/include
-: <striper> <root>{xcode_root}/Platforms/iPhoneSimulator.platform/Developer
-: <architecture>x86 <target-os>iphone
-;
-using darwin : {osx_sdk_version}~osx
-: {xcode_root}/Toolchains/XcodeDefault.xctoolchain/usr/bin/{compiler} -arch i386 -arch x86_64 "-isysroot {xcode_root}/Platforms/MacOSX.platform/Developer/SDKs/MacOSX{osx_sdk_version}.sdk" -I{xcode_root}/Platforms/MacOSX.platform/Developer/SDKs/MacOSX{osx_sdk_version}.sdk/usr/include
-: <striper> <root>{xcode_root}/Platforms/MacOSX.platform/Developer
-: <architecture>x86 <target-os>darwin
-;
-        """.format(xcode_root=self.build_env.xcode_root,
-                   compiler=COMPILER,
-                   ios_sdk_version=self.build_env.ios_sdk_version,
-                   osx_sdk_version=self.build_env.osx_sdk_version)
+        return self.build_env.toolchain.config_contents()
 
     def create_config(self):
-        if not os.path.isfile(self.config_path):
-            template_path = os.path.join(self.root, 'tools/build/example/user-config.jam')
-            if not os.path.isfile(template_path):
-                print 'File doesn\'t exist: {}'.format(template_path)
-                sys.exit(1)
-            shutil.copyfile(template_path, self.config_path)
-            with open(self.config_path, 'a') as f:
-                f.write(self.config_contents())
+        # Rewritten when the selected architectures change
+        template_path = os.path.join(self.root, 'tools/build/example/user-config.jam')
+        if not os.path.isfile(template_path):
+            raise BuildError('File doesn\'t exist: {}'.format(template_path))
+        with open(template_path) as f:
+            contents = f.read() + self.config_contents()
+        if os.path.isfile(self.config_path):
+            with open(self.config_path) as f:
+                if f.read() == contents:
+                    return
+        with open(self.config_path, 'w') as f:
+            f.write(contents)
 
     def setup(self):
-        self.download()
-        self.unpack()
+        self.fetch()
         self.invent_missing_headers()
         self.bootstrap()
         self.create_config()
 
 class BuildTask:
 
-    def __init__(self, build_env, boost_source, platform, target='stage'):
+    # b2 runs every target of the task in one pass over the same build dir
+    def __init__(self, build_env, boost_source, platform, targets=('stage',), jobs=1, profile=None):
         self.build_env = build_env
         self.boost_source = boost_source
         self.platform = platform
-        self.target = target
-        self.relative_build_dir = '{}-build'.format(platform)
+        self.targets = list(targets)
+        self.jobs = jobs
+        self.profile = profile or build_env.build_profile
+        if self.profile == DEFAULT_BUILD_PROFILE:
+            self.relative_build_dir = '{}-build'.format(platform)
+        else:
+            self.relative_build_dir = '{}-{}-build'.format(platform, self.profile)
         self.build_dir = self.boost_source.resolve_path(self.relative_build_dir)
         self.relative_stage_dir = os.path.join(self.relative_build_dir, 'stage')
         self.stage_dir = self.boost_source.resolve_path(self.relative_stage_dir)
@@ -288,186 +2689,351 @@ class BuildTask:
 
     def common_build_args(self):
         return [
-            '-j16',
+            '-j{}'.format(self.jobs),
             '--build-dir={}'.format(self.relative_build_dir),
             '--stagedir={}'.format(self.relative_stage_dir),
             '--prefix={}'.format(self.relative_prefix_dir),
-            'linkflags="-stdlib={}"'.format(STD_LIB),
             'link=static',
             'variant=release',
             '-sBOOST_BUILD_USER_CONFIG={}'.format(self.boost_source.config_path),
-            ]
-
-    def ios_and_simulator_build_args(self):
-        return [
-            'target-os=iphone',
-            ]
+            ] + self.profile_build_args() + ['--with-{}'.format(lib) for lib in self.build_env.selection.selected_libs()]
 
-    def ios_build_args(self):
-        return [
-            'macosx-version=iphone-{}'.format(self.build_env.ios_sdk_version),
-            'toolset=darwin-{}~iphone'.format(self.build_env.ios_sdk_version),
-            'define=_LITTLE_ENDIAN',
-            'architecture=arm',
-            ]
-
-    def simulator_build_args(self):
-        return [
-            'macosx-version=iphonesim-{}'.format(self.build_env.ios_sdk_version),
-            'toolset=darwin-{}~iphonesim'.format(self.build_env.ios_sdk_version),
-            'architecture=x86',
-            ]
-
-    def osx_build_args(self):
-        return [
-            'target-os=darwin',
-            'macosx-version={}'.format(self.build_env.osx_sdk_version),
-            'toolset=darwin-{}~osx'.format(self.build_env.osx_sdk_version),
-            'architecture=x86',
-            ]
+    def profile_build_args(self):
+        return ['optimization=space'] if self.profile == 'size' else []
 
     def common_cpp_flags(self):
-        return [
-            '-std={}'.format(CPP_STD),
-            '-stdlib={}'.format(STD_LIB),
-            '-fvisibility=default',
-            '-fvisibility-inlines-hidden',
-            '-fPIC', 
-            '-DBOOST_SP_USE_SPINLOCK',
-            ]
-
-    def ios_and_simulator_cpp_flags(self):
-        return [
-            '-miphoneos-version-min={}'.format(IOS_MIN_VERSION),
-            '-fembed-bitcode',
-            ]
-
-    def osx_cpp_flags(self):
-        return [
-            '-mmacosx-version-min={}'.format(OSX_MIN_VERSION),
-            ]
+        return list(COMMON_CPP_FLAGS)
 
     def cpp_flags(self):
-        flags = self.common_cpp_flags()
-        if self.platform in ('ios', 'simulator'):
-            flags.extend(self.ios_and_simulator_cpp_flags())
-        elif self.platform == 'osx':
-            flags.extend(self.osx_cpp_flags())
-        else:
-            print 'Unexpected platform: {}'.format(self.platform)
-            sys.exit(1)
+        flags = self.common_cpp_flags() + self.build_env.toolchain.cpp_flags(self.platform, self.profile)
+        if self.profile == 'pgo':
+            flags.append('-fprofile-instr-use={}'.format(self.boost_source.resolve_path(PGO_PROFILE_PATH)))
         return flags
 
-    def build_args(self):
-        args = self.common_build_args()
-        if self.platform in ('ios', 'simulator'):
-            args.extend(self.ios_and_simulator_build_args())
-            if self.platform == 'ios':
-                args.extend(self.ios_build_args())
-            else:
-                args.extend(self.simulator_build_args())
-        elif self.platform == 'osx':
-            args.extend(self.osx_build_args())
-        else:
-            print 'Unexpected platform: {}'.format(self.platform)
-            sys.exit(1)
+    def build_args(self, targets):
+        args = self.common_build_args() + self.build_env.toolchain.build_args(self.platform)
         flags = self.cpp_flags()
         if flags and len(flags) > 0:
             args.append('cxxflags="{}"'.format(' '.join(flags)))
-        args.append(self.target)
+        args.extend(targets)
         return args
 
+    def output_dir(self, target):
+        return self.prefix_dir if target == 'install' else self.stage_dir
+
+    def cache_key(self, target):
+        # The job count doesn't change the output, and the checkout location shouldn't.
+        # Each target is cached on its own, whichever targets it was built with.
+        # A PGO build is keyed by the contents of its profile.
+        args = [arg.replace(self.boost_source.root, '<boost>') for arg in self.build_args([target]) if not arg.startswith('-j')]
+        pgo_profile_path = self.boost_source.resolve_path(PGO_PROFILE_PATH)
+        return hash_key({
+            'version': BOOST_VERSION,
+            'profile': self.profile,
+            'pgo_profile': file_digest(pgo_profile_path) if self.profile == 'pgo' else None,
+            'libs': self.build_env.selection.selected_libs(),
+            'build_args': args,
+            'cpp_flags': [flag.replace(self.boost_source.root, '<boost>') for flag in self.cpp_flags()],
+            'toolchain': self.build_env.toolchain.name,
+            'toolchain_identity': self.build_env.toolchain.identity(),
+            'config': self.boost_source.config_contents(),
+            })
+
     def run(self):
+        cache = self.build_env.artifact_cache
+        targets = []
+        for target in self.targets:
+            if cache and cache.restore(self.cache_key(target), self.output_dir(target)):
+                print 'Restored {} target on {} from the artifact cache'.format(target, self.platform)
+            else:
+                targets.append(target)
+        if not targets:
+            return
         self.build_env.push_dir(self.boost_source.root)
-        print 'Running {} target on {}'.format(self.target, self.platform)
-        shell('./b2 {}'.format(' '.join(self.build_args())))
+        print 'Running {} on {} with {} jobs ({} profile)'.format(', '.join(targets), self.platform, self.jobs, self.profile)
+        shell('./b2 {}'.format(' '.join(self.build_args(targets))))
         self.build_env.pop_dir()
+        if cache:
+            for target in targets:
+                cache.store(self.cache_key(target), self.output_dir(target))
+
+class ProfileTraining:
+
+    # A PGO build runs a training workload against the host platform's
+    # instrumented libs, and merges the raw profiles it writes into the profile
+    # every platform's 'pgo' build uses. The workload is the bundled exercise of
+    # the libraries unless a command is given; that command finds the libs and
+    # headers in $BOOST_INSTRUMENTED_LIB_DIR and $BOOST_INCLUDE_DIR.
+    def __init__(self, build_env, boost_source, source_path, command=None):
+        self.build_env = build_env
+        self.boost_source = boost_source
+        self.toolchain = build_env.toolchain
+        self.source_path = source_path
+        self.command = command
+        self.output_dir = self.build_env.resolve_path('pgo')
+
+    def instrumented_task(self, jobs=1):
+        return BuildTask(self.build_env, self.boost_source, self.toolchain.host_platform(), ['stage'], jobs, profile='pgo-generate')
+
+    def build_instrumented(self, jobs=1):
+        platform = self.toolchain.host_platform()
+        if not platform:
+            raise BuildError('The {} toolchain has no platform to run the PGO training on'.format(self.toolchain.name))
+        if platform not in self.toolchain.platforms():
+            raise BuildError('The PGO training runs on {}; build that platform too'.format(platform))
+        self.instrumented_task(jobs).run()
+
+    def cache_key(self):
+        if self.command:
+            training = self.command
+        else:
+            training = file_digest(self.source_path)
+        return hash_key({
+            'instrumented': self.instrumented_task().cache_key('stage'),
+            'training': training,
+            })
+
+    def lib_paths(self, lib_dir, arch):
+        # The instrumented libs, each before the libs it needs
+        paths = dict([(archive_label(name), os.path.join(lib_dir, name)) for name in os.listdir(lib_dir) if name.endswith('.a')])
+        dependencies = archive_dependencies(paths, arch)
+        ordered = []
+        def visit(label):
+            if label in ordered:
+                return
+            for dependency in dependencies[label]:
+                visit(dependency)
+            ordered.insert(0, label)
+        for label in sorted(paths):
+            visit(label)
+        return [paths[label] for label in ordered]
+
+    def run_training(self, profile_dir):
+        platform = self.toolchain.host_platform()
+        lib_dir = os.path.join(self.instrumented_task().stage_dir, 'lib')
+        raw_dir = self.build_env.make_dir(os.path.join(self.output_dir, 'raw'))
+        for name in os.listdir(raw_dir):
+            os.remove(os.path.join(raw_dir, name))
+        # The stage runs in a process of its own, so its environment is ours to change
+        os.environ['LLVM_PROFILE_FILE'] = os.path.join(raw_dir, '%p.profraw')
+        os.environ['BOOST_INSTRUMENTED_LIB_DIR'] = lib_dir
+        os.environ['BOOST_INCLUDE_DIR'] = self.boost_source.root
+        if self.command:
+            print 'Training with {}'.format(self.command)
+            shell(self.command)
+        else:
+            program = os.path.join(self.output_dir, 'train')
+            # The instrumented libs may be fat, so the program and the libs'
+            # dependencies are for one of the archs they were built for
+            arch = self.toolchain.architectures(platform)[-1]
+            shell('{} -std={} -O2 -I"{}" -o "{}" "{}" {}'.format(
+                self.toolchain.program_command(platform, 'pgo-generate', arch), CPP_STD, self.boost_source.root,
+                program, self.source_path, ' '.join(['"{}"'.format(path) for path in self.lib_paths(lib_dir, arch)])))
+            print 'Training with {}'.format(os.path.basename(self.source_path))
+            shell('"{}"'.format(program))
+        raw_profiles = [os.path.join(raw_dir, name) for name in sorted(os.listdir(raw_dir))]
+        if not raw_profiles:
+            raise BuildError('The PGO training wrote no profiles to {}'.format(raw_dir))
+        profdata = self.toolchain.tool_path('llvm-profdata', platform)
+        if not profdata:
+            raise BuildError('Merging the PGO profiles needs llvm-profdata, which the {} toolchain lacks'.format(self.toolchain.name))
+        self.build_env.make_dir(profile_dir)
+        shell('"{}" merge -output="{}" {}'.format(profdata, os.path.join(profile_dir, os.path.basename(PGO_PROFILE_PATH)),
+                                                 ' '.join(['"{}"'.format(path) for path in raw_profiles])))
+
+    def train(self):
+        # The merged profile is cached by the instrumented build and the workload
+        cache = self.build_env.artifact_cache
+        profile_dir = os.path.dirname(self.boost_source.resolve_path(PGO_PROFILE_PATH))
+        key = self.cache_key()
+        if cache and cache.restore(key, profile_dir):
+            print 'Restored the PGO profile from the artifact cache'
+            return
+        self.run_training(profile_dir)
+        if cache:
+            cache.store(key, profile_dir)
 
 class Packager:
 
+    # Next to each fat lib, a manifest records the members of each library in
+    # each architecture, so a partial build can splice the libraries and
+    # architectures it rebuilt into the installed lib. Every library is also
+    # packaged on its own (libboost_<lib>.a), and the manifest lists the other
+    # libraries each one needs, so consumers can link only what they use.
     def __init__(self, build_env, boost_source):
         self.build_env = build_env
         self.boost_source = boost_source
+        self.toolchain = build_env.toolchain
+        self.selection = build_env.selection
         self.output_lib_dir = self.build_env.resolve_path('lib')
-        self.ios_lib_dir = os.path.join(self.output_lib_dir, 'ios')
-        self.osx_lib_dir = os.path.join(self.output_lib_dir, 'osx')
         self.lib_name = 'libboost.a'
-
-    def get_libs(self):
-        self.build_env.push_dir(self.boost_source.root)
-        lib_dirs = list()
-        for platform in PLATFORMS:
-            build_task = BuildTask(self.build_env, self.boost_source, platform)
-            lib_dirs.append(os.path.join(build_task.relative_stage_dir, 'lib'))
-        all_libs = set()
-        for lib_dir in lib_dirs:
-            libs = [lib for lib in os.listdir(lib_dir) if os.path.isfile(os.path.join(lib_dir, lib))]
-            all_libs.update(set(libs))
-        self.build_env.pop_dir()
-        return list(all_libs)
-
-    def separate_architectures(self, all_libs):
-        self.build_env.push_dir(self.boost_source.root)
-        for platform in PLATFORMS:
-            build_task = BuildTask(self.build_env, self.boost_source, platform)
-            input_dir = os.path.join(build_task.relative_stage_dir, 'lib')
-            output_dir = self.ios_lib_dir if platform in ['ios', 'simulator'] else self.osx_lib_dir
-            sdk = 'iphoneos' if platform in ['ios', 'simulator'] else 'macosx'
-            self.build_env.make_dir(output_dir)
-            for lib in all_libs:
-                input_path = os.path.join(input_dir, lib)
-                if os.path.isfile(input_path):
-                    for arch in ARCHITECTURES[platform]:
-                        arch_dir = os.path.join(output_dir, arch)
-                        self.build_env.make_dir(arch_dir)
-                        # Split the fat libs into their architecture-specific libs
-                        output_path = os.path.join(arch_dir, lib)
-                        lipo_command = 'lipo "{}" -thin {} -o "{}"'.format(input_path, arch, output_path)
-                        shell('xcrun --sdk {} {}'.format(sdk, lipo_command))
-                        # Decompose the architecture-specific libs
-                        obj_dir = os.path.join(arch_dir, 'obj')
-                        self.build_env.make_dir(obj_dir)
-                        self.build_env.push_dir(obj_dir)
-                        shell('ar -x ../{}'.format(lib))
-                        obj_files = [obj_file for obj_file in os.listdir('./') if os.path.isfile(obj_file) and obj_file.endswith('.o')]
-                        self.build_env.pop_dir()
-                        # Create an architecture-specific fat lib
-                        self.build_env.push_dir(arch_dir)
-                        if os.path.isfile(self.lib_name):
-                            os.remove(self.lib_name)
-                        ar_command = 'ar crus {} {}'.format(self.lib_name, ' '.join([os.path.join('obj', obj_file) for obj_file in obj_files]))
-                        shell('xcrun --sdk {} {}'.format(sdk, ar_command))
-                        self.build_env.pop_dir()
+        self.manifest_name = 'libboost.json'
+
+    def split_lib_name(self, label):
+        return 'libboost_{}.a'.format(label)
+
+    def platform_lib_dir(self, platform):
+        return os.path.join(self.output_lib_dir, self.toolchain.lib_dir_name(platform))
+
+    def installed_path(self, platform_dir, filename):
+        return os.path.join(self.build_env.output_lib_dir, os.path.relpath(platform_dir, self.output_lib_dir), filename)
+
+    def read_manifest(self, path):
+        if not os.path.isfile(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def get_platform_libs(self, platform):
+        build_task = BuildTask(self.build_env, self.boost_source, platform)
+        lib_dir = os.path.join(build_task.stage_dir, 'lib')
+        return [lib for lib in os.listdir(lib_dir) if os.path.isfile(os.path.join(lib_dir, lib))]
+
+    def installed_members(self, platform_dir, arch, rebuilt_labels):
+        # The members of the installed lib that belong to libraries this build
+        # doesn't rebuild
+        lib_path = self.installed_path(platform_dir, self.lib_name)
+        manifest = self.read_manifest(self.installed_path(platform_dir, self.manifest_name))
+        if not os.path.isfile(lib_path) or not manifest or arch not in manifest['archs']:
+            raise BuildError('Building some libraries for {} needs {} from a full build'.format(arch, lib_path))
+        labels = dict([(label, names) for label, names in manifest['archs'][arch].items() if label not in rebuilt_labels])
+        return lib_path, labels
+
+    def index_lib(self, lib_path, platform):
+        # Some members (LLVM bitcode, for one) have symbols only ranlib can read
+        ranlib = self.toolchain.tool_path('ranlib', platform)
+        if not ranlib:
+            raise BuildError('{} needs ranlib, which the {} toolchain lacks'.format(lib_path, self.toolchain.name))
+        shell('"{}" "{}"'.format(ranlib, lib_path))
+
+    def split_lib(self, arch_dir, platform, labels):
+        output_paths = dict([(label, os.path.join(arch_dir, self.split_lib_name(label))) for label in labels])
+        for lib_path in split_archive(os.path.join(arch_dir, self.lib_name), labels, output_paths, self.toolchain.archive_format):
+            self.index_lib(lib_path, platform)
+
+    def package_arch(self, platform, arch):
+        # Merge this architecture's slice of every library of the platform straight
+        # into one archive, member by member.
+        build_task = BuildTask(self.build_env, self.boost_source, platform)
+        input_dir = os.path.join(build_task.stage_dir, 'lib')
+        platform_dir = self.platform_lib_dir(platform)
+        arch_dir = self.build_env.make_dir(os.path.join(platform_dir, arch))
+        lib_path = os.path.join(arch_dir, self.lib_name)
+        input_paths = [os.path.join(input_dir, lib) for lib in sorted(self.get_platform_libs(platform))]
+        base_path = base_labels = None
+        if self.selection.libs:
+            base_path, base_labels = self.installed_members(platform_dir, arch, [archive_label(path) for path in input_paths])
+        indexed, labels = merge_archives(lib_path, input_paths, arch, self.toolchain.archive_format, base_path, base_labels)
+        if not indexed:
+            self.index_lib(lib_path, platform)
+        self.split_lib(arch_dir, platform, labels)
+        with open(os.path.join(arch_dir, self.manifest_name), 'w') as f:
+            json.dump(labels, f, indent=2, sort_keys=True)
+
+    def stages(self, platforms=None, size_report=None):
+        # One packaging stage per (platform, arch), then one stage per output dir
+        # that combines its arches into the fat lib and installs it, and one that
+        # reports the size of every arch.
+        stages = []
+        platform_dirs = {}
+        thin_libs = {}
+        for platform in self.toolchain.platforms():
+            if platforms is not None and platform not in platforms:
+                continue
+            for arch in self.toolchain.architectures(platform):
+                output = 'thin/{}/{}'.format(platform, arch)
+                package = lambda platform=platform, arch=arch: self.package_arch(platform, arch)
+                stages.append(Stage('package-{}-{}'.format(platform, arch), package, inputs=['stage/{}'.format(platform)], outputs=[output], cost=5))
+                platform_dirs.setdefault(self.platform_lib_dir(platform), []).append((platform, arch, output))
+                thin_libs['{}/{}'.format(self.toolchain.lib_dir_name(platform), arch)] = os.path.join(self.platform_lib_dir(platform), arch, self.lib_name)
+        for platform_dir, outputs in sorted(platform_dirs.items()):
+            name = os.path.basename(platform_dir)
+            inputs = [output for platform, arch, output in outputs]
+            archs = [arch for platform, arch, output in outputs]
+            install = lambda platform_dir=platform_dir, platform=outputs[0][0], archs=archs: self.install_platform(platform_dir, platform, archs)
+            stages.append(Stage('install-{}-lib'.format(name), install, inputs=inputs, outputs=['lib/{}'.format(name)], cost=5))
+        if size_report and thin_libs:
+            inputs = [output for outputs in platform_dirs.values() for platform, arch, output in outputs]
+            stages.append(Stage('size-report', lambda: size_report.run(thin_libs), inputs=inputs, outputs=['size-report'], cost=5))
+        return stages
+
+    def keep_installed_archs(self, platform_dir, platform, archs, manifest):
+        # A build of some platforms or architectures keeps the installed slices
+        # of the others
+        lib_path = self.installed_path(platform_dir, self.lib_name)
+        if not os.path.isfile(lib_path):
+            return []
+        installed_manifest = self.read_manifest(self.installed_path(platform_dir, self.manifest_name)) or {'archs': {}}
+        kept = []
+        for arch in fat_architectures(lib_path) or []:
+            if arch in archs:
+                continue
+            arch_dir = self.build_env.make_dir(os.path.join(platform_dir, arch))
+            if arch not in installed_manifest['archs']:
+                raise BuildError('The installed {} slice of {} has no manifest to split it by library; build {} too'.format(arch, lib_path, arch))
+            extract_slice(lib_path, arch, os.path.join(arch_dir, self.lib_name))
+            manifest['archs'][arch] = installed_manifest['archs'][arch]
+            self.split_lib(arch_dir, platform, manifest['archs'][arch])
+            kept.append(arch)
+        if kept:
+            print 'Keeping the installed {} slices of {}'.format(', '.join(kept), lib_path)
+        return kept
+
+    def combine_archs(self, arch_libs, lib_name, platform):
+        if os.path.isfile(lib_name):
+            os.remove(lib_name)
+        lipo = self.toolchain.tool_path('lipo', platform)
+        if len(arch_libs) == 1:
+            shutil.copyfile(arch_libs[0], lib_name)
+        elif lipo:
+            shell('"{}" -create {} -output {}'.format(lipo, ' '.join(arch_libs), lib_name))
+        else:
+            raise BuildError('Combining {} needs lipo, which the {} toolchain lacks'.format(', '.join(arch_libs), self.toolchain.name))
+
+    def library_dependencies(self, platform_dir, manifest):
+        # A library depends on another when it does in any architecture
+        dependencies = {}
+        for arch, labels in sorted(manifest['archs'].items()):
+            paths = dict([(label, os.path.join(platform_dir, arch, self.split_lib_name(label))) for label in labels])
+            for label, needed in archive_dependencies(paths).items():
+                dependencies.setdefault(label, set()).update(needed)
+        return dict([(label, sorted(needed)) for label, needed in dependencies.items()])
+
+    def create_fat_lib(self, platform_dir, platform, archs):
+        manifest = {'archs': {}}
+        for arch in archs:
+            with open(os.path.join(platform_dir, arch, self.manifest_name)) as f:
+                manifest['archs'][arch] = json.load(f)
+        if self.toolchain.partial():
+            archs = archs + self.keep_installed_archs(platform_dir, platform, archs, manifest)
+        manifest['dependencies'] = self.library_dependencies(platform_dir, manifest)
+        self.build_env.push_dir(platform_dir)
+        self.combine_archs([os.path.join(arch, self.lib_name) for arch in sorted(archs)], self.lib_name, platform)
+        for label in sorted(manifest['dependencies']):
+            lib_name = self.split_lib_name(label)
+            arch_libs = [os.path.join(arch, lib_name) for arch in sorted(archs) if label in manifest['archs'][arch]]
+            self.combine_archs(arch_libs, lib_name, platform)
+        with open(self.manifest_name, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
         self.build_env.pop_dir()
 
-    def create_fat_libs(self):
-        for platform_dir in [self.ios_lib_dir, self.osx_lib_dir]:
-            self.build_env.push_dir(platform_dir)
-            arch_libs = []
-            for arch_dir in [arch_dir for arch_dir in os.listdir('./') if os.path.isdir(arch_dir)]:
-                arch_lib = os.path.join(arch_dir, self.lib_name)
-                if os.path.isfile(arch_lib):
-                    arch_libs.append(arch_lib)
-            if os.path.isfile(self.lib_name):
-                os.remove(self.lib_name)
-            shell('lipo -c {} -output {}'.format(' '.join(arch_libs), self.lib_name))
-            self.build_env.pop_dir()
-
-    def install(self):
-        self.build_env.push_dir(self.build_env.root)
-        for platform_dir in [self.ios_lib_dir, self.osx_lib_dir]:
-            fat_lib_path = os.path.join(platform_dir, self.lib_name)
-            relative_fat_lib_path = os.path.relpath(fat_lib_path, self.output_lib_dir)
-            install_path = os.path.join(self.build_env.output_lib_dir, relative_fat_lib_path)
+    def install_fat_lib(self, platform_dir):
+        manifest = self.read_manifest(os.path.join(platform_dir, self.manifest_name))
+        split_libs = [self.split_lib_name(label) for label in sorted(manifest['dependencies'])]
+        for filename in [self.lib_name, self.manifest_name] + split_libs:
+            install_path = self.installed_path(platform_dir, filename)
             self.build_env.make_dir(os.path.dirname(install_path))
-            shutil.copyfile(fat_lib_path, install_path)
-        self.build_env.pop_dir()
+            shutil.copyfile(os.path.join(platform_dir, filename), install_path)
 
-    def run(self):
-        all_libs = self.get_libs()
-        self.separate_architectures(all_libs)
-        self.create_fat_libs()
-        self.install()
+    def install_platform(self, platform_dir, platform, archs):
+        self.create_fat_lib(platform_dir, platform, archs)
+        self.install_fat_lib(platform_dir)
+
+    def run(self, job_slots=1):
+        pipeline = Pipeline(job_slots)
+        for stage in self.stages():
+            pipeline.add(stage)
+        pipeline.run()
 
 class Headers:
 
@@ -477,17 +3043,16 @@ class Headers:
         self.bcp_path = self.boost_source.resolve_path('dist/bin/bcp')
         self.output_src_dir = self.build_env.resolve_path('src')
 
-    def build_bcp(self):
+    def build_bcp(self, jobs=1):
         if os.path.isfile(self.bcp_path):
             print 'Found bcp: {}'.format(self.bcp_path)
         else:
             self.build_env.push_dir(self.boost_source.root)
             print 'Building bcp'
-            shell('./b2 tools/bcp')
+            shell('./b2 -j{} tools/bcp'.format(jobs))
             self.build_env.pop_dir()
         if not os.path.isfile(self.bcp_path):
-            print 'Unable to build bcp'
-            sys.exit(1)
+            raise BuildError('Unable to build bcp')
 
     def extract_headers(self):
         self.build_env.push_dir(self.boost_source.root)
@@ -497,49 +3062,622 @@ class Headers:
         shell('{} {} {}'.format(self.bcp_path, ' '.join(dependencies), self.output_src_dir))
         self.build_env.pop_dir()
 
-    def install_headers(self):
-        if os.path.isdir(self.build_env.output_src_dir):
-            shutil.rmtree(self.build_env.output_src_dir)
-        shutil.copytree(os.path.join(self.output_src_dir, 'boost'), self.build_env.output_src_dir)
+    def resolve_headers(self, jobs=1):
+        # The native alternative to bcp: copy the closure of the include graph
+        index = IncludeIndex(self.boost_source.root, self.boost_source.version, self.build_env.cache_dir)
+        index.load(jobs)
+        dependencies = BOOST_LIBS + BOOST_HEADERS
+        print 'Resolving {}'.format(', '.join(dependencies))
+        for path in index.closure(dependencies):
+            if not path.startswith('boost/'):
+                continue
+            output_path = os.path.join(self.output_src_dir, path)
+            self.build_env.make_dir(os.path.dirname(output_path))
+            shutil.copyfile(self.boost_source.resolve_path(path), output_path)
 
-    def install(self):
-        self.build_bcp()
-        self.extract_headers()
+    def install_headers(self):
+        # Headers installed by bcp that the native include graph doesn't reach
+        # are kept rather than removed
+        updated, removed, unchanged = sync_tree(os.path.join(self.output_src_dir, 'boost'),
+                                                self.build_env.output_src_dir,
+                                                self.build_env.header_sync_mode,
+                                                self.build_env.header_store,
+                                                prune=self.build_env.header_resolver != 'native')
+        print 'Installed headers: {} updated, {} removed, {} unchanged'.format(updated, removed, unchanged)
+
+    def install(self, pch=False):
+        if self.build_env.header_resolver == 'native':
+            self.resolve_headers(detect_job_slots())
+        else:
+            self.build_bcp()
+            self.extract_headers()
         self.install_headers()
+        if pch:
+            PrecompiledHeaders(self.build_env).generate(detect_job_slots())
+
+class PrecompiledHeaders:
+
+    # Consumers either add -include pch/<platform>/<arch>/boost.hpp, which picks
+    # up the precompiled header next to it, or import the module of
+    # pch/module.modulemap. The PCHs are built with the default profile's flags,
+    # which a consumer's flags must match.
+    def __init__(self, build_env):
+        self.build_env = build_env
+        self.toolchain = build_env.toolchain
+        self.include_dir = os.path.dirname(build_env.output_src_dir)
+        self.output_dir = os.path.join(os.path.dirname(build_env.output_lib_dir), PCH_DIR)
+        self.umbrella_path = os.path.join(self.output_dir, PCH_UMBRELLA_NAME)
+
+    def module_headers(self, module):
+        # A module's own header, or else every header at the top of its directory
+        if module.startswith('boost/'):
+            return [module]
+        if module in PCH_MODULE_HEADERS:
+            return PCH_MODULE_HEADERS[module]
+        for candidate in ['boost/{}.hpp'.format(module), 'boost/{}/all.hpp'.format(module)]:
+            if os.path.isfile(os.path.join(self.include_dir, candidate)):
+                return [candidate]
+        module_dir = os.path.join(self.include_dir, 'boost', module)
+        if not os.path.isdir(module_dir):
+            return []
+        return ['boost/{}/{}'.format(module, name) for name in sorted(os.listdir(module_dir)) if name.endswith('.hpp')]
+
+    def candidate_headers(self):
+        headers = []
+        for module in BOOST_LIBS + BOOST_HEADERS:
+            headers.extend([header for header in self.module_headers(module) if header not in headers])
+        return headers
+
+    def compile_command(self, platform, arch=None):
+        # The libraries' flags, which a consumer's must match for the PCH to be used
+        return '{} {} -x c++-header -I"{}"'.format(self.toolchain.program_command(platform, DEFAULT_BUILD_PROFILE, arch),
+                                                   ' '.join(COMMON_CPP_FLAGS), self.include_dir)
+
+    def parse_platform(self):
+        platform = self.toolchain.host_platform()
+        return platform if platform in self.toolchain.platforms() else self.toolchain.platforms()[0]
+
+    def measure(self, headers, jobs=1):
+        # The CPU time of parsing each header on its own, including everything it
+        # includes, or None if it doesn't parse
+        command = self.compile_command(self.parse_platform())
+        cmds = ['{} -fsyntax-only "{}"'.format(command, os.path.join(self.include_dir, header)) for header in headers]
+        commands = [Command(cmd, CommandLog(cmd, keep_output=True)) for cmd in cmds]
+        CommandRunner(jobs).run(commands, fail_fast=False)
+        costs = {}
+        for header, command in zip(headers, commands):
+            costs[header] = command.usage.get('cpu_user', 0) + command.usage.get('cpu_system', 0) if command.status == 0 else None
+        return costs
+
+    def write_report(self, costs):
+        parsed = sorted([(cost, header) for header, cost in costs.items() if cost is not None], reverse=True)
+        total = sum([cost for cost, header in parsed]) or 1
+        lines = ['# CPU seconds to parse each header on its own, with everything it includes']
+        lines.extend(['{:8.3f} {:5.1%} {}'.format(cost, cost / total, header) for cost, header in parsed])
+        lines.extend(['   failed       {}'.format(header) for header, cost in sorted(costs.items()) if cost is None])
+        with open(os.path.join(self.output_dir, 'parse-cost.txt'), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        with open(os.path.join(self.output_dir, 'parse-cost.json'), 'w') as f:
+            json.dump(costs, f, indent=2, sort_keys=True)
+        print 'Most expensive headers to parse:'
+        for cost, header in parsed[:PCH_REPORT_HEADERS]:
+            print '  {:8.3f}s {}'.format(cost, header)
+
+    def write_umbrella(self, jobs=1):
+        self.build_env.make_dir(self.output_dir)
+        headers = self.candidate_headers()
+        print 'Measuring the parse cost of {} headers'.format(len(headers))
+        costs = self.measure(headers, jobs)
+        self.write_report(costs)
+        failed = [header for header in headers if costs[header] is None]
+        if failed:
+            print 'Leaving out of {} the headers that fail to parse on their own: {}'.format(PCH_UMBRELLA_NAME, ', '.join(failed))
+        lines = ['// Generated by build.py: the installed Boost modules', '#ifndef FIFTYTHREE_BOOST_HPP', '#define FIFTYTHREE_BOOST_HPP', '']
+        lines.extend(['#include <{}>'.format(header) for header in headers if costs[header] is not None])
+        lines.extend(['', '#endif'])
+        with open(self.umbrella_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        with open(os.path.join(self.output_dir, 'module.modulemap'), 'w') as f:
+            f.write('module {} [system] {{\n    umbrella header "{}"\n    export *\n}}\n'.format(PCH_MODULE_NAME, PCH_UMBRELLA_NAME))
+
+    def pch_dir(self, platform, arch):
+        return os.path.join(self.output_dir, platform, arch)
+
+    def precompile(self, platform, arch):
+        output_dir = self.build_env.make_dir(self.pch_dir(platform, arch))
+        header_path = os.path.join(output_dir, PCH_UMBRELLA_NAME)
+        shutil.copyfile(self.umbrella_path, header_path)
+        print 'Precompiling {} for {} {}'.format(PCH_UMBRELLA_NAME, platform, arch)
+        command = self.compile_command(platform, arch)
+        shell('{} "{}" -o "{}.{}"'.format(command, header_path, header_path, self.toolchain.pch_extension()))
+        # Record the command, whose flags consumers have to match
+        with open(os.path.join(output_dir, 'flags.txt'), 'w') as f:
+            f.write(command + '\n')
+
+    def stages(self):
+        stages = [Stage('umbrella-header', self.write_umbrella, inputs=['include'], outputs=['umbrella'], elastic=True, cost=30)]
+        for platform in self.toolchain.platforms():
+            for arch in self.toolchain.architectures(platform):
+                precompile = lambda platform=platform, arch=arch: self.precompile(platform, arch)
+                stages.append(Stage('pch-{}-{}'.format(platform, arch), precompile, inputs=['umbrella'],
+                                    outputs=['pch/{}/{}'.format(platform, arch)], cost=20))
+        return stages
+
+    def generate(self, jobs=1):
+        self.write_umbrella(jobs)
+        for platform in self.toolchain.platforms():
+            for arch in self.toolchain.architectures(platform):
+                self.precompile(platform, arch)
+
+class Benchmarks:
+
+    # Each benchmark program prints one JSON line per benchmark, with its fastest
+    # time in nanoseconds per operation. The results of the last run are kept in
+    # the log dir, the baseline of each build profile in benchmarks/.
+    def __init__(self, build_env, source_dir, results_dir, threshold=BENCHMARK_THRESHOLD, save_baseline=False):
+        self.build_env = build_env
+        self.toolchain = build_env.toolchain
+        self.source_dir = source_dir
+        self.results_path = os.path.join(results_dir, 'benchmarks-{}.json'.format(build_env.build_profile))
+        self.baseline_path = os.path.join(source_dir, 'baseline-{}.json'.format(build_env.build_profile))
+        self.threshold = threshold
+        self.save_baseline = save_baseline
+        self.output_dir = self.build_env.resolve_path('benchmarks')
+
+    def sources(self):
+        return sorted([name for name in os.listdir(self.source_dir) if name.endswith('.cpp')])
+
+    def lib_path(self):
+        platform = self.toolchain.host_platform()
+        return os.path.join(self.build_env.output_lib_dir, self.toolchain.lib_dir_name(platform), 'libboost.a')
+
+    def compile(self, jobs=1):
+        platform = self.toolchain.host_platform()
+        if not os.path.isfile(self.lib_path()):
+            raise BuildError('The benchmarks need {}; build the {} platform first'.format(self.lib_path(), platform))
+        self.build_env.make_dir(self.output_dir)
+        command = self.toolchain.program_command(platform, self.build_env.build_profile)
+        include_dir = os.path.dirname(self.build_env.output_src_dir)
+        commands = []
+        for source in self.sources():
+            commands.append('{} -std={} -O2 -DNDEBUG -I"{}" -o "{}" "{}" "{}"'.format(
+                command, CPP_STD, include_dir, os.path.join(self.output_dir, os.path.splitext(source)[0]),
+                os.path.join(self.source_dir, source), self.lib_path()))
+        print 'Compiling {} benchmarks'.format(len(commands))
+        shell_outputs(commands, max_concurrency=jobs)
+
+    def run_benchmarks(self):
+        # One program at a time, so they don't compete for the cores
+        results = {}
+        for source in self.sources():
+            program = os.path.join(self.output_dir, os.path.splitext(source)[0])
+            for line in shell_output('"{}"'.format(program)).splitlines():
+                if line.startswith('{'):
+                    result = json.loads(line)
+                    results[result['name']] = result['ns_per_op']
+        return results
+
+    def read_baseline(self):
+        if not os.path.isfile(self.baseline_path):
+            return None
+        with open(self.baseline_path) as f:
+            return json.load(f)['results']
+
+    def write_results(self, path, results):
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(path, 'w') as f:
+            json.dump({
+                'profile': self.build_env.build_profile,
+                'toolchain_identity': self.toolchain.identity(),
+                'results': results,
+                }, f, indent=2, sort_keys=True)
+
+    def compare(self, results, baseline):
+        # Returns the benchmarks slower than their baseline by more than the threshold
+        regressions = []
+        for name, ns_per_op in sorted(results.items()):
+            line = '{:<32} {:>12.2f} ns/op'.format(name, ns_per_op)
+            if baseline and baseline.get(name):
+                change = ns_per_op / baseline[name] - 1
+                line += ' {:>+8.1%}'.format(change)
+                if change > self.threshold:
+                    line += ' REGRESSION'
+                    regressions.append(name)
+            print line
+        return regressions
+
+    def run(self, jobs=1):
+        self.compile(jobs)
+        results = self.run_benchmarks()
+        self.write_results(self.results_path, results)
+        if self.save_baseline:
+            self.write_results(self.baseline_path, results)
+            print 'Saved the benchmark baseline to {}'.format(self.baseline_path)
+            baseline = None
+        else:
+            baseline = self.read_baseline()
+            if baseline is None:
+                print 'No benchmark baseline in {}; save one with --save-benchmark-baseline'.format(self.baseline_path)
+        regressions = self.compare(results, baseline)
+        if regressions:
+            raise BuildError('{} benchmarks regressed by more than {:.0%}: {}'.format(len(regressions), self.threshold, ', '.join(regressions)))
 
 #-------------------------------------------------------------------------------
 #
-# Main
+# Pipeline
 #
 #-------------------------------------------------------------------------------
 
-if __name__ == '__main__': 
-    
-    # Prepare the build folder
-    build_env = BuildEnv(os.getcwd())
-    build_env.prepare()
-
-    # Download and unpack the boost source
-    boost_source = BoostSource(build_env, BOOST_VERSION)
-    boost_source.setup()
-
-    # Define the targets for each platform
-    tasks = {
-        "ios": ['stage', 'install'],
-        "simulator": ['stage'],
-        "osx": ['stage'],
-    }
-
-    # Build each platform's targets
-    for platform in PLATFORMS:
-        for target in tasks[platform]:
-            BuildTask(build_env, boost_source, platform, target).run()
+# Every step of the build is a Stage with declared inputs and outputs. Inputs and
+# outputs are artifact names; a stage depends on whichever stages produce its
+# inputs. The Pipeline starts each stage in its own process as soon as those
+# producers have finished, so anything that isn't ordered by data runs in parallel.
+#
+# Stages draw from a shared budget of job slots. A plain stage uses one slot. An
+# elastic stage (a b2 invocation) is started with a share of the free slots and
+# receives that number as its `jobs` argument.
+
+class Stage:
+
+    def __init__(self, name, action, inputs=(), outputs=(), elastic=False, cost=1):
+        self.name = name
+        self.action = action
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.elastic = elastic
+        # Rough duration in seconds, only used to plan the critical path
+        self.cost = cost
+
+    def run(self, jobs, trace_path=None):
+        # The pipeline stops a stage with SIGTERM; turning that into an exception
+        # lets the stage cancel the commands it's running.
+        signal.signal(signal.SIGTERM, raise_cancelled)
+        open_task_log(self.name)
+        start_tracer(self.name)
+        started = time.time()
+        status = 'failed'
+        try:
+            if self.elastic:
+                self.action(jobs)
+            else:
+                self.action()
+            status = 'ok'
+        except BuildError as e:
+            print '{}: {}'.format(self.name, e)
+            sys.exit(1)
+        finally:
+            if trace_path:
+                args = {'jobs': jobs, 'status': status}
+                args.update(process_rusage())
+                TRACER.add(self.name, 'stage', started, time.time(), args=args)
+                TRACER.save(trace_path)
+
+class Pipeline:
+
+    def __init__(self, job_slots, profile=None):
+        self.job_slots = job_slots
+        self.stages = []
+        # A BuildProfile to record the run in
+        self.profile = profile
+        self.summary = None
+
+    def add(self, stage):
+        self.stages.append(stage)
+        return stage
+
+    def producers(self):
+        producers = {}
+        for stage in self.stages:
+            for output in stage.outputs:
+                if output in producers:
+                    raise BuildError('Both {} and {} produce {}'.format(producers[output].name, stage.name, output))
+                producers[output] = stage
+        return producers
+
+    def dependencies(self):
+        # Inputs nobody produces are expected to exist before the pipeline runs.
+        producers = self.producers()
+        dependencies = {}
+        for stage in self.stages:
+            deps = []
+            for input in stage.inputs:
+                producer = producers.get(input)
+                if producer and producer not in deps:
+                    deps.append(producer)
+            dependencies[stage] = deps
+        return dependencies
+
+    def ordered_stages(self):
+        dependencies = self.dependencies()
+        ordered = []
+        remaining = list(self.stages)
+        while remaining:
+            ready = [stage for stage in remaining if all([dep in ordered for dep in dependencies[stage]])]
+            if not ready:
+                raise BuildError('Cycle between stages: {}'.format(', '.join([stage.name for stage in remaining])))
+            ordered.extend(ready)
+            remaining = [stage for stage in remaining if stage not in ready]
+        return ordered
+
+    def critical_path(self, durations=None):
+        # Longest chain of dependent stages, weighted by duration (or estimated cost).
+        dependencies = self.dependencies()
+        finish = {}
+        previous = {}
+        for stage in self.ordered_stages():
+            duration = durations.get(stage.name, stage.cost) if durations else stage.cost
+            start = 0
+            for dep in dependencies[stage]:
+                if finish[dep] > start:
+                    start = finish[dep]
+                    previous[stage] = dep
+            finish[stage] = start + duration
+        if not finish:
+            return [], 0
+        stage = max(finish, key=lambda s: finish[s])
+        total = finish[stage]
+        path = [stage]
+        while stage in previous:
+            stage = previous[stage]
+            path.insert(0, stage)
+        return path, total
+
+    def print_plan(self):
+        dependencies = self.dependencies()
+        print 'Build plan ({} stages, {} job slots):'.format(len(self.stages), self.job_slots)
+        for stage in self.ordered_stages():
+            deps = ', '.join([dep.name for dep in dependencies[stage]]) or '-'
+            print '  {:<28} after {}'.format(stage.name, deps)
+        # Estimate with the durations of the last run where there are any
+        durations = self.profile.previous_durations() if self.profile else {}
+        path, total = self.critical_path(durations)
+        print 'Critical path (~{:.0f}s estimated): {}'.format(total, ' -> '.join([stage.name for stage in path]))
+
+    def start(self, stage, jobs):
+        print 'Starting {}'.format(stage.name)
+        trace_path = self.profile.stage_trace_path(stage.name) if self.profile else None
+        worker = multiprocessing.Process(target=stage.run, args=(jobs, trace_path), name=stage.name)
+        worker.start()
+        return worker
+
+    def stop(self, running):
+        for worker, stage, jobs, started in running:
+            worker.terminate()
+        for worker, stage, jobs, started in running:
+            worker.join()
 
-    # Package and install the fat libs
-    Packager(build_env, boost_source).run()
+    def run(self):
+        if self.profile:
+            self.profile.reset()
+        started = time.time()
+        durations = {}
+        try:
+            self.run_stages(durations)
+        finally:
+            if self.profile:
+                self.summary = self.profile.write(self, durations, started, time.time())
+
+    def run_stages(self, durations):
+        dependencies = self.dependencies()
+        pending = self.ordered_stages()
+        running = []
+        finished = set()
+        free = self.job_slots
+        while pending or running:
+            ready = [stage for stage in pending if all([dep in finished for dep in dependencies[stage]])]
+            for stage in [stage for stage in ready if not stage.elastic]:
+                if free < 1 and running:
+                    break
+                running.append((self.start(stage, 1), stage, 1, time.time()))
+                pending.remove(stage)
+                free -= 1
+            elastic = [stage for stage in ready if stage.elastic]
+            if elastic and (free > 0 or not running):
+                elastic = elastic[:max(1, free)]
+                for stage, jobs in zip(elastic, split_job_slots(max(1, free), len(elastic))):
+                    running.append((self.start(stage, jobs), stage, jobs, time.time()))
+                    pending.remove(stage)
+                    free -= jobs
+            time.sleep(0.1)
+            for entry in list(running):
+                worker, stage, jobs, started = entry
+                if worker.is_alive():
+                    continue
+                worker.join()
+                running.remove(entry)
+                free += jobs
+                if worker.exitcode != 0:
+                    self.stop(running)
+                    raise BuildError('{} failed, stopped the build'.format(stage.name))
+                finished.add(stage)
+                durations[stage.name] = time.time() - started
+                print 'Finished {} in {:.1f}s'.format(stage.name, durations[stage.name])
 
-    # Install the required headers using bcp
-    Headers(build_env, boost_source).install()
+#-------------------------------------------------------------------------------
+#
+# Main
+#
+#-------------------------------------------------------------------------------
 
-    # Remove build artifacts
-    build_env.cleanup()
+def create_pipeline(build_env, boost_source, job_slots, tasks, profile=None, size_report=None, benchmarks=None, training=None):
+    pipeline = Pipeline(job_slots, profile)
+
+    # Download and extract the boost source in one pass
+    pipeline.add(Stage('fetch', boost_source.fetch, outputs=['source'], cost=60))
+    pipeline.add(Stage('invent-headers', boost_source.invent_missing_headers, inputs=['source'], outputs=['missing-headers']))
+    pipeline.add(Stage('bootstrap', boost_source.bootstrap, inputs=['source'], outputs=['b2'], cost=30))
+    pipeline.add(Stage('config', boost_source.create_config, inputs=['source'], outputs=['user-config']))
+
+    # Package each architecture as soon as its platform's stage dir is ready
+    consumers = []
+    staged_platforms = [platform for platform, targets in tasks.items() if 'stage' in targets]
+    consumers.extend(Packager(build_env, boost_source).stages(staged_platforms, size_report))
+
+    # Install the required headers, using bcp or the native include graph; this
+    # only needs the source
+    headers = Headers(build_env, boost_source)
+    if build_env.header_resolver == 'native':
+        consumers.append(Stage('resolve-headers', headers.resolve_headers, inputs=['source'], outputs=['headers'], elastic=True, cost=10))
+    else:
+        consumers.append(Stage('build-bcp', headers.build_bcp, inputs=['b2'], outputs=['bcp'], elastic=True, cost=120))
+        consumers.append(Stage('extract-headers', headers.extract_headers, inputs=['bcp'], outputs=['headers'], cost=30))
+    consumers.append(Stage('install-headers', headers.install_headers, inputs=['headers'], outputs=['include'], cost=5))
+    if build_env.pch:
+        consumers.extend(PrecompiledHeaders(build_env).stages())
+
+    # A PGO build first trains on instrumented libs of the host platform
+    build_inputs = ['b2', 'user-config', 'missing-headers']
+    if training:
+        pipeline.add(Stage('pgo-instrument', training.build_instrumented, inputs=build_inputs, outputs=['pgo-instrumented'], elastic=True, cost=300))
+        pipeline.add(Stage('pgo-train', training.train, inputs=['pgo-instrumented'], outputs=['pgo-profile'], cost=60))
+        build_inputs = build_inputs + ['pgo-profile']
+
+    # Build each platform's targets in one b2 pass. Targets whose output no later
+    # stage reads are pruned, unless they were selected explicitly.
+    consumed = set([name for stage in consumers for name in stage.inputs])
+    requested = build_env.selection.targets or []
+    for platform in build_env.toolchain.platforms():
+        targets = []
+        for target in tasks.get(platform, []):
+            if '{}/{}'.format(target, platform) in consumed or target in requested:
+                targets.append(target)
+            else:
+                print 'Pruning the {} target on {}: nothing uses its output'.format(target, platform)
+        if not targets:
+            continue
+        run = lambda jobs, platform=platform, targets=targets: BuildTask(build_env, boost_source, platform, targets, jobs).run()
+        outputs = ['{}/{}'.format(target, platform) for target in targets]
+        pipeline.add(Stage('build-{}'.format(platform), run, inputs=build_inputs, outputs=outputs, elastic=True, cost=300))
+    for stage in consumers:
+        pipeline.add(stage)
+
+    # Remove build artifacts once every final output is done
+    consumed = set()
+    for stage in pipeline.stages:
+        consumed.update(stage.inputs)
+    final_outputs = [output for stage in pipeline.stages for output in stage.outputs if output not in consumed]
+
+    # Benchmark the installed headers and libs once everything else is done,
+    # so nothing competes with them for the cores
+    if benchmarks:
+        pipeline.add(Stage('benchmark', benchmarks.run, inputs=final_outputs, outputs=['benchmarks'], elastic=True, cost=60))
+        final_outputs = ['benchmarks']
+    pipeline.add(Stage('cleanup', build_env.cleanup, inputs=final_outputs))
+
+    return pipeline
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Build the Boost static libraries and headers for iOS and OS X.')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='Total number of compile jobs shared by all stages (default: detected from cores and memory)')
+    parser.add_argument('-n', '--dry-run', action='store_true', help='Print the build plan and its critical path without running it')
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help='Directory of the persistent artifact and source caches (default: %(default)s)')
+    parser.add_argument('--cache-size', type=int, default=CACHE_SIZE_MB, help='Artifact cache size limit in MB (default: %(default)s)')
+    parser.add_argument('--no-cache', action='store_true', help='Neither restore from nor store to the artifact cache')
+    parser.add_argument('--rebuild', action='store_true', help='Rebuild everything, refreshing the artifact cache')
+    parser.add_argument('--config', default=None,
+                        help='JSON file selecting what to build, with any of the keys {}'.format(', '.join(SELECTION_KEYS)))
+    parser.add_argument('--platforms', type=lambda value: value.split(','), default=None,
+                        help='Comma-separated platforms to build; the others keep their installed slices (default: all)')
+    parser.add_argument('--archs', type=lambda value: value.split(','), default=None,
+                        help='Comma-separated architectures to build; the others keep their installed slices (default: all)')
+    parser.add_argument('--libs', type=lambda value: value.split(','), default=None,
+                        help='Comma-separated libraries to build; the others keep their installed members (default: {})'.format(','.join(BOOST_LIBS)))
+    parser.add_argument('--targets', type=lambda value: value.split(','), default=None,
+                        help='Comma-separated b2 targets to run, of {} (default: all)'.format(', '.join(TARGETS)))
+    parser.add_argument('--build-profile', choices=BUILD_PROFILES, default=DEFAULT_BUILD_PROFILE,
+                        help='Compiler optimization profile; profiles other than the default install into lib-<profile> (default: %(default)s)')
+    parser.add_argument('--pgo-training-command', default=None,
+                        help='Command to train the pgo profile with instead of {}; it finds the instrumented libs in '
+                             '$BOOST_INSTRUMENTED_LIB_DIR and the headers in $BOOST_INCLUDE_DIR'.format(PGO_TRAINING_SOURCE))
+    parser.add_argument('--toolchain', choices=TOOLCHAINS, default=DEFAULT_TOOLCHAIN, help='Toolchain backend to build with (default: %(default)s)')
+    parser.add_argument('--compiler', choices=sorted(LINUX_COMPILERS), default=None,
+                        help='Compiler of the linux toolchain (default: clang if installed, gcc otherwise)')
+    parser.add_argument('--sysroot', default=None, help='Sysroot of the linux toolchain\'s cross targets')
+    parser.add_argument('--cross-target', action='append', default=[], metavar='TRIPLE',
+                        help='Also build for this target triple with the linux toolchain, e.g. aarch64-linux-gnu (repeatable)')
+    parser.add_argument('--header-resolver', choices=['bcp', 'native'], default='bcp',
+                        help='Find the required headers with bcp or with the cached native include graph (default: %(default)s)')
+    parser.add_argument('--header-sync', choices=SYNC_MODES, default='copy',
+                        help='How changed headers are placed in include/boost (default: %(default)s)')
+    parser.add_argument('--pch', action='store_true',
+                        help='Generate an umbrella header of the installed modules, precompile it for every platform and arch '
+                             'into {}/ and report the parse cost of each header'.format(PCH_DIR))
+    parser.add_argument('--header-store', default=None,
+                        help='Content-addressed store for hardlinked or cloned headers (default: headers in the cache dir)')
+    parser.add_argument('--source-cache-size', type=int, default=SOURCE_CACHE_SIZE_MB, help='Source cache size limit in MB (default: %(default)s)')
+    parser.add_argument('--no-source-cache', action='store_true', help='Download and extract the Boost source into the build dir instead of the shared source cache')
+    parser.add_argument('--source-url', default=None, help='URL of the Boost tarball, e.g. of a mirror (default: SourceForge)')
+    parser.add_argument('--minimal-source', action='store_true',
+                        help='Only extract the parts of the Boost source the build uses (needs --header-resolver native)')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='Build and run the benchmarks in benchmarks/ after the build, failing on regressions against the baseline')
+    parser.add_argument('--benchmark-threshold', type=float, default=BENCHMARK_THRESHOLD,
+                        help='Slowdown against the baseline that fails the benchmarks (default: %(default)s)')
+    parser.add_argument('--save-benchmark-baseline', action='store_true', help='Run the benchmarks and save their results as the baseline')
+    parser.add_argument('--profile', action='store_true', help='Print the slowest commands and the critical path after the build')
+    parser.add_argument('--log-dir', default=os.path.join(os.getcwd(), 'logs'), help='Directory of the per-stage command logs (default: %(default)s)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Print the output of every command')
+    args = parser.parse_args()
+    if args.minimal_source and args.header_resolver != 'native':
+        parser.error('--minimal-source needs --header-resolver native: bcp would install fewer headers from the trimmed source')
+    VERBOSE = args.verbose
+    LOG_DIR = args.log_dir
+    # A dry run writes nothing, its log included
+    if not args.dry_run:
+        open_task_log('build')
+
+    try:
+        build_env = BuildEnv(os.getcwd())
+        build_env.toolchain = create_toolchain(args.toolchain, args.cache_dir, args.compiler, args.sysroot, args.cross_target)
+        build_env.selection = load_selection(args.config, args.platforms, args.archs, args.libs, args.targets)
+        build_env.toolchain.select(build_env.selection.platforms, build_env.selection.archs)
+        build_env.build_profile = args.build_profile
+        if args.build_profile != DEFAULT_BUILD_PROFILE:
+            build_env.output_lib_dir = os.path.join(os.getcwd(), 'lib-{}'.format(args.build_profile))
+        build_env.artifact_cache = ArtifactCache(args.cache_dir, args.cache_size, enabled=not args.no_cache, rebuild=args.rebuild)
+        build_env.cache_dir = args.cache_dir
+        build_env.header_resolver = args.header_resolver
+        build_env.header_sync_mode = args.header_sync
+        build_env.header_store = args.header_store or os.path.join(args.cache_dir, 'headers')
+        build_env.pch = args.pch
+        boost_source = BoostSource(build_env, BOOST_VERSION)
+        boost_source.tarball_url = args.source_url or boost_source.tarball_url
+        boost_source.minimal = args.minimal_source
+        if not args.no_source_cache:
+            boost_source.source_cache = SourceCache(args.cache_dir, args.source_cache_size)
+
+        # The selected targets for each platform
+        tasks = build_env.selection.select_tasks(build_env.toolchain.tasks(), build_env.toolchain.platforms())
+
+        # Every run is traced into the log dir
+        profile = BuildProfile(os.path.join(LOG_DIR, 'trace'))
+        size_report = SizeReport(LOG_DIR, args.build_profile)
+        benchmarks = None
+        if args.benchmark or args.save_benchmark_baseline:
+            benchmarks = Benchmarks(build_env, os.path.join(os.getcwd(), 'benchmarks'), LOG_DIR,
+                                    args.benchmark_threshold, args.save_benchmark_baseline)
+        training = None
+        if args.build_profile == 'pgo':
+            training = ProfileTraining(build_env, boost_source, os.path.join(os.getcwd(), PGO_TRAINING_SOURCE), args.pgo_training_command)
+        pipeline = create_pipeline(build_env, boost_source, args.jobs or detect_job_slots(), tasks, profile, size_report, benchmarks, training)
+        if args.dry_run:
+            pipeline.print_plan()
+            sys.exit(0)
+
+        # Prepare the build folder and run every stage
+        build_env.prepare()
+        # Probe the toolchain (or load the cached probe) once, before the stages
+        # fork, so each of them inherits it
+        build_env.toolchain.info()
+        try:
+            pipeline.run()
+        finally:
+            if args.profile and pipeline.summary:
+                profile.print_report(pipeline.summary)
+    except BuildError as e:
+        print e
+        sys.exit(1)
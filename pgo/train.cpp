@@ -0,0 +1,136 @@
+// The PGO training workload: exercises the parts of Boost.Thread, Boost.Chrono
+// and Boost.System our apps use most, against the instrumented libs.
+
+#include <boost/chrono.hpp>
+#include <boost/system/error_code.hpp>
+#include <boost/thread.hpp>
+
+#include <cstdio>
+#include <deque>
+
+namespace {
+
+const int THREADS = 4;
+const int ITEMS = 20000;
+
+// A producer/consumer queue: mutex, condition variables and notifications
+class Queue
+{
+public:
+    void push(int item)
+    {
+        {
+            boost::unique_lock<boost::mutex> lock(mutex_);
+            items_.push_back(item);
+        }
+        ready_.notify_one();
+    }
+
+    int pop()
+    {
+        boost::unique_lock<boost::mutex> lock(mutex_);
+        while (items_.empty()) {
+            ready_.wait(lock);
+        }
+        int item = items_.front();
+        items_.pop_front();
+        return item;
+    }
+
+private:
+    boost::mutex mutex_;
+    boost::condition_variable ready_;
+    std::deque<int> items_;
+};
+
+void produce(Queue& queue)
+{
+    for (int i = 0; i < ITEMS; ++i) {
+        queue.push(i);
+    }
+}
+
+void consume(Queue& queue, long& sum)
+{
+    for (int i = 0; i < ITEMS; ++i) {
+        sum += queue.pop();
+    }
+}
+
+// Readers and writers of a shared_mutex, timing themselves with every clock
+void read_and_write(boost::shared_mutex& mutex, long& value, boost::chrono::nanoseconds& elapsed)
+{
+    for (int i = 0; i < ITEMS; ++i) {
+        boost::chrono::steady_clock::time_point start = boost::chrono::steady_clock::now();
+        if (i % 8 == 0) {
+            boost::unique_lock<boost::shared_mutex> lock(mutex);
+            ++value;
+        } else {
+            boost::shared_lock<boost::shared_mutex> lock(mutex);
+            elapsed += boost::chrono::nanoseconds(value % 2);
+        }
+        elapsed += boost::chrono::steady_clock::now() - start;
+        boost::chrono::system_clock::now();
+        boost::chrono::high_resolution_clock::now();
+    }
+}
+
+void wait_with_timeouts()
+{
+    boost::mutex mutex;
+    boost::condition_variable never;
+    boost::unique_lock<boost::mutex> lock(mutex);
+    for (int i = 0; i < 100; ++i) {
+        never.wait_for(lock, boost::chrono::microseconds(10));
+        boost::this_thread::sleep_for(boost::chrono::microseconds(10));
+        boost::this_thread::yield();
+    }
+}
+
+void use_error_codes(long& count)
+{
+    for (int i = 0; i < ITEMS; ++i) {
+        boost::system::error_code error(i % 64, boost::system::generic_category());
+        if (error && error.category() == boost::system::generic_category()) {
+            count += error.message().size();
+        }
+        boost::system::error_code system_error(i % 64, boost::system::system_category());
+        count += system_error.default_error_condition().value();
+    }
+}
+
+} // namespace
+
+int main()
+{
+    Queue queue;
+    long sums[THREADS] = {};
+    boost::thread_group group;
+    for (int i = 0; i < THREADS; ++i) {
+        group.create_thread(boost::bind(produce, boost::ref(queue)));
+        group.create_thread(boost::bind(consume, boost::ref(queue), boost::ref(sums[i])));
+    }
+    group.join_all();
+
+    boost::shared_mutex shared;
+    long value = 0;
+    boost::chrono::nanoseconds elapsed[THREADS];
+    boost::thread_group readers;
+    for (int i = 0; i < THREADS; ++i) {
+        elapsed[i] = boost::chrono::nanoseconds(0);
+        readers.create_thread(boost::bind(read_and_write, boost::ref(shared), boost::ref(value), boost::ref(elapsed[i])));
+    }
+    readers.join_all();
+
+    boost::thread waiter(wait_with_timeouts);
+    waiter.join();
+
+    long count = 0;
+    use_error_codes(count);
+
+    boost::chrono::thread_clock::now();
+    boost::chrono::process_cpu_clock::now();
+
+    std::printf("Trained on %d threads: %ld, %ld, %ld\n", THREADS * 2, sums[0], value, count);
+    return 0;
+}
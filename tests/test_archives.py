@@ -0,0 +1,278 @@
+from distutils.spawn import find_executable
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import build
+
+# The tools are found on PATH; tests whose tools are missing are skipped
+AR = find_executable('ar')
+NM = find_executable('nm')
+CC = find_executable('gcc')
+LLVM_AR = find_executable('llvm-ar')
+LLVM_NM = find_executable('llvm-nm')
+LLVM_MC = find_executable('llvm-mc')
+LLVM_LIPO = find_executable('llvm-lipo')
+
+def armap(output):
+    # The (symbol, member) pairs of `nm -s` (Archive index:) or
+    # `llvm-nm --print-armap` (Archive map) output
+    entries = []
+    lines = output.splitlines()
+    start = [i for i, line in enumerate(lines) if line in ('Archive index:', 'Archive map')][0]
+    for line in lines[start + 1:]:
+        if not line:
+            break
+        symbol, member = line.split(' in ')
+        entries.append((symbol, member))
+    return sorted(entries)
+
+class ArchiveTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, *names):
+        return os.path.join(self.dir, *names)
+
+    def run_tool(self, *args):
+        return subprocess.check_output(args, cwd=self.dir)
+
+#-------------------------------------------------------------------------------
+#
+# GNU archives
+#
+#-------------------------------------------------------------------------------
+
+# {library: {member: source}}. Both libraries have a different common.o, and
+# the same shared.o.
+ELF_LIBRARIES = {
+    'a': {
+        'common.o': 'int a_common(void) { return 1; }\n',
+        'a.o': 'int b_value(void);\nint a_value(void) { return 10 + b_value(); }\n',
+        'shared.o': 'int shared_value(void) { return 100; }\n',
+    },
+    'b': {
+        'common.o': 'int b_common(void) { return 1000; }\nint b_data = 5;\n',
+        'b.o': 'int b_value(void) { return 10000; }\n',
+        'shared.o': 'int shared_value(void) { return 100; }\n',
+        'a_long_member_name.o': 'int b_long(void) { return 100000; }\n',
+    },
+}
+
+MAIN_SOURCE = '''#include <stdio.h>
+int a_common(void); int a_value(void); int shared_value(void);
+int b_common(void); int b_long(void); extern int b_data;
+int main(void) {
+    printf("%d\\n", a_common() + a_value() + shared_value() + b_common() + b_long() + b_data);
+    return 0;
+}
+'''
+MAIN_OUTPUT = '{}\n'.format(1 + 10 + 10000 + 100 + 1000 + 100000 + 5)
+
+@unittest.skipUnless(AR and NM and CC, 'needs ar, nm and gcc on PATH')
+class GnuArchiveTest(ArchiveTestCase):
+
+    def make_library(self, label):
+        library_dir = self.path(label)
+        os.mkdir(library_dir)
+        members = sorted(ELF_LIBRARIES[label])
+        for member in members:
+            source = os.path.join(library_dir, member.replace('.o', '.c'))
+            with open(source, 'w') as f:
+                f.write(ELF_LIBRARIES[label][member])
+            self.run_tool(CC, '-c', '-fPIC', source, '-o', os.path.join(library_dir, member))
+        path = self.path('libboost_{}.a'.format(label))
+        self.run_tool(AR, 'rcs', path, *[os.path.join(library_dir, member) for member in members])
+        return path
+
+    def assert_links(self, *archives):
+        with open(self.path('main.c'), 'w') as f:
+            f.write(MAIN_SOURCE)
+        self.run_tool(CC, self.path('main.c'), *(list(archives) + ['-o', self.path('main')]))
+        self.assertEqual(self.run_tool(self.path('main')), MAIN_OUTPUT)
+
+    def test_merge(self):
+        paths = [self.make_library('a'), self.make_library('b')]
+        merged = self.path('merged.a')
+        indexed, labels = build.merge_archives(merged, paths, format='gnu')
+        self.assertTrue(indexed)
+        self.assertEqual(labels, {
+            'a': ['a.o', 'common.o', 'shared.o'],
+            'b': ['a_long_member_name.o', 'b.o', 'b_common.o'],
+        })
+        self.assertEqual(self.run_tool(AR, 't', merged).split(),
+                         ['a.o', 'common.o', 'shared.o', 'a_long_member_name.o', 'b.o', 'b_common.o'])
+        self.assertEqual(armap(self.run_tool(NM, '-s', merged)), sorted([
+            ('a_value', 'a.o'),
+            ('a_common', 'common.o'),
+            ('shared_value', 'shared.o'),
+            ('b_long', 'a_long_member_name.o'),
+            ('b_value', 'b.o'),
+            ('b_common', 'b_common.o'),
+            ('b_data', 'b_common.o'),
+        ]))
+        # The renamed member is the original object
+        with open(os.path.join(self.path('b'), 'common.o'), 'rb') as f:
+            self.assertEqual(self.run_tool(AR, 'p', merged, 'b_common.o'), f.read())
+        self.assert_links(merged)
+
+    def test_read_system_archive(self):
+        path = self.make_library('b')
+        with build.Archive(path) as archive:
+            names = [member.name for member in archive.members]
+            self.assertEqual(names, sorted(ELF_LIBRARIES['b']))
+            for member in archive.members:
+                with open(os.path.join(self.path('b'), member.name), 'rb') as f:
+                    self.assertEqual(str(member.data), f.read())
+            symbols = dict([(member.name, sorted(build.object_symbols(member.data))) for member in archive.members])
+        self.assertEqual(symbols['common.o'], ['b_common', 'b_data'])
+        with build.Archive(path) as archive:
+            a = [member for member in archive.members if member.name == 'b.o'][0]
+            self.assertEqual(build.object_symbols(a.data, undefined=True), [])
+
+    def test_split(self):
+        paths = [self.make_library('a'), self.make_library('b')]
+        merged = self.path('merged.a')
+        indexed, labels = build.merge_archives(merged, paths, format='gnu')
+        outputs = {'a': self.path('split_a.a'), 'b': self.path('split_b.a')}
+        self.assertEqual(build.split_archive(merged, labels, outputs, format='gnu'), [])
+        for label, path in outputs.items():
+            self.assertEqual(sorted(self.run_tool(AR, 't', path).split()), labels[label])
+            self.assertEqual(armap(self.run_tool(NM, '-s', path)),
+                             sorted([entry for entry in armap(self.run_tool(NM, '-s', merged)) if entry[1] in labels[label]]))
+        self.assertEqual(build.archive_dependencies(outputs), {'a': ['b'], 'b': []})
+        self.assert_links(outputs['a'], outputs['b'])
+
+    def test_merge_onto_base(self):
+        paths = [self.make_library('a'), self.make_library('b')]
+        base = self.path('base.a')
+        indexed, base_labels = build.merge_archives(base, paths, format='gnu')
+        # Replace b on top of the merged archive, keeping a's members
+        merged = self.path('merged.a')
+        indexed, labels = build.merge_archives(merged, [paths[1]], format='gnu',
+                                               base_path=base, base_labels={'a': base_labels['a']})
+        self.assertEqual(labels, base_labels)
+        self.assertEqual(self.run_tool(AR, 't', merged), self.run_tool(AR, 't', base))
+        self.assert_links(merged)
+
+#-------------------------------------------------------------------------------
+#
+# Darwin archives
+#
+#-------------------------------------------------------------------------------
+
+MACHO_LIBRARIES = {
+    'a': {
+        'common.o': '.globl _a_common\n_a_common:\n ret\n',
+        'a.o': '.globl _a_value\n_a_value:\n call _b_value\n ret\n',
+    },
+    'b': {
+        'common.o': '.globl _b_common\n_b_common:\n ret\n.globl _b_other\n_b_other:\n ret\n',
+        'b.o': '.globl _b_value\n_b_value:\n ret\n',
+        'a_long_member_name.o': '.globl _b_long\n_b_long:\n ret\n',
+    },
+}
+
+@unittest.skipUnless(LLVM_AR and LLVM_NM and LLVM_MC, 'needs llvm-ar, llvm-nm and llvm-mc on PATH')
+class DarwinArchiveTest(ArchiveTestCase):
+
+    def make_library(self, label, arch='x86_64'):
+        library_dir = self.path('{}-{}'.format(label, arch))
+        os.mkdir(library_dir)
+        triple = {'x86_64': 'x86_64-apple-macos10.13', 'arm64': 'arm64-apple-ios11'}[arch]
+        members = sorted(MACHO_LIBRARIES[label])
+        for member in members:
+            source = os.path.join(library_dir, member.replace('.o', '.s'))
+            with open(source, 'w') as f:
+                f.write(MACHO_LIBRARIES[label][member].replace('call', 'bl' if arch == 'arm64' else 'call'))
+            self.run_tool(LLVM_MC, '-triple', triple, '-filetype=obj', source, '-o', os.path.join(library_dir, member))
+        if not os.path.isdir(self.path(arch)):
+            os.mkdir(self.path(arch))
+        path = self.path(arch, 'libboost_{}.a'.format(label))
+        self.run_tool(LLVM_AR, '--format=darwin', 'rcs', path, *[os.path.join(library_dir, member) for member in members])
+        return path
+
+    def expected_armap(self):
+        return sorted([
+            ('_a_value', 'a.o'),
+            ('_a_common', 'common.o'),
+            ('_b_long', 'a_long_member_name.o'),
+            ('_b_value', 'b.o'),
+            ('_b_common', 'b_common.o'),
+            ('_b_other', 'b_common.o'),
+        ])
+
+    def test_merge(self):
+        paths = [self.make_library('a'), self.make_library('b')]
+        merged = self.path('merged.a')
+        indexed, labels = build.merge_archives(merged, paths, format='bsd')
+        self.assertTrue(indexed)
+        self.assertEqual(self.run_tool(LLVM_AR, 't', merged).split(),
+                         ['a.o', 'common.o', 'a_long_member_name.o', 'b.o', 'b_common.o'])
+        self.assertEqual(armap(self.run_tool(LLVM_NM, '--print-armap', merged)), self.expected_armap())
+        with open(os.path.join(self.path('b-x86_64'), 'common.o'), 'rb') as f:
+            self.assertEqual(self.run_tool(LLVM_AR, 'p', merged, 'b_common.o'), f.read())
+        # The members of the merged archive start on an 8 byte boundary
+        with build.Archive(merged) as archive:
+            for member in archive.members:
+                self.assertEqual(archive.map.find(str(member.data)) % 8, 0)
+        self.assertEqual(build.archive_dependencies({'merged': merged}), {'merged': []})
+
+    def make_fat_library(self, label):
+        slices = [self.make_library(label, 'x86_64'), self.make_library(label, 'arm64')]
+        path = self.path('libboost_{}.a'.format(label))
+        self.run_tool(LLVM_LIPO, '-create', slices[0], slices[1], '-output', path)
+        return path
+
+    @unittest.skipUnless(LLVM_LIPO, 'needs llvm-lipo on PATH')
+    def test_merge_fat_slice(self):
+        paths = [self.make_fat_library('a'), self.make_fat_library('b')]
+        merged = self.path('merged.a')
+        indexed, labels = build.merge_archives(merged, paths, arch='arm64', format='bsd')
+        self.assertTrue(indexed)
+        self.assertEqual(armap(self.run_tool(LLVM_NM, '--print-armap', merged)), self.expected_armap())
+        with open(os.path.join(self.path('a-arm64'), 'a.o'), 'rb') as f:
+            self.assertEqual(self.run_tool(LLVM_AR, 'p', merged, 'a.o'), f.read())
+        self.assertRaises(build.ArchiveError, build.merge_archives, merged, paths, arch='armv7', format='bsd')
+
+    @unittest.skipUnless(LLVM_LIPO, 'needs llvm-lipo on PATH')
+    def test_fat_dependencies(self):
+        # Like the instrumented libs of a PGO build on OS X
+        paths = {'a': self.make_fat_library('a'), 'b': self.make_fat_library('b')}
+        for arch in ['x86_64', 'arm64']:
+            self.assertEqual(build.archive_dependencies(paths, arch), {'a': ['b'], 'b': []})
+        self.assertRaises(build.ArchiveError, build.archive_dependencies, paths)
+
+    def test_split(self):
+        paths = [self.make_library('a'), self.make_library('b')]
+        merged = self.path('merged.a')
+        indexed, labels = build.merge_archives(merged, paths, format='bsd')
+        outputs = {'a': self.path('split_a.a'), 'b': self.path('split_b.a')}
+        self.assertEqual(build.split_archive(merged, labels, outputs, format='bsd'), [])
+        for label, path in outputs.items():
+            self.assertEqual(sorted(self.run_tool(LLVM_AR, 't', path).split()), labels[label])
+            self.assertEqual(armap(self.run_tool(LLVM_NM, '--print-armap', path)),
+                             [entry for entry in self.expected_armap() if entry[1] in labels[label]])
+        self.assertEqual(build.archive_dependencies(outputs), {'a': ['b'], 'b': []})
+
+    def test_unreadable_member(self):
+        path = self.make_library('b')
+        # Not an object, like LLVM bitcode
+        with open(self.path('notes.o'), 'w') as f:
+            f.write('x' * 100)
+        self.run_tool(LLVM_AR, '--format=darwin', 'q', path, self.path('notes.o'))
+        merged = self.path('merged.a')
+        indexed, labels = build.merge_archives(merged, [path], format='bsd')
+        self.assertFalse(indexed)
+        self.assertIn('notes.o', self.run_tool(LLVM_AR, 't', merged).split())
+
+if __name__ == '__main__':
+    unittest.main()
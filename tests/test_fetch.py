@@ -0,0 +1,198 @@
+import BaseHTTPServer
+import hashlib
+import io
+import os
+import random
+import re
+import shutil
+import SocketServer
+import sys
+import tarfile
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import build
+
+def random_bytes(seed, size):
+    generator = random.Random(seed)
+    return ''.join([chr(generator.getrandbits(8)) for i in range(size)])
+
+# Incompressible, so the tarball spans several FETCH_CHUNK_SIZE reads
+FILES = {
+    'boost/config.hpp': '#define BOOST_CONFIG\n',
+    'boost/data.bin': random_bytes(1, 200),
+    'libs/thread/src/once.cpp': random_bytes(2, 3 * build.FETCH_CHUNK_SIZE),
+    'doc/index.html': '<html></html>\n',
+}
+
+def make_tarball():
+    data = io.BytesIO()
+    tar = tarfile.open(fileobj=data, mode='w:bz2')
+    for name, contents in sorted(FILES.items()):
+        info = tarfile.TarInfo('boost_1_60_0/{}'.format(name))
+        info.size = len(contents)
+        tar.addfile(info, io.BytesIO(contents))
+    tar.close()
+    return data.getvalue()
+
+TARBALL = make_tarball()
+TARBALL_SHA256 = hashlib.sha256(TARBALL).hexdigest()
+
+class TarballHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(self.headers.getheader('Range'))
+        start = 0
+        match = re.match(r'bytes=(\d+)-$', self.headers.getheader('Range') or '')
+        if match and server.ranges:
+            start = int(match.group(1))
+            if start >= len(server.data):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(server.data) - 1, len(server.data)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(server.data) - start))
+        self.end_headers()
+        end = len(server.data)
+        if server.cuts:
+            # Drop the connection partway through the response
+            end = min(end, start + server.cuts.pop(0))
+        self.wfile.write(server.data[start:end])
+
+    def log_message(self, *args):
+        pass
+
+class TarballServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, data):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), TarballHandler)
+        self.data = data
+        self.ranges = True
+        # Bytes to send of each of the next responses before closing the connection
+        self.cuts = []
+        self.requests = []
+
+    def handle_error(self, request, client_address):
+        # The client hangs up without reading the rest of corrupt data
+        pass
+
+class FetchTarballTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.server = TarballServer(TARBALL)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{}/boost_1_60_0.tar.bz2'.format(self.server.server_address[1])
+        self.tarball_path = os.path.join(self.dir, 'boost_1_60_0.tar.bz2')
+        self.part_path = '{}.part'.format(self.tarball_path)
+        self.dst_dir = os.path.join(self.dir, 'boost_1_60_0')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dir)
+
+    def fetch(self, **kwargs):
+        build.fetch_tarball(self.url, self.tarball_path, self.dst_dir, **kwargs)
+
+    def extracted(self):
+        files = {}
+        for root, dirs, names in os.walk(self.dst_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                with open(path, 'rb') as f:
+                    files[os.path.relpath(path, self.dst_dir)] = f.read()
+        return files
+
+    def assert_fetched(self):
+        self.assertEqual(self.extracted(), FILES)
+        with open(self.tarball_path, 'rb') as f:
+            self.assertEqual(f.read(), TARBALL)
+        self.assertFalse(os.path.exists(self.part_path))
+        self.assertFalse(os.path.exists('{}.partial'.format(self.dst_dir)))
+
+    def test_download(self):
+        self.fetch(sha256=TARBALL_SHA256)
+        self.assert_fetched()
+        self.assertEqual(self.server.requests, [None])
+
+    def test_resume_after_cut(self):
+        cut = len(TARBALL) // 2
+        self.server.cuts = [cut]
+        self.fetch(sha256=TARBALL_SHA256)
+        self.assert_fetched()
+        self.assertEqual(self.server.requests, [None, 'bytes={}-'.format(cut)])
+
+    def test_resume_part_file(self):
+        # A .part file left behind by an earlier run is replayed, and the rest requested
+        cut = len(TARBALL) // 3
+        with open(self.part_path, 'wb') as f:
+            f.write(TARBALL[:cut])
+        self.fetch(sha256=TARBALL_SHA256)
+        self.assert_fetched()
+        self.assertEqual(self.server.requests, ['bytes={}-'.format(cut)])
+
+    def test_failed_download_keeps_part_file(self):
+        self.server.cuts = [100000] * (build.FETCH_RETRIES + 1)
+        self.assertRaises(build.FetchError, self.fetch, sha256=TARBALL_SHA256)
+        self.assertEqual(os.path.getsize(self.part_path), 100000 * (build.FETCH_RETRIES + 1))
+        self.assertFalse(os.path.exists(self.tarball_path))
+        self.assertFalse(os.path.exists(self.dst_dir))
+        self.assertFalse(os.path.exists('{}.partial'.format(self.dst_dir)))
+        # The next run picks up where this one stopped
+        self.server.requests = []
+        self.fetch(sha256=TARBALL_SHA256)
+        self.assert_fetched()
+        self.assertEqual(self.server.requests, ['bytes={}-'.format(100000 * (build.FETCH_RETRIES + 1))])
+
+    def test_resume_without_range_support(self):
+        self.server.ranges = False
+        self.server.cuts = [len(TARBALL) // 2]
+        self.assertRaises(build.FetchError, self.fetch, sha256=TARBALL_SHA256)
+        self.assertFalse(os.path.exists(self.dst_dir))
+
+    def test_checksum_mismatch(self):
+        self.assertRaises(build.FetchError, self.fetch, sha256='0' * 64)
+        # The download is discarded rather than resumed
+        self.assertFalse(os.path.exists(self.part_path))
+        self.assertFalse(os.path.exists(self.tarball_path))
+        self.assertFalse(os.path.exists(self.dst_dir))
+        self.assertFalse(os.path.exists('{}.partial'.format(self.dst_dir)))
+
+    def test_corrupt_download(self):
+        self.server.data = TARBALL[:1000] + '\0' * 1000 + TARBALL[2000:]
+        self.assertRaises(build.FetchError, self.fetch)
+        self.assertFalse(os.path.exists(self.part_path))
+        self.assertFalse(os.path.exists(self.dst_dir))
+
+    def test_wanted(self):
+        self.fetch(sha256=TARBALL_SHA256, wanted=lambda member: member.name.startswith('boost/'))
+        self.assertEqual(self.extracted(), dict([(name, contents) for name, contents in FILES.items()
+                                                 if name.startswith('boost/')]))
+        # The whole tarball is still downloaded and verified
+        with open(self.tarball_path, 'rb') as f:
+            self.assertEqual(f.read(), TARBALL)
+
+    def test_existing_tarball(self):
+        with open(self.tarball_path, 'wb') as f:
+            f.write(TARBALL)
+        self.fetch(sha256=TARBALL_SHA256)
+        self.assert_fetched()
+        self.assertEqual(self.server.requests, [])
+
+    def test_existing_tarball_mismatch(self):
+        with open(self.tarball_path, 'wb') as f:
+            f.write(TARBALL)
+        self.assertRaises(build.FetchError, self.fetch, sha256='0' * 64)
+        self.assertFalse(os.path.exists(self.tarball_path))
+
+if __name__ == '__main__':
+    unittest.main()
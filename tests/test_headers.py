@@ -0,0 +1,160 @@
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import unittest
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPO_DIR)
+import build
+
+# The Boost source the installed include/boost was extracted from by bcp: the
+# build's own working tree, unless BOOST_SOURCE_DIR names another
+BOOST_SOURCE_DIR = os.environ.get('BOOST_SOURCE_DIR') or \
+    os.path.join(REPO_DIR, 'build', 'boost_{}'.format(build.BOOST_VERSION.replace('.', '_')))
+
+class IncludeIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.dir, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def closure(self, root, modules):
+        index = build.IncludeIndex(root, build.BOOST_VERSION, self.cache_dir)
+        index.load()
+        return index.closure(modules)
+
+#-------------------------------------------------------------------------------
+#
+# bcp's rules
+#
+#-------------------------------------------------------------------------------
+
+# {path: contents} of a small Boost tree
+SOURCE_TREE = {
+    'boost/thread.hpp': '#include <boost/thread/thread.hpp>\n',
+    'boost/thread/thread.hpp': '#include "detail/config.hpp"\n',
+    'boost/thread/detail/config.hpp': '#include <boost/config.hpp>\n',
+    'boost/thread/unused.hpp': '',
+    'boost/config.hpp': '',
+    'boost/config/user.hpp': '',
+    'boost/asio.hpp': '#include <boost/asio/io_service.hpp>\n',
+    'boost/asio/io_service.hpp': '',
+    'boost/date_time/date.hpp': '#include <boost/cstdint.hpp>\n',
+    'boost/cstdint.hpp': '',
+    'boost/make_shared.hpp': '',
+    'boost/weak_ptr.hpp': '',
+    'boost/regex.hpp': '',
+    # Only tests and examples use these
+    'libs/thread/test/test_once.cpp': '#include <boost/make_shared.hpp>\n',
+    'libs/thread/example/server.cpp': '#include <boost/asio.hpp>\n',
+    'libs/thread/src/once.cpp': '#include <boost/thread/once.hpp>\n#include <boost/date_time/date.hpp>\n',
+    'boost/thread/once.hpp': '',
+    # A library whose header is used brings its sources along
+    'libs/date_time/src/gregorian/greg_month.cpp': '#include <boost/weak_ptr.hpp>\n',
+    'libs/date_time/test/testdate.cpp': '#include <boost/regex.hpp>\n',
+    'libs/thread/doc/thread.html': '<boost/regex.hpp>\n',
+}
+
+class BcpRulesTest(IncludeIndexTestCase):
+
+    def make_tree(self):
+        root = os.path.join(self.dir, 'boost_1_60_0')
+        for path, contents in SOURCE_TREE.items():
+            if not os.path.isdir(os.path.dirname(os.path.join(root, path))):
+                os.makedirs(os.path.dirname(os.path.join(root, path)))
+            with open(os.path.join(root, path), 'w') as f:
+                f.write(contents)
+        return root
+
+    def test_module(self):
+        closure = self.closure(self.make_tree(), ['thread'])
+        self.assertEqual([path for path in closure if path.startswith('boost/')], [
+            'boost/asio.hpp',
+            'boost/asio/io_service.hpp',
+            'boost/config.hpp',
+            'boost/config/user.hpp',
+            'boost/cstdint.hpp',
+            'boost/date_time/date.hpp',
+            'boost/make_shared.hpp',
+            'boost/thread.hpp',
+            'boost/thread/detail/config.hpp',
+            'boost/thread/once.hpp',
+            'boost/thread/thread.hpp',
+            'boost/thread/unused.hpp',
+            'boost/weak_ptr.hpp',
+        ])
+        # Other libraries' tests and docs aren't followed
+        self.assertNotIn('boost/regex.hpp', closure)
+        self.assertIn('libs/date_time/src/gregorian/greg_month.cpp', closure)
+        self.assertNotIn('libs/date_time/test/testdate.cpp', closure)
+
+    def test_header(self):
+        closure = self.closure(self.make_tree(), ['boost/date_time/date.hpp'])
+        self.assertEqual(closure, [
+            'boost/cstdint.hpp',
+            'boost/date_time/date.hpp',
+            'boost/weak_ptr.hpp',
+            'libs/date_time/src/gregorian/greg_month.cpp',
+        ])
+
+    def test_minimal_source(self):
+        # A minimal tree holds everything the resolver reads
+        root = self.make_tree()
+        tarball_path = os.path.join(self.dir, 'boost.tar')
+        tar = tarfile.open(tarball_path, 'w')
+        tar.add(root, 'boost_1_60_0')
+        tar.close()
+        boost_source = build.BoostSource(build.BuildEnv(self.dir), build.BOOST_VERSION)
+        wanted = boost_source.source_filter()
+        minimal_root = os.path.join(self.dir, 'minimal')
+        tar = tarfile.open(tarball_path)
+        for member in tar:
+            member = build.strip_member_path(member, 1)
+            if member and wanted(member):
+                tar.extract(member, minimal_root)
+        tar.close()
+        self.assertFalse(os.path.exists(os.path.join(minimal_root, 'libs/date_time/test')))
+        modules = ['thread', 'boost/date_time/date.hpp']
+        self.assertEqual(self.closure(minimal_root, modules), self.closure(root, modules))
+
+class SyncTreeTest(IncludeIndexTestCase):
+
+    def test_prune(self):
+        src_root = os.path.join(self.dir, 'src')
+        dst_root = os.path.join(self.dir, 'dst')
+        for root, names in [(src_root, ['a.hpp']), (dst_root, ['a.hpp', 'b/c.hpp'])]:
+            os.makedirs(os.path.join(root, 'b'))
+            for name in names:
+                with open(os.path.join(root, name), 'w') as f:
+                    f.write(name)
+        # The native resolver's sync keeps headers only bcp reached
+        self.assertEqual(build.sync_tree(src_root, dst_root, prune=False), (0, 0, 1))
+        self.assertTrue(os.path.isfile(os.path.join(dst_root, 'b/c.hpp')))
+        self.assertEqual(build.sync_tree(src_root, dst_root), (0, 1, 1))
+        self.assertEqual(build.list_files(dst_root), set(['a.hpp']))
+
+#-------------------------------------------------------------------------------
+#
+# The installed headers
+#
+#-------------------------------------------------------------------------------
+
+@unittest.skipUnless(os.path.isdir(os.path.join(BOOST_SOURCE_DIR, 'libs')),
+                     'needs the Boost {} source in {} (or BOOST_SOURCE_DIR)'.format(build.BOOST_VERSION, BOOST_SOURCE_DIR))
+class InstalledHeadersTest(IncludeIndexTestCase):
+
+    def test_same_as_bcp(self):
+        # The native resolver finds the headers bcp installed in include/boost
+        closure = self.closure(BOOST_SOURCE_DIR, build.BOOST_LIBS + build.BOOST_HEADERS)
+        native = set([path for path in closure if path.startswith('boost/')])
+        installed = set(['boost/' + path for path in build.list_files(os.path.join(REPO_DIR, 'include', 'boost'))])
+        self.assertEqual(sorted(installed - native), [])
+        self.assertEqual(sorted(native - installed), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import build
+
+class SyncTreeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.src_root = os.path.join(self.dir, 'src')
+        self.dst_root = os.path.join(self.dir, 'dst')
+        self.store_root = os.path.join(self.dir, 'store')
+        os.makedirs(os.path.join(self.src_root, 'boost'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, relative_path, contents):
+        with open(os.path.join(self.src_root, relative_path), 'w') as f:
+            f.write(contents)
+
+    def read(self, relative_path):
+        with open(os.path.join(self.dst_root, relative_path)) as f:
+            return f.read()
+
+    def test_same_size_edit_in_the_same_second(self):
+        for mode in build.SYNC_MODES:
+            self.write('boost/a.hpp', '#define A 1\n')
+            self.write('boost/b.hpp', '#define B 1\n')
+            build.sync_tree(self.src_root, self.dst_root, mode, self.store_root)
+            self.write('boost/a.hpp', '#define A 2\n')
+            # The edit and the installed copy share a timestamp
+            mtime = int(os.path.getmtime(os.path.join(self.dst_root, 'boost/a.hpp')))
+            for root in [self.src_root, self.dst_root]:
+                os.utime(os.path.join(root, 'boost/a.hpp'), (mtime, mtime))
+            self.assertEqual(build.sync_tree(self.src_root, self.dst_root, mode, self.store_root), (1, 0, 1), mode)
+            self.assertEqual(self.read('boost/a.hpp'), '#define A 2\n', mode)
+            shutil.rmtree(self.dst_root)
+
+if __name__ == '__main__':
+    unittest.main()